@@ -20,8 +20,20 @@ from dacman.core import diff
 from dacman.core import cleanup
 from dacman.core import mpi_indexer
 from dacman.core import metadata
+from dacman.core import hashing
+from dacman.core import manifest
 
 
+def _addScanOptions(parser_worker):
+    parser_worker.add_argument('-i', '--ignore', help='(optional) ignores files and directories matching these patterns', nargs='*')
+    parser_worker.add_argument('--extensions', help='(optional) only scans files with these extensions', nargs='*')
+    parser_worker.add_argument('--min-size', dest='min_size', help='(optional) only scans files of at least this size (in bytes)', type=int)
+    parser_worker.add_argument('--max-size', dest='max_size', help='(optional) only scans files of at most this size (in bytes)', type=int)
+    parser_worker.add_argument('--newer-than', dest='newer_than', help='(optional) only scans files modified in the last NEWER_THAN days', type=float)
+    parser_worker.add_argument('--older-than', dest='older_than', help='(optional) only scans files not modified in the last OLDER_THAN days', type=float)
+    parser_worker.add_argument('--symlinks', help='(optional) allows recursive scanning symbolic links', action='store_true')
+    parser_worker.add_argument('--metadata-details', dest='metadetails', help='(optional) capture detailed filesystem metadata', action='store_true')
+
 def _addScanParser(subparsers):
     parser_worker = subparsers.add_parser('scan',
                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -31,10 +43,10 @@ def _addScanParser(subparsers):
     #parser_worker.add_argument('-d','--datapath', help='path to the dataset', required=True)    
     parser_worker.add_argument(dest='datapath', help='path to the dataset')    
     parser_worker.add_argument('-s','--stage', dest='stagingdir', help='(optional) directory where indexes and metadata information will be saved')    
-    parser_worker.add_argument('-i', '--ignore', help='(optional) ignores files of specific types', nargs='*')
+    _addScanOptions(parser_worker)
     parser_worker.add_argument('--nonrecursive', help='(optional) only scans specified directory contents, ignoring subdirectory contents', action='store_true')
-    parser_worker.add_argument('--symlinks', help='(optional) allows recursive scanning symbolic links', action='store_true')
-    parser_worker.add_argument('--metadata-details', dest='metadetails', help='(optional) capture detailed filesystem metadata', action='store_true')
+    parser_worker.add_argument('-t', '--threads', help='(optional) number of threads listing subdirectories in parallel', type=int, default=1)
+    parser_worker.add_argument('--incremental', help='(optional) only rescans directories changed since the last scan', action='store_true')
     #parser_worker.add_argument('-U','--usermeta', help='optional user-level metadata <to be implemented>')    
 
 def _addIndexParser(subparsers):
@@ -46,7 +58,22 @@ def _addIndexParser(subparsers):
     #parser_worker.add_argument('-d','--datapath', help='path to the dataset', required=True)    
     parser_worker.add_argument(dest='datapath', help='path to the dataset')    
     parser_worker.add_argument('-s','--stage', dest='stagingdir', help='(optional) directory where indexes and metadata information will be saved')    
-    parser_worker.add_argument('-m','--manager', help='execution manager', choices=['python', 'tigres', 'mpi'], default='python')
+    parser_worker.add_argument('-m','--manager', help='execution manager', choices=['python', 'threads', 'asyncio', 'tigres', 'mpi'], default='python')
+    parser_worker.add_argument('-t', '--threads', help='(optional) number of threads hashing files with the threads manager', type=int, default=indexer.DEFAULT_HASH_THREADS)
+    parser_worker.add_argument('--concurrency', help='(optional) maximum number of files read at once with the asyncio manager', type=int, default=indexer.DEFAULT_CONCURRENCY)
+    parser_worker.add_argument('--pipeline', help='(optional) hashes files while the data path is being scanned, with the scan options below', action='store_true')
+    _addScanOptions(parser_worker)
+    parser_worker.add_argument('-a', '--algorithm', help='(optional) hash algorithm used for indexing', choices=sorted(hashing.ALGORITHMS), default=hashing.DEFAULT_ALGORITHM)
+    parser_worker.add_argument('--block-size', dest='block_size', help='(optional) size of the blocks read for hashing (in MiB)', type=int, default=1)
+    parser_worker.add_argument('--no-readahead', dest='no_readahead', help='(optional) disables reading the next block while hashing the current one', action='store_true')
+    parser_worker.add_argument('--mmap', help='(optional) memory-maps files for hashing, suitable for local filesystems', action='store_true')
+    parser_worker.add_argument('--chunk-size', dest='chunk_size', help='(optional) size of the chunks hashed in parallel for larger files, which get a tree hash (in MiB, 0 disables)', type=int, default=0)
+    parser_worker.add_argument('--cdc-size', dest='cdc_size', help='(optional) average size of the content-defined chunks recorded for each file, to measure changes within files (in MiB, 0 disables)', type=int, default=0)
+    parser_worker.add_argument('--verify', help='(optional) rehashes all files, instead of reusing the hashes of files unchanged since the previous index', action='store_true')
+    parser_worker.add_argument('--resume', help='(optional) resumes an interrupted indexing, reusing the hashes journaled for files that are unchanged since', action='store_true')
+    parser_worker.add_argument('--continue-on-error', help='(optional) leaves out the files that cannot be read and indexes the others, listing the files left out in the ERRORS file of the index', action='store_true')
+    parser_worker.add_argument('--hash-cache', help='(optional) reuses and records the hashes of files in a hash cache shared by the data paths of the staging directory', action='store_true')
+    parser_worker.add_argument('--xattrs', help='(optional) stores the hash of each file in its extended attributes, and reuses it while the file is unchanged', action='store_true')
 
 def _addChangeParser(subparsers):
     parser_worker = subparsers.add_parser('compare',
@@ -60,6 +87,7 @@ def _addChangeParser(subparsers):
     parser_worker.add_argument(dest='newpath', help='path to the new dataset')    
     parser_worker.add_argument('-s','--stage', dest='stagingdir', help='(optional) directory where indexes and metadata information will be saved')    
     parser_worker.add_argument('-F', '--force', help='(optional) force data comparison even if the changes are pre-calculated', action='store_true')
+    parser_worker.add_argument('--staged', help='(optional) compares file sizes and partial hashes first, and only hashes whole files when needed, instead of indexing both datasets', action='store_true')
     #parser_worker.add_argument('-N','--newdeducedir', help='optional directory for saving indexes and metadata for new datapath (for read-only data directories)')    
 
 def _addDiffParser(subparsers):
@@ -97,6 +125,21 @@ def _addMetadataParser(subparsers):
     parser_worker.add_argument('-m', '--metadata', help='user-level metadata')    
     parser_worker.add_argument('-s','--stage', dest='stagingdir', help='(optional) directory where indexes and metadata information will be saved')
 
+def _addManifestParser(subparsers):
+    parser_worker = subparsers.add_parser('manifest',
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                          help=""" Imports checksum manifests into indexes, and exports indexes as manifests """)
+
+    parser_worker.set_defaults(action="manifest")
+    parser_worker.add_argument(dest='option', choices=['import', 'export'], help='imports a manifest into the index of the dataset, or exports its index as a manifest', type=str)
+    parser_worker.add_argument(dest='datapath', help='path to the dataset')
+    parser_worker.add_argument('-f', '--file', help='BagIt manifest (manifest-<algorithm>.txt) or md5sum-style checksum list to import, or to export to')
+    parser_worker.add_argument('-s','--stage', dest='stagingdir', help='(optional) directory where indexes and metadata information will be saved')
+    parser_worker.add_argument('-a', '--algorithm', help='(optional) hash algorithm of an imported manifest, by default from the name of BagIt manifests or from the length of the digests', choices=sorted(hashing.ALGORITHMS))
+    parser_worker.add_argument('--sample', help='(optional) number of random files of an imported manifest hashed to verify their digests', type=int, default=0)
+    parser_worker.add_argument('--continue-on-error', help='(optional) leaves out the files of an imported manifest that cannot be read, and indexes the others', action='store_true')
+    parser_worker.add_argument('--prefix', help='(optional) prefix of the paths of an exported manifest, e.g. data/ for a BagIt bag', default='')
+
 ##################################
 def main():
     parser = argparse.ArgumentParser(description="",
@@ -110,6 +153,7 @@ def main():
     _addDiffParser(subparsers)
     _addCleanupParser(subparsers)
     _addMetadataParser(subparsers)
+    _addManifestParser(subparsers)
 
     args = parser.parse_args()
     if len(args.__dict__) == 0:
@@ -134,6 +178,8 @@ def main():
         cleanup.main(args)
     elif action == 'metadata':
         metadata.main(args)
+    elif action == 'manifest':
+        manifest.main(args)
     else:
         print("Invalid action!")
 
@@ -206,10 +206,11 @@ The module function will be removed
 '''
 class ChangeManager(object):
 
-   def __init__(self, old_datapath, new_datapath, force=False, custom_stagingdir=None):
+   def __init__(self, old_datapath, new_datapath, force=False, custom_stagingdir=None, staged=False):
       self._old_datapath = old_datapath
       self._new_datapath = new_datapath
       self._force = force
+      self._staged = staged
       if not custom_stagingdir:
          self._stagingdir = dacman_utils.DACMAN_STAGING_LOC
       else:
@@ -231,6 +232,10 @@ class ChangeManager(object):
    def force(self):
       return self._force
    
+   @property
+   def staged(self):
+      return self._staged
+
    @property
    def stagingdir(self):
       return self._stagingdir
@@ -348,7 +353,7 @@ class ChangeManager(object):
       logger.info('Checking for changes between %s and %s', self.old_datapath, self.new_datapath)
 
       if cache_status == CacheStatus.NOT_CACHED:
-         change_dir = comparator.compare(self.old_datapath, self.new_datapath, self.stagingdir)
+         change_dir = comparator.compare(self.old_datapath, self.new_datapath, self.stagingdir, self.staged)
       else:
          with open(self.cache_entries, 'r') as f:
             cache = yaml.safe_load(f)
@@ -862,9 +867,10 @@ def main(args):
     newpath = os.path.abspath(args.newpath)
     stagingdir = args.stagingdir
     force = args.force
+    staged = args.staged
 
     #change = changes(oldpath, newpath, force, stagingdir)
-    changeManager = ChangeManager(oldpath, newpath, force, stagingdir)
+    changeManager = ChangeManager(oldpath, newpath, force, stagingdir, staged)
     status, cached_old_path, cached_new_path = changeManager.get_cached_paths()
     change = changeManager.get_changes(status, cached_old_path, cached_new_path)
     display(change)
@@ -0,0 +1,113 @@
+"""
+`dacman.core.chunking`
+====================================
+
+.. currentmodule:: dacman.core.chunking
+
+:platform: Unix, Mac
+:synopsis: Module for content-defined chunking of files with a rolling hash
+
+"""
+
+import hashlib
+
+import numpy as np
+
+import dacman.core.hashing as hashing
+
+import logging
+
+__modulename__ = 'chunking'
+
+logger = logging.getLogger(__name__)
+
+'''
+random value of each byte for the gear rolling hash, derived from MD5 so that
+chunk boundaries are stable across versions and platforms
+'''
+GEAR = np.array([int.from_bytes(hashlib.md5(bytes([i])).digest()[:4], 'little') for i in range(256)],
+                dtype=np.uint32)
+
+
+class ContentChunker(object):
+    '''
+    Splits the data it is fed into chunks whose boundaries depend on the content,
+    so that an insertion or deletion only changes the chunks around it.
+    A boundary follows each byte where the low bits of a gear rolling hash are zero,
+    which happens on average every `avg_size` bytes; chunks are kept between
+    a quarter and four times that size. The boundaries of a whole block are
+    found at once with NumPy, and the (length, hash) of each chunk is recorded.
+    '''
+    def __init__(self, avg_size, algorithm=hashing.DEFAULT_ALGORITHM):
+        # the low bits of the gear hash only depend on as many trailing bytes
+        self.window = min(max(avg_size.bit_length() - 1, 1), 31)
+        self.mask = np.uint32((1 << self.window) - 1)
+        self.min_size = max(avg_size // 4, self.window)
+        self.max_size = avg_size * 4
+        self.algorithm = algorithm
+        self.chunks = []
+        self._checksum = hashing.new_hash(algorithm)
+        self._tail = np.empty(0, dtype=np.uint8)
+        self._offset = 0
+        self._start = 0
+        self._fed = 0
+
+    def _cut(self, data, cut):
+        self._checksum.update(data[self._fed - self._offset:cut - self._offset])
+        self.chunks.append((cut - self._start, self._checksum.hexdigest()))
+        self._checksum = hashing.new_hash(self.algorithm)
+        self._start = self._fed = cut
+
+    def _boundaries(self, data):
+        window = np.concatenate((self._tail, np.frombuffer(data, dtype=np.uint8)))
+        self._tail = window[max(len(window) - self.window + 1, 0):].copy()
+        if len(window) < self.window:
+            return []
+        w = self.window
+        n = len(window)
+        # the hash of each window of w bytes is the sum of the shifted gear values
+        # of its bytes; windows of 1, 2, 4... bytes are combined to compute it
+        # in a logarithmic number of passes over the block
+        rolling = None
+        covered = 0
+        power = GEAR[window]
+        span = 1
+        while span <= w:
+            if w & span:
+                if rolling is None:
+                    rolling = power
+                else:
+                    rolling = rolling[span:] + (power[:n - covered - span + 1] << np.uint32(covered))
+                covered += span
+            if 2 * span <= w:
+                power = power[span:] + (power[:n - 2 * span + 1] << np.uint32(span))
+            span *= 2
+        # offsets in the file of the bytes after which a chunk may end
+        first = self._offset - (n - len(data)) + w
+        return (np.flatnonzero((rolling & self.mask) == 0) + first).tolist()
+
+    def update(self, data):
+        end = self._offset + len(data)
+        for cut in self._boundaries(data):
+            while cut - self._start > self.max_size:
+                self._cut(data, self._start + self.max_size)
+            if cut - self._start >= self.min_size:
+                self._cut(data, cut)
+        while end - self._start > self.max_size:
+            self._cut(data, self._start + self.max_size)
+        self._checksum.update(data[self._fed - self._offset:])
+        self._offset = self._fed = end
+
+    def finish(self):
+        if self._offset > self._start:
+            self.chunks.append((self._offset - self._start, self._checksum.hexdigest()))
+            self._start = self._offset
+        return self.chunks
+
+
+def changed_bytes(old_chunks, new_chunks):
+    '''
+    Returns the number of bytes of a file in chunks that are not in its previous version.
+    '''
+    old_hashes = set(chunk_hash for length, chunk_hash in old_chunks)
+    return sum(length for length, chunk_hash in new_chunks if chunk_hash not in old_hashes)
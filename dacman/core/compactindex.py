@@ -0,0 +1,137 @@
+"""
+`dacman.core.compactindex`
+====================================
+
+.. currentmodule:: dacman.core.compactindex
+
+:platform: Unix, Mac
+:synopsis: Module for holding the indexes of large datasets compactly in memory
+
+"""
+
+import os
+import hashlib
+from array import array
+
+import numpy as np
+
+import dacman.core.indexstore as indexstore
+
+import logging
+
+__modulename__ = 'compactindex'
+
+logger = logging.getLogger(__name__)
+
+
+class Directories(object):
+    '''
+    Table of interned directory paths, shared by the indexes that are compared
+    so that the same directory has the same identifier in all of them.
+    '''
+    def __init__(self):
+        self.ids = {}
+        self.paths = []
+
+    def get_id(self, dirpath):
+        dir_id = self.ids.get(dirpath)
+        if dir_id is None:
+            dir_id = self.ids[dirpath] = len(self.paths)
+            self.paths.append(dirpath)
+        return dir_id
+
+    def __getitem__(self, dir_id):
+        return self.paths[dir_id]
+
+
+def name_key(name):
+    '''
+    64-bit key of a file name, used to match names with vectorized operations.
+    '''
+    return hashlib.blake2b(name, digest_size=8).digest()
+
+
+class CompactIndex(object):
+    '''
+    Index of the files of a data path held compactly in memory, for comparing
+    datasets of many millions of files. The files are ordered by path: the
+    directory of each file is an identifier in a shared table of directories,
+    and the names of the files are stored one after the other in a single buffer.
+    The hash of each file is a fixed-width binary digest in a NumPy array, and
+    each name has a 64-bit key, so that hashes and names are compared and
+    searched for with vectorized operations. With MD5 hashes, a file takes
+    32 bytes plus the length of its name.
+    '''
+    def __init__(self, directories, dir_ids, names, name_offsets, name_keys, digests):
+        self.directories = directories
+        self.dir_ids = dir_ids
+        self.names = names
+        self.name_offsets = name_offsets
+        self.name_keys = name_keys
+        self.digests = digests
+
+    @classmethod
+    def load(cls, index_file, directories=None):
+        '''
+        Loads an index saved by the indexer, interning its directories in `directories`.
+        '''
+        if directories is None:
+            directories = Directories()
+        dir_ids = array('I')
+        names = bytearray()
+        name_offsets = array('Q', [0])
+        name_keys = bytearray()
+        digests = bytearray()
+        digest_size = 0
+        with indexstore.IndexStore(index_file) as store:
+            for filepath, file_hash in store.conn.execute('SELECT path, hash FROM files ORDER BY path'):
+                dirpath, name = os.path.split(filepath)
+                name = name.encode('utf-8', 'surrogateescape')
+                dir_ids.append(directories.get_id(dirpath))
+                names += name
+                name_offsets.append(len(names))
+                name_keys += name_key(name)
+                digest = bytes.fromhex(file_hash)
+                digest_size = len(digest)
+                digests += digest
+
+        # offsets are stored in 32 bits unless the names take more than 4 GiB
+        offset_type = np.uint32 if len(names) < (1 << 32) else np.uint64
+        index = cls(directories, np.frombuffer(dir_ids, dtype=np.uint32).copy(), bytes(names),
+                    np.frombuffer(name_offsets, dtype=np.uint64).astype(offset_type),
+                    np.frombuffer(bytes(name_keys), dtype='S8'),
+                    np.frombuffer(bytes(digests), dtype='S{}'.format(max(digest_size, 1))))
+        logger.info('Loaded %d files from %s in %d bytes (%.1f bytes per file)', len(index), index_file,
+                    index.nbytes, float(index.nbytes) / len(index) if len(index) else 0.0)
+        return index
+
+    def __len__(self):
+        return len(self.dir_ids)
+
+    @property
+    def nbytes(self):
+        return (self.dir_ids.nbytes + len(self.names) + self.name_offsets.nbytes +
+                self.name_keys.nbytes + self.digests.nbytes)
+
+    def name(self, i):
+        return self.names[self.name_offsets[i]:self.name_offsets[i + 1]].decode('utf-8', 'surrogateescape')
+
+    def path(self, i):
+        return os.path.join(self.directories[self.dir_ids[i]], self.name(i))
+
+    def path_keys(self):
+        '''
+        Returns a key for the path of each file, made of its directory identifier
+        and name key, which is the same for the same path in indexes that share
+        their directories.
+        '''
+        keys = np.empty(len(self), dtype=[('dir', '>u4'), ('name', 'S8')])
+        keys['dir'] = self.dir_ids
+        keys['name'] = self.name_keys
+        return keys.view('S12')
+
+    def digest(self, file_hash):
+        '''
+        Returns the binary digest of a hex hash, as stored in the index.
+        '''
+        return np.array(bytes.fromhex(file_hash), dtype=self.digests.dtype)
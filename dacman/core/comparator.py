@@ -13,8 +13,16 @@
 
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 import dacman.core.indexer as indexer
+import dacman.core.scanner as scanner
+import dacman.core.hashing as hashing
+import dacman.core.chunking as chunking
+import dacman.core.indexstore as indexstore
+from dacman.core.compactindex import CompactIndex, Directories
 from dacman.core.utils import get_hash_id
 import dacman.core.utils as dacman_utils
 
@@ -22,155 +30,86 @@ import logging
 
 __modulename__ = 'comparator'
 
-def get_index_data(index_file):
-    index_data = {}
-    with open(index_file) as f:
-        lines = f.readlines()
-        for line in lines:
-            kv = line.split(':')
-            index_data[kv[0].strip()] = kv[1].strip()
-    return index_data
+# number of bytes hashed at each end of the files compared in staged mode
+PARTIAL_HASH_SIZE = 4 << 20
+# number of threads reading the files compared in staged mode
+HASH_THREADS = 8
 
 '''
-Function to compare data and find changes
-Algo:
-- for filepaths in NEW_PATH_INDEX:
- - if filepaths match between NEW_PATH_INDEX and OLD_PATH_INDEX, then:
-   -- if datahashes match, then add to unchanged
-   -- else, add to modified
-   -- remove from OLD_PATH_INDEX
- - else if filename is found in OLD_NAME_PATHS (but paths differ), then:
-   -- get all associated filepaths from OLD_NAME_PATHS (and associated datahashes)
-   -- for all these filepaths:
-     --- if datahashes match between NEW_PATH_INDEX and OLD_PATH_INDEX, then unchanged
-        ---- remove it from OLD_PATH_INDEX, and break
-  -- if no datahash match has been found
-     --- select the first filepath, mark it modified
-     --- remove it from OLD_PATH_INDEX and OLD_NAME_PATHS
- - else (no matching path or filename):
-   -- if datahashes match to any OLD_DATA_INDEX, then add to unchanged
-     --- remove it from OLD_PATH_INDEX and OLD_DATA_INDEX
-   -- else, add to added
-- for all remaining filepaths in OLD_PATH_INDEX:
-   -- add to deleted
+hashing options to index a data path as the index with this header was indexed
 '''
-def compare(old_datapath, new_datapath, custom_stagingdir):
-    logger = logging.getLogger(__name__)
-
-    logger.info('Starting directory comparison')
-    if not custom_stagingdir:        
-        #old_stagingdir = os.path.join(old_datapath, '.deduce')
-        stagingdir = dacman_utils.DACMAN_STAGING_LOC
-    else:
-        stagingdir = custom_stagingdir
-
-    old_indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(old_datapath))
-    new_indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(new_datapath))
-
-    old_index_file = os.path.join(old_indexdir, 'PATH.idx')
-    new_index_file = os.path.join(new_indexdir, 'PATH.idx')
-    
-    if not os.path.exists(old_index_file):
-        indexer.index(old_datapath, stagingdir)
-    if not os.path.exists(new_index_file):
-        indexer.index(new_datapath, stagingdir)
-
-    old_data_index_file = os.path.join(old_indexdir, 'DATA.idx')
-    old_pathname_map_file = os.path.join(old_indexdir, 'PATHNAME.map')
-
-    old_metafile = os.path.join(old_indexdir, 'METADATA')
-    new_metafile = os.path.join(new_indexdir, 'METADATA')
+def get_hash_options(header):
+    return hashing.HashOptions(algorithm=header['algorithm'], chunk_size=header['chunk_size'])
 
-    #cprint(__modulename__, 'Loading Indexes')
-    logger.info('Loading indexes for fast comparison')
-    old_path_indexes = dacman_utils.file_to_dict(old_index_file)
-    new_path_indexes = dacman_utils.file_to_dict(new_index_file)
-    old_data_indexes = dacman_utils.file_to_dict(old_data_index_file)
-    name_path_map = dacman_utils.file_to_dict_list(old_pathname_map_file)
-
-    old_metadata = dacman_utils.file_to_dict(old_metafile)
-    new_metadata = dacman_utils.file_to_dict(new_metafile)
+'''
+Byte ranges of the modified files that changed, for the files that have
+chunk hashes in both indexes; files whose size is not in the new index
+(e.g. imported from a manifest) have no ranges, and are modified as a whole
+'''
+def get_modified_ranges(modified, old_indexdir, new_indexdir, new_index_file, chunk_size):
+    logger = logging.getLogger(__name__)
+    old_chunk_indexes = indexer.read_chunk_index(os.path.join(old_indexdir, 'CHUNKS.idx'))
+    new_chunk_indexes = indexer.read_chunk_index(os.path.join(new_indexdir, 'CHUNKS.idx'))
+    if not old_chunk_indexes or not new_chunk_indexes:
+        return {}
+    modified_ranges = {}
+    with indexstore.IndexStore(new_index_file) as new_store:
+        for filepath, old_filepath in modified.items():
+            if filepath in new_chunk_indexes and old_filepath in old_chunk_indexes:
+                entry = new_store.get(filepath)
+                if entry is None or entry[1] is None:
+                    logger.debug('No size of %s in the index, modified as a whole', filepath)
+                    continue
+                new_size = entry[1][0]
+                ranges = hashing.changed_ranges(old_chunk_indexes[old_filepath], new_chunk_indexes[filepath],
+                                                chunk_size, new_size)
+                modified_ranges[filepath] = ' '.join('{}-{}'.format(start, end) for start, end in ranges)
+    return modified_ranges
 
-    _unchanged = []
-    _metachange = {}
-    _added = []
-    _deleted = []
-    _modified = {}
-    
-    #cprint(__modulename__, 'Comparing {} and {}'.format(old_datapath, new_datapath))
+'''
+Fraction of changed bytes of the modified files, and the files of the old
+version whose chunks are shared with the modified and added files, for the
+files that have content-defined chunks in both indexes
+'''
+def get_chunk_changes(modified, added, old_indexdir, new_indexdir):
+    old_header, old_cdc_indexes = indexer.read_cdc_index(os.path.join(old_indexdir, 'CDC.idx'))
+    new_header, new_cdc_indexes = indexer.read_cdc_index(os.path.join(new_indexdir, 'CDC.idx'))
+    if not old_header or old_header != new_header:
+        return {}, {}
+    chunk_paths = {}
+    for old_filepath, chunks in old_cdc_indexes.items():
+        for length, chunk_hash in chunks:
+            chunk_paths.setdefault(chunk_hash, set()).add(old_filepath)
 
-    # MD5 hash for a zero-byte file
-    __MAGIC_HASH__ = 'd41d8cd98f00b204e9800998ecf8427e'
+    modified_fractions = {}
+    shared_chunks = {}
+    changed_files = [(filepath, modified[filepath]) for filepath in modified] + \
+                    [(filepath, None) for filepath in added]
+    for filepath, old_filepath in changed_files:
+        if filepath not in new_cdc_indexes:
+            continue
+        chunks = new_cdc_indexes[filepath]
+        size = sum(length for length, chunk_hash in chunks)
+        if old_filepath in old_cdc_indexes:
+            nbytes = chunking.changed_bytes(old_cdc_indexes[old_filepath], chunks)
+            modified_fractions[filepath] = '{:.6f}'.format(float(nbytes) / size if size else 0.0)
+        shared_bytes = 0
+        shared_paths = set()
+        for length, chunk_hash in chunks:
+            other_paths = chunk_paths.get(chunk_hash, set()) - set([old_filepath])
+            if other_paths:
+                shared_bytes += length
+                shared_paths.update(other_paths)
+        if shared_paths:
+            shared_chunks[filepath] = '{} {}'.format(shared_bytes, ' '.join(sorted(shared_paths)))
+    return modified_fractions, shared_chunks
 
-    logger.info('Comparing files in %s and %s', old_datapath, new_datapath)
-    for filepath in new_path_indexes:
-        datahash = new_path_indexes[filepath]
-        if filepath in old_path_indexes:
-            '''
-            if filepaths are same, but data or metadata changed
-            '''
-            if datahash == old_path_indexes[filepath]:
-                if filepath in old_metadata and filepath in new_metadata:
-                    if old_metadata[filepath] == new_metadata[filepath]:
-                        _unchanged.append(filepath)
-                    else:
-                        _metachange[filepath] = filepath
-                else:
-                    _unchanged.append(filepath)
-            else:
-                _modified[filepath] = filepath
-            old_path_indexes.pop(filepath)
-            basename = os.path.basename(filepath)
-            if basename in name_path_map:
-                if filepath in name_path_map[basename]:
-                    name_path_map[basename].remove(filepath)
-                    if len(name_path_map[basename]) == 0:
-                        name_path_map.pop(basename)
-        elif os.path.basename(filepath) in name_path_map:
-            '''
-            if filenames are same, but filepaths and data changed
-            '''
-            filename = os.path.basename(filepath)
-            old_filepaths = name_path_map[filename]
-            for old_filepath in old_filepaths:
-                if datahash == old_path_indexes[old_filepath]:
-                    _metachange[filepath] = old_filepath
-                    old_path_indexes.pop(old_filepath)
-                    name_path_map[filename].remove(old_filepath)
-                    break
-            if filepath not in _metachange:
-                old_filepath = old_filepaths[0]
-                _modified[filepath] = old_filepath
-                old_path_indexes.pop(old_filepath)
-                del name_path_map[filename][0]
-            if len(name_path_map[filename]) == 0:
-                name_path_map.pop(filename)
-        elif datahash in old_data_indexes and datahash != __MAGIC_HASH__:
-            '''
-            if data remains same, but filepath changes
-            '''
-            old_filepath = old_data_indexes[datahash]
-            if old_filepath in old_path_indexes:
-                _metachange[filepath] = old_filepath
-                old_path_indexes.pop(old_filepath)
-                old_data_indexes.pop(datahash)
-                basename = os.path.basename(old_filepath)
-                if basename in name_path_map:
-                    if old_filepath in name_path_map[basename]:
-                        name_path_map[basename].remove(old_filepath)
-                        if len(name_path_map[basename]) == 0:
-                            name_path_map.pop(basename)
-            else:
-                _added.append(filepath)
-        else:
-            _added.append(filepath)
-                
-    for old_filepath in old_path_indexes:
-        _deleted.append(old_filepath)
+'''
+Saving change information in cache
+'''
+def save_changes(old_datapath, new_datapath, stagingdir, _unchanged, _added, _deleted, _modified, _metachange):
+    logger = logging.getLogger(__name__)
 
-    '''
-    Saving change information in cache
-    '''
     logger.info('Updating change cache entries')
     change_id = dacman_utils.hash_comparison_id(old_datapath, new_datapath)
     cachedir = os.path.join(stagingdir, 'cache')
@@ -203,6 +142,387 @@ def compare(old_datapath, new_datapath, custom_stagingdir):
     dacman_utils.dict_to_file(_modified, _mfile)
     dacman_utils.dict_to_file(_metachange, _mcfile)
 
+    return change_id, change_dir
+
+'''
+Compares the contents of the files of two data paths in stages, reading as
+little data as possible: files of different sizes differ, files of the same
+size are first compared by the hash of their first and last few MiB, and only
+the files whose partial hashes match are hashed fully. The hashes of each
+file are kept, so that a file is read at most once in each stage
+'''
+class StagedComparison(object):
+
+    def __init__(self, old_datapath, new_datapath):
+        self.datapaths = {'old': old_datapath, 'new': new_datapath}
+        self.sizes = {}
+        self.partial_hashes = {}
+        self.full_hashes = {}
+        self.bytes_read = 0
+
+    def stat(self, side, filepaths):
+        datapath = self.datapaths[side]
+        with ThreadPoolExecutor(max_workers=indexer.STAT_THREADS) as executor:
+            sizes = executor.map(lambda filepath: os.stat(os.path.join(datapath, filepath)).st_size, filepaths)
+            for filepath, size in zip(filepaths, sizes):
+                self.sizes[(side, filepath)] = size
+
+    def _hash(self, key, partial):
+        size = self.sizes[key]
+        with open(os.path.join(self.datapaths[key[0]], key[1]), 'rb', buffering=0) as f:
+            if partial:
+                return hashing.hash_ends(f, size, PARTIAL_HASH_SIZE), min(size, 2 * PARTIAL_HASH_SIZE)
+            return hashing.hash_file(f, size), size
+
+    def hash_all(self, keys, partial):
+        hashes = self.partial_hashes if partial else self.full_hashes
+        keys = [key for key in set(keys) if key not in hashes]
+        with ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+            for key, (file_hash, nbytes) in zip(keys, executor.map(lambda key: self._hash(key, partial), keys)):
+                hashes[key] = file_hash
+                self.bytes_read += nbytes
+
+    def same_contents(self, pairs):
+        '''
+        Returns the (old filepath, new filepath) pairs whose files have the same contents.
+        '''
+        pairs = [(('old', old), ('new', new)) for old, new in pairs
+                 if self.sizes[('old', old)] == self.sizes[('new', new)]]
+        self.hash_all([key for pair in pairs for key in pair], partial=True)
+        pairs = [(old, new) for old, new in pairs if self.partial_hashes[old] == self.partial_hashes[new]]
+        # the partial hash covers the whole contents of smaller files
+        full_pairs = [(old, new) for old, new in pairs if self.sizes[old] > 2 * PARTIAL_HASH_SIZE]
+        self.hash_all([key for pair in full_pairs for key in pair], partial=False)
+        return set((old[1], new[1]) for old, new in pairs
+                   if self.sizes[old] <= 2 * PARTIAL_HASH_SIZE or self.full_hashes[old] == self.full_hashes[new])
+
+    def find_same_contents(self, old_filepaths, new_filepath):
+        '''
+        Returns the first of `old_filepaths` with the same contents as `new_filepath`, if any.
+        '''
+        same = self.same_contents([(old_filepath, new_filepath) for old_filepath in old_filepaths])
+        for old_filepath in old_filepaths:
+            if (old_filepath, new_filepath) in same:
+                return old_filepath
+        return None
+
+'''
+Function to compare data in stages, without indexing the data paths first.
+The changes are classified as in `compare`:
+- files with the same path are unchanged (or metadata changes) if their
+  contents are the same, and modified otherwise
+- other new files are metadata changes of an old file with the same name and
+  contents, or modified if an old file has the same name but other contents
+- other new files are metadata changes of any old file with the same contents,
+  or added otherwise
+- the remaining old files are deleted
+'''
+def staged_compare(old_datapath, new_datapath, stagingdir):
+    logger = logging.getLogger(__name__)
+
+    logger.info('Comparing file sizes and partial hashes in stages')
+    old_indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(old_datapath))
+    new_indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(new_datapath))
+    old_paths_file = os.path.join(old_indexdir, 'FILEPATHS')
+    new_paths_file = os.path.join(new_indexdir, 'FILEPATHS')
+    for datapath, paths_file in [(old_datapath, old_paths_file), (new_datapath, new_paths_file)]:
+        if not os.path.exists(paths_file):
+            scanner.scan(datapath, stagingdir)
+    old_filepaths = indexer.read_filelist(old_paths_file)
+    new_filepaths = indexer.read_filelist(new_paths_file)
+
+    old_metadata = scanner.FileStats.load(os.path.join(old_indexdir, 'FILESTATS.npz'), old_paths_file)
+    new_metadata = scanner.FileStats.load(os.path.join(new_indexdir, 'FILESTATS.npz'), new_paths_file)
+
+    comparison = StagedComparison(old_datapath, new_datapath)
+    comparison.stat('old', old_filepaths)
+    comparison.stat('new', new_filepaths)
+
+    _unchanged = []
+    _metachange = {}
+    _added = []
+    _deleted = []
+    _modified = {}
+
+    logger.info('Comparing files in %s and %s', old_datapath, new_datapath)
+    old_remaining = set(old_filepaths)
+    common_filepaths = [filepath for filepath in new_filepaths if filepath in old_remaining]
+    same = comparison.same_contents([(filepath, filepath) for filepath in common_filepaths])
+    for filepath in common_filepaths:
+        if (filepath, filepath) not in same:
+            _modified[filepath] = filepath
+        elif filepath in old_metadata and filepath in new_metadata and \
+             old_metadata[filepath] != new_metadata[filepath]:
+            _metachange[filepath] = filepath
+        else:
+            _unchanged.append(filepath)
+        old_remaining.remove(filepath)
+
+    name_path_map = {}
+    size_path_map = {}
+    for old_filepath in old_filepaths:
+        if old_filepath in old_remaining:
+            name_path_map.setdefault(os.path.basename(old_filepath), []).append(old_filepath)
+            size_path_map.setdefault(comparison.sizes[('old', old_filepath)], []).append(old_filepath)
+
+    common_filepaths = set(common_filepaths)
+    for filepath in new_filepaths:
+        if filepath in common_filepaths:
+            continue
+        candidates = [old_filepath for old_filepath in name_path_map.get(os.path.basename(filepath), [])
+                      if old_filepath in old_remaining]
+        old_filepath = comparison.find_same_contents(candidates, filepath)
+        if old_filepath is None and candidates:
+            _modified[filepath] = candidates[0]
+            old_remaining.remove(candidates[0])
+            continue
+        size = comparison.sizes[('new', filepath)]
+        if old_filepath is None and size > 0:
+            # files with the same contents, and a different name, have the same size
+            candidates = [old_filepath for old_filepath in size_path_map.get(size, [])
+                          if old_filepath in old_remaining]
+            old_filepath = comparison.find_same_contents(candidates, filepath)
+        if old_filepath is not None:
+            _metachange[filepath] = old_filepath
+            old_remaining.remove(old_filepath)
+        else:
+            _added.append(filepath)
+
+    _deleted = [old_filepath for old_filepath in old_filepaths if old_filepath in old_remaining]
+
+    total_bytes = sum(comparison.sizes.values())
+    logger.info('Read %d of %d bytes (%.1f%%) to compare the files', comparison.bytes_read, total_bytes,
+                100.0 * comparison.bytes_read / total_bytes if total_bytes else 0.0)
+
+    change_id, change_dir = save_changes(old_datapath, new_datapath, stagingdir, _unchanged, _added,
+                                         _deleted, _modified, _metachange)
+    # changes within files are only measured from indexes
+    for filename in ['MODIFIED_RANGES', 'MODIFIED_FRACTION', 'SHARED_CHUNKS']:
+        if os.path.exists(os.path.join(change_dir, filename)):
+            os.remove(os.path.join(change_dir, filename))
+
+    logger.info('Directory comparison complete')
+
+    return change_id
+
+'''
+Classifies the files of two compact indexes, as described for `compare`. The files
+with the same path are matched, and their hashes compared, with vectorized
+operations on the whole indexes; only the other files, and the changed ones,
+are looked at one by one. Returns the unchanged files as a generator, so that
+their paths are only built when they are saved
+'''
+def compare_indexes(old_index, new_index, algorithm, old_metadata, new_metadata):
+    _metachange = {}
+    _added = []
+    _modified = {}
+
+    # hash of a zero-byte file
+    empty_digest = new_index.digest(hashing.empty_hash(algorithm))
+
+    old_remaining = np.ones(len(old_index), dtype=bool)
+    old_keys = old_index.path_keys()
+    new_keys = new_index.path_keys()
+    path_order = np.argsort(old_keys, kind='stable')
+    sorted_keys = old_keys[path_order]
+    positions = np.searchsorted(sorted_keys, new_keys)
+    same_path = np.zeros(len(new_index), dtype=bool)
+    if len(old_index):
+        found = positions < len(old_index)
+        same_path[found] = sorted_keys[positions[found]] == new_keys[found]
+    del old_keys, new_keys, sorted_keys
+
+    '''
+    if filepaths are same, but data or metadata changed
+    '''
+    new_common = np.flatnonzero(same_path)
+    old_common = path_order[positions[new_common]]
+    del path_order, positions
+    old_remaining[old_common] = False
+    same_hash = old_index.digests[old_common] == new_index.digests[new_common]
+    for i in new_common[~same_hash]:
+        filepath = new_index.path(i)
+        _modified[filepath] = filepath
+    unchanged = new_common[same_hash]
+    if old_metadata and new_metadata:
+        metachange = np.zeros(len(unchanged), dtype=bool)
+        for k, i in enumerate(unchanged):
+            filepath = new_index.path(i)
+            if filepath in old_metadata and filepath in new_metadata and \
+               old_metadata[filepath] != new_metadata[filepath]:
+                _metachange[filepath] = filepath
+                metachange[k] = True
+        unchanged = unchanged[~metachange]
+
+    new_rest = np.flatnonzero(~same_path)
+    if len(new_rest):
+        # the old files are sorted by name key and by hash to look up the other new files
+        name_order = np.argsort(old_index.name_keys, kind='stable')
+        sorted_names = old_index.name_keys[name_order]
+        rest_names = new_index.name_keys[new_rest]
+        name_ranges = zip(np.searchsorted(sorted_names, rest_names, 'left'),
+                          np.searchsorted(sorted_names, rest_names, 'right'))
+        hash_order = np.argsort(old_index.digests, kind='stable')
+        sorted_digests = old_index.digests[hash_order]
+        rest_digests = new_index.digests[new_rest]
+        hash_ranges = zip(np.searchsorted(sorted_digests, rest_digests, 'left'),
+                          np.searchsorted(sorted_digests, rest_digests, 'right'))
+
+        for i, (name_start, name_end), (hash_start, hash_end) in zip(new_rest, name_ranges, hash_ranges):
+            filepath = new_index.path(i)
+            name = new_index.name(i)
+            digest = new_index.digests[i]
+            old_files = [j for j in name_order[name_start:name_end]
+                         if old_remaining[j] and old_index.name(j) == name]
+            if old_files:
+                '''
+                if filenames are same, but filepaths and data changed
+                '''
+                for j in old_files:
+                    if old_index.digests[j] == digest:
+                        _metachange[filepath] = old_index.path(j)
+                        break
+                else:
+                    j = old_files[0]
+                    _modified[filepath] = old_index.path(j)
+                old_remaining[j] = False
+                continue
+
+            old_files = []
+            if digest != empty_digest:
+                old_files = [j for j in hash_order[hash_start:hash_end] if old_remaining[j]]
+            if old_files:
+                '''
+                if data remains same, but filepath changes
+                '''
+                _metachange[filepath] = old_index.path(old_files[0])
+                old_remaining[old_files[0]] = False
+            else:
+                _added.append(filepath)
+
+    _deleted = [old_index.path(j) for j in np.flatnonzero(old_remaining)]
+    _unchanged = (new_index.path(i) for i in unchanged)
+
+    return _unchanged, _added, _deleted, _modified, _metachange
+
+'''
+Function to compare data and find changes
+Algo:
+- load OLD_INDEX and NEW_INDEX (indexing a missing data path with the hashing
+  options of the other one) as compact arrays of path keys, name keys and digests
+- for filepaths of NEW_INDEX that are also in OLD_INDEX (matched by sorting
+  and searching the path keys of OLD_INDEX):
+   -- if datahashes match, then add to unchanged (or to metachange if the
+      metadata details of both scans differ)
+   -- else, add to modified
+   -- remove from OLD_INDEX
+- for the other filepaths of NEW_INDEX:
+   -- if filename is found in OLD_INDEX (among its remaining files):
+     --- if datahashes match with one of them, then add to metachange
+     --- else, select the first one, and mark it modified
+     --- remove it from OLD_INDEX
+   -- else if datahash (of a non-empty file) matches a remaining file of
+      OLD_INDEX, then add to metachange, and remove it from OLD_INDEX
+   -- else, add to added
+- for all remaining filepaths in OLD_INDEX:
+   -- add to deleted
+- save the changes, with the changed byte ranges and chunks of the modified
+  files when both indexes have them
+With `staged`, the files are classified in the same way from their sizes and
+partial hashes, without indexing the data paths (see `staged_compare`)
+'''
+def compare(old_datapath, new_datapath, custom_stagingdir, staged=False):
+    logger = logging.getLogger(__name__)
+
+    logger.info('Starting directory comparison')
+    if not custom_stagingdir:        
+        #old_stagingdir = os.path.join(old_datapath, '.deduce')
+        stagingdir = dacman_utils.DACMAN_STAGING_LOC
+    else:
+        stagingdir = custom_stagingdir
+
+    old_indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(old_datapath))
+    new_indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(new_datapath))
+
+    if staged:
+        return staged_compare(old_datapath, new_datapath, stagingdir)
+
+    old_index_file = os.path.join(old_indexdir, indexstore.INDEX_DB)
+    new_index_file = os.path.join(new_indexdir, indexstore.INDEX_DB)
+    
+    # a missing index is created with the hashing options of the other one
+    if not os.path.exists(old_index_file):
+        header = {'algorithm': hashing.DEFAULT_ALGORITHM, 'chunk_size': 0}
+        if os.path.exists(new_index_file):
+            header = indexer.read_index_header(new_index_file)
+        indexer.index(old_datapath, stagingdir, hash_options=get_hash_options(header))
+    if not os.path.exists(new_index_file):
+        header = indexer.read_index_header(old_index_file)
+        indexer.index(new_datapath, stagingdir, hash_options=get_hash_options(header))
+
+    header = indexer.read_index_header(old_index_file)
+    new_header = indexer.read_index_header(new_index_file)
+    if header != new_header:
+        '''
+        hashes of different algorithms or chunk sizes cannot be compared:
+        the available dataset is indexed again with the options of the other one
+        '''
+        if os.path.isdir(new_datapath):
+            logger.warning('Indexes use different hashing options (%s, %s): re-indexing %s',
+                           header, new_header, new_datapath)
+            indexer.index(new_datapath, stagingdir, hash_options=get_hash_options(header))
+        elif os.path.isdir(old_datapath):
+            logger.warning('Indexes use different hashing options (%s, %s): re-indexing %s',
+                           header, new_header, old_datapath)
+            indexer.index(old_datapath, stagingdir, hash_options=get_hash_options(new_header))
+            header = new_header
+        else:
+            logger.error('Cannot compare indexes that use different hashing options (%s, %s)',
+                         header, new_header)
+            sys.exit()
+    algorithm = header['algorithm']
+    chunk_size = header['chunk_size']
+
+    old_paths_file = os.path.join(old_indexdir, 'FILEPATHS')
+    new_paths_file = os.path.join(new_indexdir, 'FILEPATHS')
+    old_stats_file = os.path.join(old_indexdir, 'FILESTATS.npz')
+    new_stats_file = os.path.join(new_indexdir, 'FILESTATS.npz')
+
+    #cprint(__modulename__, 'Loading Indexes')
+    logger.info('Loading indexes for fast comparison')
+    # both indexes share their directories, so that the same paths have the same keys
+    directories = Directories()
+    old_index = CompactIndex.load(old_index_file, directories)
+    new_index = CompactIndex.load(new_index_file, directories)
+
+    old_metadata = scanner.FileStats.load(old_stats_file, old_paths_file)
+    new_metadata = scanner.FileStats.load(new_stats_file, new_paths_file)
+
+    #cprint(__modulename__, 'Comparing {} and {}'.format(old_datapath, new_datapath))
+    logger.info('Comparing files in %s and %s', old_datapath, new_datapath)
+    _unchanged, _added, _deleted, _modified, _metachange = compare_indexes(old_index, new_index, algorithm,
+                                                                          old_metadata, new_metadata)
+
+    change_id, change_dir = save_changes(old_datapath, new_datapath, stagingdir, _unchanged, _added,
+                                         _deleted, _modified, _metachange)
+    _mrfile = os.path.join(change_dir, 'MODIFIED_RANGES')
+    _mffile = os.path.join(change_dir, 'MODIFIED_FRACTION')
+    _scfile = os.path.join(change_dir, 'SHARED_CHUNKS')
+    if chunk_size:
+        _modified_ranges = get_modified_ranges(_modified, old_indexdir, new_indexdir, new_index_file,
+                                               chunk_size)
+        dacman_utils.dict_to_file(_modified_ranges, _mrfile)
+    elif os.path.exists(_mrfile):
+        os.remove(_mrfile)
+    _modified_fractions, _shared_chunks = get_chunk_changes(_modified, _added, old_indexdir, new_indexdir)
+    if _modified_fractions or _shared_chunks:
+        dacman_utils.dict_to_file(_modified_fractions, _mffile)
+        dacman_utils.dict_to_file(_shared_chunks, _scfile)
+    else:
+        for _file in [_mffile, _scfile]:
+            if os.path.exists(_file):
+                os.remove(_file)
+
     logger.info('Directory comparison complete')
 
     return change_id
@@ -0,0 +1,129 @@
+"""
+`dacman.core.hashcache`
+====================================
+
+.. currentmodule:: dacman.core.hashcache
+
+:platform: Unix, Mac
+:synopsis: Module for caching the hashes of files across the data paths indexed in a staging directory
+
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from dacman.core.indexstore import _to_signed
+
+import logging
+
+__modulename__ = 'hashcache'
+
+logger = logging.getLogger(__name__)
+
+# name of the hash cache in the staging directory
+HASH_CACHE_DB = 'HASHCACHE.db'
+# the least recently indexed files are evicted beyond this number of cached hashes
+MAX_CACHE_ENTRIES = 10000000
+# seconds a process waits for another one writing to the cache
+BUSY_TIMEOUT = 60
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,
+                                   algorithm TEXT, hash TEXT NOT NULL, used INTEGER NOT NULL,
+                                   PRIMARY KEY (device, inode, size, mtime_ns, algorithm)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hashes_used ON hashes (used);
+'''
+
+
+class HashCache(object):
+    '''
+    Hashes of the files indexed from a staging directory, keyed by the device,
+    inode, size and modification time of each file rather than by its path, so
+    that the files shared by several data paths, e.g. hard-linked snapshots of
+    a directory, are only hashed once. The cache is a SQLite database with a
+    rollback journal, which unlike WAL mode needs no shared memory between the
+    processes, and thus works on network and parallel filesystems (e.g. NFS
+    or Lustre) that support file locks; the indexing processes wait for each
+    other's writes for up to `BUSY_TIMEOUT` seconds.
+    '''
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.conn = sqlite3.connect(cache_file, timeout=BUSY_TIMEOUT)
+        # caches created in WAL mode are converted
+        self.conn.execute('PRAGMA journal_mode = DELETE')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def get(self, stats, algorithm):
+        '''
+        Returns the hash of the file with the (size, mtime_ns, inode, device) `stats`, or `None`.
+        '''
+        row = self.conn.execute('SELECT hash FROM hashes WHERE device = ? AND inode = ? AND size = ? '
+                                'AND mtime_ns = ? AND algorithm = ?',
+                                (_to_signed(stats[3]), _to_signed(stats[2]), stats[0], stats[1],
+                                 algorithm)).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, entries, algorithm):
+        '''
+        Inserts (hash, stats) entries in a single transaction, marking them as used now.
+        '''
+        used = int(time.time())
+        rows = ((_to_signed(stats[3]), _to_signed(stats[2]), stats[0], stats[1], algorithm, file_hash, used)
+                for file_hash, stats in entries)
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def evict(self, max_entries=MAX_CACHE_ENTRIES):
+        '''
+        Removes the hashes of the least recently indexed files beyond `max_entries`.
+        '''
+        excess = len(self) - max_entries
+        if excess <= 0:
+            return 0
+        with self.conn:
+            self.conn.execute('DELETE FROM hashes WHERE (device, inode, size, mtime_ns, algorithm) IN '
+                              '(SELECT device, inode, size, mtime_ns, algorithm FROM hashes '
+                              'ORDER BY used LIMIT ?)', (excess,))
+        logger.info('Evicted %d hashes from the hash cache', excess)
+        return excess
+
+
+'''
+per-thread connections to the caches looked up by the workers, which are
+opened again in a forked worker process
+'''
+_local = threading.local()
+
+
+def lookup(cache_file, stats, algorithm):
+    '''
+    Returns the cached hash of a file, or `None` if it is not cached or the cache cannot be read.
+    '''
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.caches = {}
+    cache = _local.caches.get(cache_file, False)
+    try:
+        if cache is False:
+            cache = _local.caches[cache_file] = HashCache(cache_file)
+        return cache.get(stats, algorithm) if cache is not None else None
+    except sqlite3.Error as e:
+        # the cache is not looked up again by this thread
+        logger.warning('Could not read the hash cache %s: %s', cache_file, e)
+        _local.caches[cache_file] = None
+        return None
@@ -0,0 +1,293 @@
+"""
+`dacman.core.hashing`
+====================================
+
+.. currentmodule:: dacman.core.hashing
+
+:platform: Unix, Mac
+:synopsis: Module for calculating file hashes with large, overlapped reads
+
+"""
+
+import os
+import time
+import mmap
+import hashlib
+import functools
+import threading
+import multiprocessing.util
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+    XXHASH_IMPORT = True
+except ImportError:
+    XXHASH_IMPORT = False
+
+import logging
+
+__modulename__ = 'hashing'
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_ALGORITHM = 'md5'
+
+'''
+hash algorithms that can be used for indexing, by name;
+the xxhash algorithms are only available if the `xxhash` package is installed
+'''
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+    'blake2b': hashlib.blake2b,
+    'blake2b-128': functools.partial(hashlib.blake2b, digest_size=16),
+    'blake2s': hashlib.blake2s,
+}
+if XXHASH_IMPORT:
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+    ALGORITHMS['xxh128'] = xxhash.xxh3_128
+
+
+def new_hash(algorithm=DEFAULT_ALGORITHM):
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Hash algorithm {} is not available'.format(algorithm))
+    return ALGORITHMS[algorithm]()
+
+
+'''
+hash of a zero-byte file, which is shared by all empty files
+'''
+def empty_hash(algorithm=DEFAULT_ALGORITHM):
+    return new_hash(algorithm).hexdigest()
+
+
+class HashOptions(object):
+    '''
+    Options of the hashing engine, passed along with each file to the workers.
+    Read-ahead overlaps the read of the next block with the digest of the current one;
+    memory-mapping avoids copying data from the page cache, and suits local files.
+    With a `chunk_size`, files larger than a chunk get a tree hash of their chunks.
+    With a `cdc_size`, the hashes of content-defined chunks of that average size
+    are also recorded for each file. With a `hash_cache`, the hashes of files
+    found in that shared hash cache are reused without reading the files.
+    With `use_xattrs`, the hash of each file is also stored in its extended
+    attributes, and reused while its size and modification time are unchanged.
+    '''
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, readahead=True, use_mmap=False,
+                 algorithm=DEFAULT_ALGORITHM, chunk_size=0, cdc_size=0, hash_cache=None, use_xattrs=False):
+        self.block_size = block_size
+        self.readahead = readahead
+        self.use_mmap = use_mmap
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.cdc_size = cdc_size
+        self.hash_cache = hash_cache
+        self.use_xattrs = use_xattrs
+
+    def __repr__(self):
+        return ('HashOptions(block_size={}, readahead={}, use_mmap={}, algorithm={}, chunk_size={}, '
+                'cdc_size={}, hash_cache={}, use_xattrs={})').format(self.block_size, self.readahead,
+                                                                     self.use_mmap, self.algorithm,
+                                                                     self.chunk_size, self.cdc_size,
+                                                                     self.hash_cache, self.use_xattrs)
+
+
+'''
+per-thread state: the read buffers and the read-ahead thread are reused
+across files, and the number of bytes hashed in the process is accumulated
+for reporting
+'''
+_local = threading.local()
+_throughput = {'bytes': 0, 'seconds': 0.0, 'files': 0}
+_throughput_lock = threading.Lock()
+
+
+def _get_buffers(block_size, nbuffers=1):
+    if not hasattr(_local, 'buffers'):
+        _local.buffers = {}
+    buffers = _local.buffers.setdefault(block_size, [])
+    # the second buffer is only allocated by the threads that read ahead
+    while len(buffers) < nbuffers:
+        buffers.append(memoryview(bytearray(block_size)))
+    return buffers
+
+
+def _get_reader():
+    # threads do not survive a fork, so each worker process starts its own
+    if getattr(_local, 'reader_pid', None) != os.getpid():
+        _local.reader = ThreadPoolExecutor(max_workers=1)
+        _local.reader_pid = os.getpid()
+    return _local.reader
+
+
+def _add_throughput(nbytes, seconds, nfiles):
+    with _throughput_lock:
+        _throughput['bytes'] += nbytes
+        _throughput['seconds'] += seconds
+        _throughput['files'] += nfiles
+
+
+def _update_read(f, checksum, block_size):
+    buf = _get_buffers(block_size)[0]
+    while True:
+        nbytes = f.readinto(buf)
+        if not nbytes:
+            break
+        checksum.update(buf[:nbytes])
+
+
+def _update_readahead(f, checksum, block_size):
+    buffers = _get_buffers(block_size, 2)
+    reader = _get_reader()
+    current = 0
+    pending = reader.submit(f.readinto, buffers[current])
+    while True:
+        nbytes = pending.result()
+        if not nbytes:
+            break
+        # the next block is read while the current one is digested
+        pending = reader.submit(f.readinto, buffers[1 - current])
+        checksum.update(buffers[current][:nbytes])
+        current = 1 - current
+
+
+def _update_mmap(f, checksum, block_size, file_size):
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, file_size, block_size):
+                checksum.update(view[offset:offset + block_size])
+        finally:
+            view.release()
+
+
+class _Tee(object):
+    '''
+    Feeds the data hashed for a file to a chunker as well.
+    '''
+    def __init__(self, checksum, chunker):
+        self.checksum = checksum
+        self.chunker = chunker
+
+    def update(self, data):
+        self.checksum.update(data)
+        self.chunker.update(data)
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+
+def hash_file(f, file_size, options=None, checksum=None, chunker=None):
+    '''
+    Updates `checksum` (a new hash of the algorithm in `options` by default)
+    with the contents of the open binary file `f` and returns its hex digest.
+    The contents are also fed to `chunker` in the same pass, if given.
+    '''
+    if options is None:
+        options = HashOptions()
+    if checksum is None:
+        checksum = new_hash(options.algorithm)
+    if chunker is not None:
+        checksum = _Tee(checksum, chunker)
+    block_size = options.block_size
+
+    start = time.time()
+    if options.use_mmap and file_size > 0:
+        _update_mmap(f, checksum, block_size, file_size)
+    elif options.readahead and file_size > 2 * block_size:
+        _update_readahead(f, checksum, block_size)
+    else:
+        _update_read(f, checksum, block_size)
+
+    _add_throughput(file_size, time.time() - start, 1)
+    return checksum.hexdigest()
+
+
+def hash_range(f, offset, length, options=None, checksum=None):
+    '''
+    Updates `checksum` (a new hash of the algorithm in `options` by default) with
+    `length` bytes of the open binary file `f` from `offset`, and returns its hex digest.
+    '''
+    if options is None:
+        options = HashOptions()
+    if checksum is None:
+        checksum = new_hash(options.algorithm)
+    buf = _get_buffers(options.block_size)[0]
+
+    start = time.time()
+    f.seek(offset)
+    remaining = length
+    while remaining > 0:
+        nbytes = f.readinto(buf[:min(remaining, options.block_size)])
+        if not nbytes:
+            break
+        checksum.update(buf[:nbytes])
+        remaining -= nbytes
+
+    _add_throughput(length - remaining, time.time() - start, 0)
+    return checksum.hexdigest()
+
+
+def hash_ends(f, file_size, length, options=None):
+    '''
+    Returns the hex digest of the first and last `length` bytes of the open binary
+    file `f`, which is the digest of the whole file if it is not larger than both.
+    '''
+    if file_size <= 2 * length:
+        return hash_file(f, file_size, options)
+    if options is None:
+        options = HashOptions()
+    checksum = new_hash(options.algorithm)
+    hash_range(f, 0, length, options, checksum)
+    return hash_range(f, file_size - length, length, options, checksum)
+
+
+def tree_hash(chunk_hashes, algorithm=DEFAULT_ALGORITHM):
+    '''
+    Combines the hex digests of the consecutive chunks of a file into the file hash,
+    as the root of a two-level (Merkle-style) hash tree.
+    '''
+    root = new_hash(algorithm)
+    for chunk_hash in chunk_hashes:
+        root.update(bytes.fromhex(chunk_hash))
+    return root.hexdigest()
+
+
+def changed_ranges(old_chunk_hashes, new_chunk_hashes, chunk_size, new_size):
+    '''
+    Returns the (start, end) byte ranges of a file whose chunks differ from the
+    chunks of its previous version, merging adjacent chunks. A file truncated
+    by whole chunks has an empty range at its new end.
+    '''
+    ranges = []
+    nchunks = max(len(old_chunk_hashes), len(new_chunk_hashes))
+    for i in range(nchunks):
+        old_hash = old_chunk_hashes[i] if i < len(old_chunk_hashes) else None
+        new_hash = new_chunk_hashes[i] if i < len(new_chunk_hashes) else None
+        if old_hash == new_hash:
+            continue
+        start = min(i * chunk_size, new_size)
+        end = min((i + 1) * chunk_size, new_size)
+        if ranges and ranges[-1][1] >= start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def log_throughput():
+    seconds = _throughput['seconds']
+    mbytes = _throughput['bytes'] / float(1 << 20)
+    logger.info('Worker %d hashed %d files, %.1f MB in %.2f seconds (%.1f MB/s)',
+                os.getpid(), _throughput['files'], mbytes, seconds,
+                mbytes / seconds if seconds > 0 else 0.0)
+
+
+'''
+initializer of the pool workers, so that each worker reports its throughput when it exits
+'''
+def init_worker():
+    multiprocessing.util.Finalize(None, log_throughput, exitpriority=10)
@@ -14,10 +14,13 @@
 import yaml
 import sys
 import os
-import hashlib
+import sqlite3
 import time
+import errno
 
+import asyncio
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 try:
     import tigres
     TIGRES_IMPORT = True
@@ -25,6 +28,12 @@ except ImportError:
     TIGRES_IMPORT = False
 
 import dacman.core.scanner as scanner
+import dacman.core.hashing as hashing
+import dacman.core.chunking as chunking
+import dacman.core.indexstore as indexstore
+import dacman.core.journal as journal
+import dacman.core.hashcache as hashcache
+import dacman.core.xattrs as xattrs
 from dacman.core.utils import cprint, dict_to_file, get_hash_id
 import dacman.core.utils as dacman_utils
 
@@ -34,15 +43,296 @@ __modulename__ = 'indexer'
 
 logger = logging.getLogger(__name__)
 
-def calculate_hash(datapath, filename):
+# first line of a content-defined chunk index
+CDC_HEADER = '#dacman-cdc algorithm={} avg_size={}\n'
+
+# bounds of the size-balanced batches of files sent to the workers
+MIN_BATCH_BYTES = 1 << 20
+MAX_BATCH_BYTES = 256 << 20
+MAX_BATCH_FILES = 1000
+# number of index entries inserted in the index database at once
+WRITE_BATCH_FILES = 10000
+# number of threads used to stat the files before scheduling them
+STAT_THREADS = 32
+# number of times a file is hashed again after a transient error, waiting
+# RETRY_DELAY seconds more before each attempt
+HASH_RETRIES = 2
+RETRY_DELAY = 1.0
+# errors that may not happen again, e.g. on network filesystems
+TRANSIENT_ERRORS = {errno.EIO, errno.ESTALE, errno.EAGAIN, errno.EINTR, errno.EBUSY, errno.ETIMEDOUT}
+# files that could not be read, listed in the index directory of a data path
+ERRORS_FILE = 'ERRORS'
+# files whose hashes were imported from a manifest and not calculated since
+UNVERIFIED_FILE = 'UNVERIFIED'
+# default number of threads hashing files with the thread-pool manager
+DEFAULT_HASH_THREADS = 8
+# default number of files read at once with the asyncio manager, each with a read buffer of the block size
+DEFAULT_CONCURRENCY = 64
+
+def get_file_stats(file_stats):
+    return (file_stats.st_size, file_stats.st_mtime_ns, file_stats.st_ino, file_stats.st_dev)
+
+
+def stat_file(filepath):
+    return get_file_stats(os.stat(filepath))
+
+
+def calculate_hash(datapath, filename, prev_index=None, hash_options=None):
+    '''
+    Returns the hash of a file and the (size, mtime_ns, inode, device) of the file
+    it was calculated for, followed by the (length, hash) of its content-defined
+    chunks if they are enabled in `hash_options`. If the file still has the stat
+    information of its previous index entry `prev_index`, the previous hash
+    is reused without reading the file, as are the hash of the file in the
+    hash cache of `hash_options`, if any, and the hash stored in the extended
+    attributes of the file with `use_xattrs`, if it has the same size and
+    modification time. With `use_xattrs`, the hashes calculated are stored
+    in the extended attributes of the files.
+    '''
     file_path = os.path.join(datapath, filename)
-    checksum = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        for block in iter(lambda: f.read(4096), b""):
-            checksum.update(block)
+    file_stats = None
+    if prev_index is not None:
+        file_stats = get_file_stats(os.stat(file_path))
+        if file_stats == prev_index[1]:
+            return (filename, prev_index[0], file_stats) + tuple(prev_index[2:])
+    # the content-defined chunks of a file are not cached
+    if hash_options is not None and hash_options.hash_cache and not hash_options.cdc_size:
+        if file_stats is None:
+            file_stats = get_file_stats(os.stat(file_path))
+        file_hash = hashcache.lookup(hash_options.hash_cache, file_stats, hash_options.algorithm)
+        if file_hash is not None:
+            return (filename, file_hash, file_stats)
+    if hash_options is not None and hash_options.use_xattrs and not hash_options.cdc_size:
+        if file_stats is None:
+            file_stats = get_file_stats(os.stat(file_path))
+        file_hash = xattrs.read_hash(file_path, hash_options.algorithm, file_stats)
+        if file_hash is not None:
+            return (filename, file_hash, file_stats)
+
+    chunker = None
+    if hash_options is not None and hash_options.cdc_size:
+        chunker = chunking.ContentChunker(hash_options.cdc_size, hash_options.algorithm)
+    with open(file_path, 'rb', buffering=0) as f:
+        file_stats = get_file_stats(os.fstat(f.fileno()))
+        file_hash = hashing.hash_file(f, file_stats[0], hash_options, chunker=chunker)
+        if hash_options is not None and hash_options.use_xattrs:
+            xattrs.write_hash(f.fileno(), hash_options.algorithm, file_hash, file_stats)
+
+    if chunker is not None:
+        return (filename, file_hash, file_stats, chunker.finish())
+    return (filename, file_hash, file_stats)
+
+
+class FileError(object):
+    '''
+    Error that prevented a file from being hashed, returned in place of its index entry.
+    '''
+    def __init__(self, filename, error):
+        self.filename = filename
+        self.error = error
+
+    def __str__(self):
+        error_name = errno.errorcode.get(self.error.errno)
+        if error_name:
+            return '{}: {} ({})'.format(self.filename, self.error.strerror, error_name)
+        return '{}: {}'.format(self.filename, self.error)
+
+
+def _retry(hash_fn, filename, *args):
+    '''
+    Calls `hash_fn`, retrying it after transient errors. Returns its result,
+    or a `FileError` if the file could not be read.
+    '''
+    for attempt in range(HASH_RETRIES + 1):
+        try:
+            return hash_fn(*args)
+        except OSError as e:
+            if e.errno not in TRANSIENT_ERRORS or attempt == HASH_RETRIES:
+                return FileError(filename, e)
+            logger.warning('Could not read %s (%s), retrying', filename, e)
+            time.sleep(RETRY_DELAY * (attempt + 1))
+
+
+def try_calculate_hash(datapath, filename, prev_index=None, hash_options=None):
+    '''
+    Returns the result of `calculate_hash`, or a `FileError` if the file could not be read.
+    '''
+    return _retry(calculate_hash, filename, datapath, filename, prev_index, hash_options)
+
+
+def _calculate_hash(args):
+    return try_calculate_hash(*args)
+
+
+def calculate_chunk_hash(datapath, filename, offset, hash_options):
+    '''
+    Returns the hash of the chunk of a file that starts at `offset`.
+    '''
+    with open(os.path.join(datapath, filename), 'rb', buffering=0) as f:
+        return (filename, offset, hashing.hash_range(f, offset, hash_options.chunk_size, hash_options))
+
+
+def _calculate_hashes(args):
+    '''
+    Hashes a batch of files and file chunks; a chunk is given as a (filename, offset) pair.
+    A `FileError` is returned in place of the result of a file or chunk that could not be read.
+    '''
+    datapath, items, hash_options = args
+    results = []
+    chunk_results = []
+    for item in items:
+        if isinstance(item, tuple):
+            chunk_results.append(_retry(calculate_chunk_hash, item[0], datapath, item[0], item[1], hash_options))
+        else:
+            results.append(try_calculate_hash(datapath, item, None, hash_options))
+    return results, chunk_results
+
+
+def _results(futures):
+    '''
+    Yields the results of a list of futures in order, removing each future from
+    the list once its result is taken, as `Executor.map` does, so that the
+    futures left in the list can be cancelled after an error.
+    '''
+    futures.reverse()
+    while futures:
+        yield futures.pop().result()
+
+
+def make_batches(files, num_workers):
+    '''
+    Groups (filename, size) pairs into batches of similar total size, to be hashed
+    by the workers in order. Files larger than a batch make a batch of their own,
+    while small files are grouped, which saves pickling and IPC for each file.
+    Batches are returned largest first (longest-processing-time scheduling),
+    so that a large file does not start last and leave the other workers idle.
+    '''
+    files = sorted(files, key=lambda f: f[1], reverse=True)
+    total_bytes = sum(size for filename, size in files)
+    # several batches per worker keep the load balanced until the end
+    nbatches = num_workers * 16
+    batch_bytes = min(max(total_bytes // nbatches, MIN_BATCH_BYTES), MAX_BATCH_BYTES)
+    batch_files = min(max(len(files) // nbatches, 1), MAX_BATCH_FILES)
+
+    batches = []
+    batch = []
+    size_sum = 0
+    for filename, size in files:
+        if size >= batch_bytes:
+            batches.append((size, [filename]))
+            continue
+        batch.append(filename)
+        size_sum += size
+        if size_sum >= batch_bytes or len(batch) >= batch_files:
+            batches.append((size_sum, batch))
+            batch = []
+            size_sum = 0
+    if batch:
+        batches.append((size_sum, batch))
+
+    batches.sort(key=lambda b: b[0], reverse=True)
+    return [batch for size_sum, batch in batches]
+
+
+def read_path_index(index_file, with_stats=False):
+    '''
+    Reads the index of a data path as a map of file path to hash, or
+    to (hash, stats) if `with_stats` is set. Entries saved without the
+    stat information of the file have `None` stats.
+    '''
+    with indexstore.IndexStore(index_file) as store:
+        if with_stats:
+            return {filepath: (file_hash, file_stats) for filepath, file_hash, file_stats in store.items()}
+        return {filepath: file_hash for filepath, file_hash, file_stats in store.items()}
+
+
+def read_index_header(index_file):
+    '''
+    Returns the options recorded with the index of a data path, as a map with
+    the hash `algorithm` and the `chunk_size` of tree hashes (0 for flat hashes).
+    '''
+    with indexstore.IndexStore(index_file) as store:
+        options = store.options()
+    return {'algorithm': options['algorithm'], 'chunk_size': int(options['chunk_size'])}
+
+
+def read_index_algorithm(index_file):
+    '''
+    Returns the hash algorithm recorded with the index of a data path.
+    '''
+    return read_index_header(index_file)['algorithm']
+
 
-    file_hash = checksum.hexdigest()
-    return (filename, file_hash)
+def read_chunk_index(chunk_index_file):
+    '''
+    Reads the chunk hashes of the files that have a tree hash, as a map of
+    file path to the list of hashes of its consecutive chunks.
+    '''
+    chunk_indexes = {}
+    if not os.path.exists(chunk_index_file):
+        return chunk_indexes
+    with open(chunk_index_file) as f:
+        for line in f:
+            filepath, value = line.rstrip('\n').rsplit(': ', 1)
+            chunk_indexes[filepath] = value.split()
+    return chunk_indexes
+
+
+def read_cdc_index(cdc_index_file):
+    '''
+    Reads the content-defined chunks of the files of a data path, as the options
+    recorded in the header of the index and a map of file path to the list of
+    (length, hash) of its consecutive chunks.
+    '''
+    header = {}
+    cdc_indexes = {}
+    if not os.path.exists(cdc_index_file):
+        return header, cdc_indexes
+    with open(cdc_index_file) as f:
+        for line in f:
+            if line.startswith('#dacman-cdc '):
+                header = dict(field.split('=', 1) for field in line.split()[1:])
+                header['avg_size'] = int(header['avg_size'])
+                continue
+            filepath, value = line.rstrip('\n').rsplit(': ', 1)
+            fields = value.split()
+            cdc_indexes[filepath] = [(int(length), chunk_hash)
+                                     for length, chunk_hash in zip(fields[::2], fields[1::2])]
+    return header, cdc_indexes
+
+
+def read_prev_indexes(indexdir, verify, hash_options):
+    path_index_file = os.path.join(indexdir, indexstore.INDEX_DB)
+    if verify or not os.path.exists(path_index_file):
+        return {}
+    header = read_index_header(path_index_file)
+    if (header['algorithm'], header['chunk_size']) != (hash_options.algorithm, hash_options.chunk_size):
+        logger.info('Previous index used different hashing options, rehashing all files')
+        return {}
+    prev_indexes = read_path_index(path_index_file, with_stats=True)
+    logger.info('Reusing hashes of files unchanged since the previous index')
+    prev_indexes = {filepath: prev_index for filepath, prev_index in prev_indexes.items()
+                    if prev_index[1] is not None}
+    if hash_options.cdc_size:
+        # hashes are only reused along with the content-defined chunks of the file
+        cdc_header, cdc_indexes = read_cdc_index(os.path.join(indexdir, 'CDC.idx'))
+        if cdc_header != {'algorithm': hash_options.algorithm, 'avg_size': hash_options.cdc_size}:
+            cdc_indexes = {}
+        prev_indexes = {filepath: prev_index + (cdc_indexes[filepath],)
+                        for filepath, prev_index in prev_indexes.items() if filepath in cdc_indexes}
+    return prev_indexes
+
+
+def add_journal_indexes(indexdir, hash_options, prev_indexes, prev_chunk_indexes=None):
+    '''
+    Adds the entries journaled by an interrupted indexing of the data path to
+    the previous index entries, so that the files it hashed are not hashed again.
+    '''
+    options = journal.journal_options(hash_options.algorithm, hash_options.chunk_size, hash_options.cdc_size)
+    journal_indexes, journal_chunk_indexes = journal.read_journals(indexdir, options)
+    prev_indexes.update(journal_indexes)
+    if prev_chunk_indexes is not None:
+        prev_chunk_indexes.update(journal_chunk_indexes)
 
 
 def read_filelist(metafile):
@@ -78,18 +368,61 @@ def check_stagingdir(custom_stagingdir, datapath):
 '''
 main function to call different managers for parallel indexing
 '''
-def index(datapath, custom_stagingdir=None, manager='python'):
+def index(datapath, custom_stagingdir=None, manager='python', pipeline=False, verify=False,
+          hash_options=None, nthreads=DEFAULT_HASH_THREADS, concurrency=DEFAULT_CONCURRENCY, resume=False,
+          continue_on_error=False, hash_cache=False, scan_options=None):
     logger.info('Indexing %s', datapath)
+    if hash_options is None:
+        hash_options = hashing.HashOptions()
+    logger.info('Using %s hashes', hash_options.algorithm)
     stagingdir = check_stagingdir(custom_stagingdir, datapath)
+    # files are hashed again when verifying
+    hash_options.hash_cache = None
+    if hash_cache and not verify:
+        hash_options.hash_cache = os.path.join(stagingdir, hashcache.HASH_CACHE_DB)
+    if hash_options.use_xattrs and not xattrs.AVAILABLE:
+        logger.warning('Extended attributes are not available on this platform, not storing hashes in files')
+        hash_options.use_xattrs = False
+    elif hash_options.use_xattrs and verify:
+        hash_options.use_xattrs = False
+    elif hash_options.use_xattrs:
+        logger.info('Storing the hashes of files in their extended attributes')
+    if pipeline and manager != 'python':
+        logger.warning('Pipelined indexing is only available with the Python multiprocessing manager')
+    if scan_options and not (pipeline and manager == 'python'):
+        logger.warning('Scan options are only used by pipelined indexing, scan the data path with them first')
+    if hash_options.chunk_size and (pipeline or manager not in ('python', 'threads')):
+        logger.warning('Chunked hashing is only available with non-pipelined Python multiprocessing '
+                       'or threads, using flat hashes')
+        hash_options.chunk_size = 0
+    elif hash_options.chunk_size and hash_options.cdc_size:
+        logger.warning('Chunked hashing cannot be combined with content-defined chunks, using flat hashes')
+        hash_options.chunk_size = 0
+    elif hash_options.chunk_size:
+        logger.info('Using tree hashes of %d-byte chunks for larger files', hash_options.chunk_size)
+    if hash_options.cdc_size:
+        logger.info('Recording content-defined chunks of %d bytes on average', hash_options.cdc_size)
     if manager == 'tigres':
         if not TIGRES_IMPORT:
             logger.error('Tigres is not installed or not in path')
             sys.exit()
         logger.info('Using Tigres for parallel indexing')
-        indexdir = tigres_index(stagingdir, datapath)
+        indexdir = tigres_index(stagingdir, datapath, hash_options, resume, continue_on_error)
+    elif manager == 'threads':
+        logger.info('Using %d threads for parallel indexing', nthreads)
+        indexdir = thread_index(stagingdir, datapath, verify, hash_options, nthreads, resume,
+                                    continue_on_error)
+    elif manager == 'asyncio':
+        logger.info('Using asyncio for concurrent indexing of up to %d files', concurrency)
+        indexdir = async_index(stagingdir, datapath, verify, hash_options, concurrency, resume,
+                                   continue_on_error)
+    elif pipeline:
+        logger.info('Using Python multiprocessing for pipelined scanning and indexing')
+        indexdir = pipeline_index(stagingdir, datapath, verify, hash_options, resume, continue_on_error,
+                                  scan_options)
     else:
         logger.info('Using Python multiprocessing for parallel indexing')
-        indexdir = mp_index(stagingdir, datapath)
+        indexdir = mp_index(stagingdir, datapath, verify, hash_options, resume, continue_on_error)
 
     index_metafile = os.path.join(os.path.dirname(indexdir), 'INDEXED_PATHS')
     index_metadata = {}
@@ -99,74 +432,487 @@ def index(datapath, custom_stagingdir=None, manager='python'):
     dacman_utils.dump_yaml(index_metadata, index_metafile)
     return indexdir
 
-def save_indexes(indexdir, indexes):
-    '''
-    There are two types of indexes created for each data path.
-    First, a hash of the data in a file to the file path.
-    Second, a file path to its hash.
-    A map of filename to all the paths is also created.
-    '''
-    logger.info('Building two-way hash indexes')
-    if not os.path.exists(indexdir):
-        os.makedirs(indexdir)
-    path_index_file = os.path.join(indexdir, 'PATH.idx')
-    data_index_file = os.path.join(indexdir, 'DATA.idx')
-    name_path_map_file = os.path.join(indexdir, 'PATHNAME.map')
-    path_indexes = dict(indexes)
-    data_indexes = {}
-    name_path_map = {}
-    for k, v in path_indexes.items():
-        data_indexes[v] = k
-        filename = os.path.basename(k)
-        if filename in name_path_map:
-            name_path_map[filename] = name_path_map[filename] + ' ' + k
+def install_index(indexdir, tmp_index_file):
+    '''
+    Renames a complete index database built aside to `INDEX.db`. The database
+    is written without syncing, so it and the rename are made durable here,
+    before the journals that could rebuild it are removed.
+    '''
+    journal.sync_path(tmp_index_file)
+    os.replace(tmp_index_file, os.path.join(indexdir, indexstore.INDEX_DB))
+    # text indexes saved by earlier versions
+    for legacy_file in ['PATH.idx', 'DATA.idx', 'PATHNAME.map']:
+        if os.path.exists(os.path.join(indexdir, legacy_file)):
+            os.remove(os.path.join(indexdir, legacy_file))
+    journal.sync_path(indexdir)
+
+
+class IndexWriter(object):
+    '''
+    Writes the indexes of a data path as the hashes of its files come in, so that
+    memory use does not grow with the number of files. Entries are inserted in the
+    index database in batches of `WRITE_BATCH_FILES`, and the hash and name
+    lookups are indexed once all files are inserted, which SQLite does by sorting
+    on disk. The chunk hashes and content-defined chunks of the files are appended
+    to their indexes as they come. All indexes are written aside and renamed
+    once complete. If `prev_indexes` are given, the entries reused from them are counted.
+    Every entry is also recorded in a journal as it comes, so that an interrupted
+    indexing can be resumed; the journals of earlier runs are removed unless
+    `keep_journals` is set, and all journals are removed once the indexes are complete.
+    A `FileError` added in place of an entry stops the indexing with its error,
+    unless `continue_on_error` is set: the file is then left out of the index
+    and listed in `ERRORS`, and is hashed again by a resumed indexing.
+    With a `hash_cache`, the flat hashes of the files are also added to that
+    shared hash cache, which is trimmed once the indexes are complete.
+    Entries added as not `verified`, e.g. imported from a manifest, are listed
+    in `UNVERIFIED` and kept out of the hash cache, as are the entries reused
+    from them, until their files are hashed.
+    '''
+    def __init__(self, indexdir, algorithm=hashing.DEFAULT_ALGORITHM, chunk_size=0, cdc_size=0,
+                 prev_indexes=None, keep_journals=False, continue_on_error=False, hash_cache=None):
+        if not os.path.exists(indexdir):
+            os.makedirs(indexdir)
+        self.indexdir = indexdir
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.prev_indexes = prev_indexes
+        self.continue_on_error = continue_on_error
+        self.nfiles = 0
+        self.nreused = 0
+        self.nerrors = 0
+        self._errors_file = None
+        if continue_on_error:
+            self._errors_file = open(os.path.join(indexdir, ERRORS_FILE) + '.tmp', 'w')
+        self.nunverified = 0
+        self._prev_unverified = set()
+        if os.path.exists(os.path.join(indexdir, UNVERIFIED_FILE)):
+            self._prev_unverified = set(read_filelist(os.path.join(indexdir, UNVERIFIED_FILE)))
+        self._unverified = set()
+        self._unverified_file = open(os.path.join(indexdir, UNVERIFIED_FILE) + '.tmp', 'w')
+        self._entries = []
+        self._tmp_index_file = os.path.join(indexdir, indexstore.INDEX_DB) + '.tmp'
+        self._store = indexstore.IndexStore.create(self._tmp_index_file,
+                                                   {'algorithm': algorithm, 'chunk_size': chunk_size})
+        if not keep_journals:
+            journal.remove_journals(indexdir)
+        self._journal = journal.Journal(indexdir, journal.journal_options(algorithm, chunk_size, cdc_size))
+        self._hash_cache = None
+        if hash_cache:
+            try:
+                self._hash_cache = hashcache.HashCache(hash_cache)
+            except sqlite3.Error as e:
+                logger.warning('Could not open the hash cache %s: %s', hash_cache, e)
+        self._nchunked = 0
+        self._chunk_file = None
+        self._cdc_file = None
+        if chunk_size:
+            self._chunk_file = open(os.path.join(indexdir, 'CHUNKS.idx.tmp'), 'w')
+        if cdc_size:
+            self._cdc_file = open(os.path.join(indexdir, 'CDC.idx.tmp'), 'w')
+            self._cdc_file.write(CDC_HEADER.format(algorithm, cdc_size))
+
+    def add(self, indexes, verified=True):
+        '''
+        Adds the (filename, hash, stats[, cdc_chunks]) results of `calculate_hash`.
+        '''
+        for index in indexes:
+            if isinstance(index, FileError):
+                self._add_error(index)
+                continue
+            if len(index) > 3 and self._cdc_file is not None:
+                self._cdc_file.write('{}: {}\n'.format(index[0], ' '.join('{} {}'.format(*chunk)
+                                                                          for chunk in index[3])))
+            reused = False
+            if self.prev_indexes:
+                prev_index = self.prev_indexes.get(index[0])
+                if prev_index is not None and prev_index[:2] == tuple(index[1:3]):
+                    self.nreused += 1
+                    reused = True
+            if not verified or (reused and index[0] in self._prev_unverified):
+                self._unverified_file.write('{}\n'.format(index[0]))
+                self._unverified.add(index[0])
+                self.nunverified += 1
+            self._journal.add([index])
+            self._entries.append((index[0], index[1], index[2] if len(index) > 2 else None))
+            if len(self._entries) >= WRITE_BATCH_FILES:
+                self._flush()
+        self._journal.flush()
+
+    def _add_error(self, file_error):
+        logger.error('Could not read %s', file_error)
+        if not self.continue_on_error:
+            raise file_error.error
+        self._errors_file.write('{}\n'.format(file_error))
+        self.nerrors += 1
+
+    def add_chunks(self, filepath, chunk_hashes):
+        self._chunk_file.write('{}: {}\n'.format(filepath, ' '.join(chunk_hashes)))
+        self._journal.add_chunks(filepath, chunk_hashes)
+        self._nchunked += 1
+
+    def _flush(self):
+        self._journal.sync()
+        self._store.add(self._entries)
+        if self._hash_cache is not None:
+            # tree hashes depend on the chunk size, and are not cached
+            self._update_cache([(file_hash, stats) for filepath, file_hash, stats in self._entries
+                                if stats is not None and not (self.chunk_size and stats[0] > self.chunk_size)
+                                and filepath not in self._unverified])
+        self.nfiles += len(self._entries)
+        self._entries = []
+
+    def _update_cache(self, entries):
+        try:
+            self._hash_cache.add(entries, self.algorithm)
+        except sqlite3.Error as e:
+            logger.warning('Could not update the hash cache %s: %s', self._hash_cache.cache_file, e)
+            self._hash_cache.close()
+            self._hash_cache = None
+
+    def _install(self, filename, tmp_file, keep):
+        index_file = os.path.join(self.indexdir, filename)
+        if keep:
+            os.replace(tmp_file.name, index_file)
         else:
-            name_path_map[filename] = k
-    logger.info('Saving indexes')
-    dict_to_file(path_indexes, path_index_file)
-    dict_to_file(data_indexes, data_index_file)
-    dict_to_file(name_path_map, name_path_map_file)
-    logger.info('Directory indexing complete')
+            os.remove(tmp_file.name)
+            if os.path.exists(index_file):
+                os.remove(index_file)
+
+    def abort(self):
+        '''
+        Removes the indexes written aside after an error, keeping the journal for a resumed indexing.
+        '''
+        self._journal.close()
+        self._store.close()
+        os.remove(self._tmp_index_file)
+        for tmp_file in [self._chunk_file, self._cdc_file, self._errors_file, self._unverified_file]:
+            if tmp_file is not None:
+                tmp_file.close()
+                os.remove(tmp_file.name)
+        if self._hash_cache is not None:
+            self._hash_cache.close()
+
+    def close(self):
+        self._flush()
+        logger.info('Saving indexes')
+        if self.prev_indexes:
+            logger.info('Reused the hashes of %d unchanged files', self.nreused)
+        self._store.finish()
+        self._store.close()
+        if self._hash_cache is not None:
+            try:
+                self._hash_cache.evict()
+            except sqlite3.Error as e:
+                logger.warning('Could not trim the hash cache %s: %s', self._hash_cache.cache_file, e)
+            self._hash_cache.close()
+        for filename, tmp_file, keep in [('CHUNKS.idx', self._chunk_file, self._nchunked > 0),
+                                         ('CDC.idx', self._cdc_file, True),
+                                         (ERRORS_FILE, self._errors_file, self.nerrors > 0),
+                                         (UNVERIFIED_FILE, self._unverified_file, self.nunverified > 0)]:
+            if tmp_file is not None:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+                tmp_file.close()
+                self._install(filename, tmp_file, keep)
+            elif os.path.exists(os.path.join(self.indexdir, filename)):
+                os.remove(os.path.join(self.indexdir, filename))
+        install_index(self.indexdir, self._tmp_index_file)
+        self._journal.close()
+        journal.remove_journals(self.indexdir)
+        if self.nerrors:
+            logger.warning('Could not read %d files, listed in %s', self.nerrors,
+                           os.path.join(self.indexdir, ERRORS_FILE))
+        logger.info('Directory indexing complete')
+
+
+def save_indexes(indexdir, indexes, algorithm=hashing.DEFAULT_ALGORITHM, chunk_size=0,
+                 chunk_indexes=None, cdc_size=0):
+    '''
+    The index of a data path maps each file path to the hash of its data
+    and its stat information. It is saved in a database (`INDEX.db`) where
+    files can also be looked up by hash and by name.
+    The chunk hashes of the files that have a tree hash, and the content-defined
+    chunks of the files, are saved in separate indexes.
+    '''
+    writer = IndexWriter(indexdir, algorithm, chunk_size, cdc_size)
+    writer.add(indexes)
+    for filepath, chunk_hashes in (chunk_indexes or {}).items():
+        writer.add_chunks(filepath, chunk_hashes)
+    writer.close()
 
 
 '''
-function to index file paths in parallel using python multiprocessing
-module
+function to index file paths in batches, hashed in parallel by `num_workers`
+workers through `map_batches`, which returns the results of `_calculate_hashes`
+for each batch
 '''
-def mp_index(stagingdir, datapath):
+def batch_index(stagingdir, datapath, verify, hash_options, num_workers, map_batches, resume=False,
+                continue_on_error=False):
     indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
     deduce_file = os.path.join(indexdir, 'FILEPATHS')
     if not os.path.exists(deduce_file):
         scanner.scan(datapath, stagingdir)
 
     filelist = read_filelist(deduce_file)
-    
+    if hash_options is None:
+        hash_options = hashing.HashOptions()
+    prev_indexes = read_prev_indexes(indexdir, verify, hash_options)
+    chunk_size = hash_options.chunk_size
+    prev_chunk_indexes = {}
+    if chunk_size and prev_indexes:
+        prev_chunk_indexes = read_chunk_index(os.path.join(indexdir, 'CHUNKS.idx'))
+    if resume:
+        add_journal_indexes(indexdir, hash_options, prev_indexes, prev_chunk_indexes)
+
     logger.info('Indexing %d files', len(filelist))
+    writer = IndexWriter(indexdir, hash_options.algorithm, chunk_size, hash_options.cdc_size, prev_indexes,
+                         keep_journals=resume, continue_on_error=continue_on_error,
+                         hash_cache=hash_options.hash_cache)
+    try:
+        # the file sizes are needed for scheduling, and the stat of each file
+        # also tells which previous hashes can be reused without hashing
+        executor = ThreadPoolExecutor(max_workers=STAT_THREADS)
+        futures = [executor.submit(_retry, stat_file, filename, os.path.join(datapath, filename))
+                   for filename in filelist]
+        try:
+            file_stats = _results(futures)
+            files = []
+            # files larger than a chunk are split, so that their chunks are hashed in parallel
+            chunked_files = {}
+            for filename, stats in zip(filelist, file_stats):
+                if isinstance(stats, FileError):
+                    writer.add([stats])
+                    continue
+                prev_index = prev_indexes.get(filename)
+                # a tree hash is only reused along with its chunk hashes
+                if prev_index is not None and prev_index[1] == stats and \
+                   (not chunk_size or stats[0] <= chunk_size or filename in prev_chunk_indexes):
+                    writer.add([(filename, prev_index[0], stats) + prev_index[2:]])
+                    if filename in prev_chunk_indexes:
+                        writer.add_chunks(filename, prev_chunk_indexes[filename])
+                elif chunk_size and stats[0] > chunk_size:
+                    chunked_files[filename] = stats
+                    files.extend(((filename, offset), min(chunk_size, stats[0] - offset))
+                                 for offset in range(0, stats[0], chunk_size))
+                else:
+                    files.append((filename, stats[0]))
+        finally:
+            # a file that cannot be read stops the indexing before the other files are stated
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+        batches = make_batches(files, num_workers)
+        logger.info('Hashing %d files and chunks in %d batches', len(files), len(batches))
+        tasks = ((datapath, batch, hash_options) for batch in batches)
+        chunk_hashes = {filename: {} for filename in chunked_files}
+        for results, chunk_results in map_batches(tasks):
+            writer.add(results)
+            for chunk_result in chunk_results:
+                if isinstance(chunk_result, FileError):
+                    # a file fails with its first unreadable chunk, and its other chunks are dropped
+                    if chunk_result.filename in chunk_hashes:
+                        del chunk_hashes[chunk_result.filename]
+                        writer.add([chunk_result])
+                    continue
+                filename, offset, chunk_hash = chunk_result
+                if filename not in chunk_hashes:
+                    continue
+                chunk_hashes[filename][offset] = chunk_hash
+                size = chunked_files[filename][0]
+                if len(chunk_hashes[filename]) == (size + chunk_size - 1) // chunk_size:
+                    # the hash of a chunked file is the root of the tree of its chunk hashes
+                    file_chunk_hashes = [chunk_hashes[filename][offset] for offset in sorted(chunk_hashes[filename])]
+                    writer.add_chunks(filename, file_chunk_hashes)
+                    writer.add([(filename, hashing.tree_hash(file_chunk_hashes, hash_options.algorithm),
+                                 chunked_files[filename])])
+                    del chunk_hashes[filename]
+    except BaseException:
+        # the indexes written aside are removed, and the journal is kept for a resumed indexing
+        writer.abort()
+        raise
+    writer.close()
+
+    return indexdir
+
+'''
+function to index file paths in parallel using python multiprocessing
+module
+'''
+def mp_index(stagingdir, datapath, verify=False, hash_options=None, resume=False, continue_on_error=False):
     num_procs = multiprocessing.cpu_count()
-    results = []
-    pool = multiprocessing.Pool(processes=num_procs)
+    pool = multiprocessing.Pool(processes=num_procs, initializer=hashing.init_worker)
+    try:
+        indexdir = batch_index(stagingdir, datapath, verify, hash_options, num_procs,
+                               lambda tasks: pool.imap_unordered(_calculate_hashes, tasks), resume,
+                               continue_on_error)
+        pool.close()
+    except BaseException:
+        # the batches still queued are dropped rather than hashed
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return indexdir
+
+'''
+function to index file paths in parallel using a pool of threads, which
+avoids starting processes and pickling the batches and their results.
+hashlib releases the GIL while hashing large blocks, so threads scale
+with the number of cores for large files, and hide the I/O latency of
+small files
+'''
+def thread_index(stagingdir, datapath, verify=False, hash_options=None, nthreads=DEFAULT_HASH_THREADS,
+                 resume=False, continue_on_error=False):
+    executor = ThreadPoolExecutor(max_workers=nthreads)
+    futures = []
+
+    def map_batches(tasks):
+        futures.extend(executor.submit(_calculate_hashes, task) for task in tasks)
+        return _results(futures)
+
+    try:
+        indexdir = batch_index(stagingdir, datapath, verify, hash_options, nthreads, map_batches, resume,
+                               continue_on_error)
+    finally:
+        # only the batches being hashed are waited for after an error
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+    hashing.log_throughput()
+
+    return indexdir
+
+async def _hash_files(datapath, filelist, prev_indexes, hash_options, executor, concurrency, writer):
+    loop = asyncio.get_event_loop()
+    pending = set()
     for filename in filelist:
-        result = pool.apply_async(calculate_hash, args=(datapath, filename))
-        results.append(result)
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            writer.add(task.result() for task in done)
+        pending.add(loop.run_in_executor(executor, try_calculate_hash, datapath, filename,
+                                         prev_indexes.get(filename), hash_options))
+    if pending:
+        done, pending = await asyncio.wait(pending)
+        writer.add(task.result() for task in done)
 
-    pool.close()
-    pool.join()
-    indexes = [result.get() for result in results]
+'''
+function to index file paths with asyncio, keeping up to `concurrency` files
+being opened and read at once. On network filesystems, where the latency of
+each open and read rather than the CPU limits the throughput, this keeps
+many more requests in flight than there are cores
+'''
+def async_index(stagingdir, datapath, verify=False, hash_options=None, concurrency=DEFAULT_CONCURRENCY,
+                resume=False, continue_on_error=False):
+    indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
+    deduce_file = os.path.join(indexdir, 'FILEPATHS')
+    if not os.path.exists(deduce_file):
+        scanner.scan(datapath, stagingdir)
+
+    filelist = read_filelist(deduce_file)
+    if hash_options is None:
+        hash_options = hashing.HashOptions()
+    # the files read at once already overlap their reads, and a read-ahead thread
+    # and buffer per file would double the threads and the memory of the readers
+    hash_options.readahead = False
+    prev_indexes = read_prev_indexes(indexdir, verify, hash_options)
+    if resume:
+        add_journal_indexes(indexdir, hash_options, prev_indexes)
+
+    logger.info('Indexing %d files', len(filelist))
+    writer = IndexWriter(indexdir, hash_options.algorithm, cdc_size=hash_options.cdc_size,
+                         prev_indexes=prev_indexes, keep_journals=resume, continue_on_error=continue_on_error,
+                         hash_cache=hash_options.hash_cache)
+    loop = asyncio.new_event_loop()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            loop.run_until_complete(_hash_files(datapath, filelist, prev_indexes, hash_options,
+                                                executor, concurrency, writer))
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        loop.close()
+    hashing.log_throughput()
+
+    writer.close()
+
+    return indexdir
 
-    save_indexes(indexdir, indexes)
+'''
+function to scan and index a data path in one pass: the directory scan feeds
+the worker pool, so files are hashed while deeper directories are still listed.
+The data path is always scanned again, with the keyword arguments of
+`scanner.iter_scan` in `scan_options`, and FILEPATHS is written by the scan
+as usual
+'''
+def pipeline_index(stagingdir, datapath, verify=False, hash_options=None, resume=False, continue_on_error=False,
+                   scan_options=None):
+    indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
+    if hash_options is None:
+        hash_options = hashing.HashOptions()
+    prev_indexes = read_prev_indexes(indexdir, verify, hash_options)
+    if resume:
+        add_journal_indexes(indexdir, hash_options, prev_indexes)
+    num_procs = multiprocessing.cpu_count()
+    writer = IndexWriter(indexdir, hash_options.algorithm, cdc_size=hash_options.cdc_size,
+                         prev_indexes=prev_indexes, keep_journals=resume, continue_on_error=continue_on_error,
+                         hash_cache=hash_options.hash_cache)
+    pool = multiprocessing.Pool(processes=num_procs, initializer=hashing.init_worker)
+    scan = scanner.iter_scan(datapath, stagingdir, **(scan_options or {}))
+    try:
+        # the pool consumes the scan from its task handler thread
+        tasks = ((datapath, filename, prev_indexes.get(filename), hash_options) for filename in scan)
+        writer.add(pool.imap_unordered(_calculate_hash, tasks, chunksize=16))
+        pool.close()
+    except BaseException:
+        # the directories not listed yet are not scanned, and the files queued are not hashed
+        pool.terminate()
+        pool.join()
+        scan.close()
+        writer.abort()
+        raise
+    pool.join()
+    writer.close()
+    logger.info('Indexed %d files', writer.nfiles)
 
     return indexdir
 
+_task_journals = {}
+
+def journaled_hash(datapath, filename, prev_index, hash_options, indexdir):
+    '''
+    Hashes a file as `try_calculate_hash` does, and records the result in the journal
+    of the process, for the tasks that run in other processes than the indexer.
+    '''
+    index = try_calculate_hash(datapath, filename, prev_index, hash_options)
+    if isinstance(index, FileError):
+        return index
+    if indexdir not in _task_journals:
+        options = journal.journal_options(hash_options.algorithm, hash_options.chunk_size, hash_options.cdc_size)
+        _task_journals[indexdir] = journal.Journal(indexdir, options, tag='.task')
+    _task_journals[indexdir].add([index])
+    _task_journals[indexdir].flush()
+    return index
+
 '''
 indexing using Tigres API for scaling across multiple nodes
 '''
-def tigres_index(stagingdir, datapath):
+def tigres_index(stagingdir, datapath, hash_options=None, resume=False, continue_on_error=False):
     indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
     deduce_file = os.path.join(indexdir, 'FILEPATHS')
     if not os.path.exists(deduce_file):
         scanner.scan(datapath, os.path.dirname(stagingdir))
 
     filelist = read_filelist(deduce_file)
+    if hash_options is None:
+        hash_options = hashing.HashOptions()
+    prev_indexes = {}
+    if resume:
+        add_journal_indexes(indexdir, hash_options, prev_indexes)
+    else:
+        journal.remove_journals(indexdir)
     
     exec_name = 'EXECUTION_DISTRIBUTE_PROCESS'
     exec_plugin = tigres.utils.Execution.get(exec_name)
@@ -178,18 +924,26 @@ def tigres_index(stagingdir, datapath):
 
         task_array = tigres.TaskArray(tasks=[])
         
-        task_hash = tigres.Task("hash_index", task_type=tigres.FUNCTION, impl_name=calculate_hash)
+        task_hash = tigres.Task("hash_index", task_type=tigres.FUNCTION, impl_name=journaled_hash)
         task_array.append(task_hash)
         
         input_list = []
         for file in filelist:
-            input_list.append([datapath, file])
+            input_list.append([datapath, file, prev_indexes.get(file), hash_options, indexdir])
         input_array = tigres.InputArray(values=input_list)
 
         logger.info('Indexing %d files', len(filelist))
         indexes = tigres.parallel('index_files', input_array=input_array, task_array=task_array)
 
-        save_indexes(indexdir, indexes)
+        # the journals of the tasks are removed once the indexes are saved
+        task_journal = _task_journals.pop(indexdir, None)
+        if task_journal is not None:
+            task_journal.close()
+        writer = IndexWriter(indexdir, hash_options.algorithm, cdc_size=hash_options.cdc_size,
+                             prev_indexes=prev_indexes, keep_journals=True, continue_on_error=continue_on_error,
+                             hash_cache=hash_options.hash_cache)
+        writer.add(indexes)
+        writer.close()
 
     except tigres.utils.TigresException as e:
         print(str(e))
@@ -199,6 +953,18 @@ def tigres_index(stagingdir, datapath):
 
     return indexdir
 
+def get_hash_options(args):
+    return hashing.HashOptions(block_size=args.block_size << 20, readahead=not args.no_readahead,
+                               use_mmap=args.mmap, algorithm=args.algorithm,
+                               chunk_size=args.chunk_size << 20, cdc_size=args.cdc_size << 20,
+                               use_xattrs=args.xattrs)
+
+def get_scan_options(args):
+    scan_options = {'ignorelist': args.ignore, 'extensions': args.extensions, 'min_size': args.min_size,
+                    'max_size': args.max_size, 'newer_than': args.newer_than, 'older_than': args.older_than,
+                    'symlinks': args.symlinks or None, 'details': args.metadetails or None}
+    return {name: value for name, value in scan_options.items() if value is not None}
+
 def main(args):
     datapath = os.path.abspath(args.datapath)
     stagingdir = None
@@ -207,7 +973,11 @@ def main(args):
         stagingdir = args.stagingdir
     #args.stagingdir
     manager = args.manager
-    index(datapath, stagingdir, manager)
+    pipeline = args.pipeline
+    verify = args.verify
+    hash_options = get_hash_options(args)
+    index(datapath, stagingdir, manager, pipeline, verify, hash_options, args.threads, args.concurrency,
+          args.resume, args.continue_on_error, args.hash_cache, get_scan_options(args))
 
 def s_main(args):
     datapath = args['datapath']
@@ -0,0 +1,151 @@
+"""
+`dacman.core.indexstore`
+====================================
+
+.. currentmodule:: dacman.core.indexstore
+
+:platform: Unix, Mac
+:synopsis: Module for storing the indexes of a data path in a SQLite database
+
+"""
+
+import os
+import sqlite3
+
+import logging
+
+__modulename__ = 'indexstore'
+
+logger = logging.getLogger(__name__)
+
+# name of the index database in the index directory of a data path
+INDEX_DB = 'INDEX.db'
+
+_SCHEMA = '''
+CREATE TABLE options (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE files (path TEXT PRIMARY KEY, name TEXT NOT NULL, hash TEXT NOT NULL,
+                    size INTEGER, mtime_ns INTEGER, inode INTEGER, device INTEGER);
+'''
+
+# the hash and name indexes are built once all files are inserted, which is faster
+_INDEXES = '''
+CREATE INDEX files_hash ON files (hash);
+CREATE INDEX files_name ON files (name);
+'''
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit, and inode numbers may not fit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class IndexStore(object):
+    '''
+    Index of the files of a data path in a SQLite database, with the hash
+    and the (size, mtime_ns, inode, device) of each file. The paths, hashes
+    and names of the files are indexed, so that the hash of a file, or the files
+    with a hash or a name, are looked up without loading the whole index.
+    The options the index was created with (e.g. the hash algorithm) are stored along.
+    '''
+    def __init__(self, db_file, create=False):
+        if not create and not os.path.exists(db_file):
+            raise IOError('Index {} does not exist'.format(db_file))
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+
+    @classmethod
+    def create(cls, db_file, options):
+        '''
+        Creates an empty index, replacing any existing one.
+        '''
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        store = cls(db_file, create=True)
+        # the database is only used once it is complete, so it needs no journal,
+        # and is synced once, when it is installed (see `indexer.install_index`)
+        store.conn.execute('PRAGMA journal_mode = OFF')
+        store.conn.execute('PRAGMA synchronous = OFF')
+        store.conn.executescript(_SCHEMA)
+        with store.conn:
+            store.conn.executemany('INSERT INTO options VALUES (?, ?)',
+                                   ((name, str(value)) for name, value in options.items()))
+        return store
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, entries):
+        '''
+        Inserts (path, hash, stats) entries in a single transaction;
+        `stats` may be `None` if the stat information of a file is not known.
+        '''
+        rows = ((path, os.path.basename(path), file_hash) +
+                ((stats[0], stats[1], _to_signed(stats[2]), _to_signed(stats[3])) if stats else (None,) * 4)
+                for path, file_hash, stats in entries)
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def merge(self, db_file):
+        '''
+        Inserts all the files of another index, e.g. a partial index written by another process.
+        '''
+        self.conn.execute('ATTACH DATABASE ? AS other', (db_file,))
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO files SELECT * FROM other.files')
+        self.conn.execute('DETACH DATABASE other')
+
+    def finish(self):
+        self.conn.executescript(_INDEXES)
+
+    def options(self):
+        return dict(self.conn.execute('SELECT name, value FROM options'))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def _entry(self, row):
+        stats = None
+        if row[2] is not None:
+            stats = (row[2], row[3], _to_unsigned(row[4]), _to_unsigned(row[5]))
+        return row[0], row[1], stats
+
+    def items(self):
+        '''
+        Iterates over the (path, hash, stats) of all the files.
+        '''
+        cursor = self.conn.execute('SELECT path, hash, size, mtime_ns, inode, device FROM files')
+        for row in cursor:
+            yield self._entry(row)
+
+    def get(self, path):
+        '''
+        Returns the (hash, stats) of a file, or `None` if it is not indexed.
+        '''
+        row = self.conn.execute('SELECT path, hash, size, mtime_ns, inode, device FROM files WHERE path = ?',
+                                (path,)).fetchone()
+        return self._entry(row)[1:] if row is not None else None
+
+    def get_hash(self, path):
+        entry = self.get(path)
+        return entry[0] if entry is not None else None
+
+    def has_hash(self, file_hash):
+        return self.conn.execute('SELECT 1 FROM files WHERE hash = ? LIMIT 1', (file_hash,)).fetchone() is not None
+
+    def paths_with_hash(self, file_hash):
+        return [row[0] for row in self.conn.execute('SELECT path FROM files WHERE hash = ? ORDER BY path',
+                                                    (file_hash,))]
+
+    def paths_with_name(self, name):
+        return [row[0] for row in self.conn.execute('SELECT path FROM files WHERE name = ? ORDER BY path',
+                                                    (name,))]
@@ -0,0 +1,122 @@
+"""
+`dacman.core.journal`
+====================================
+
+.. currentmodule:: dacman.core.journal
+
+:platform: Unix, Mac
+:synopsis: Module for journaling the files hashed while indexing, so that interrupted indexing can be resumed
+
+"""
+
+import os
+import glob
+import json
+import socket
+
+import logging
+
+__modulename__ = 'journal'
+
+logger = logging.getLogger(__name__)
+
+# prefix of the journals in the index directory of a data path, one per indexing process
+JOURNAL_PREFIX = 'INDEX.journal.'
+
+
+def journal_options(algorithm, chunk_size=0, cdc_size=0):
+    '''
+    Hashing options a journal is written with; entries are only resumed with the same options.
+    '''
+    return {'algorithm': algorithm, 'chunk_size': chunk_size, 'cdc_size': cdc_size}
+
+
+class Journal(object):
+    '''
+    Append-only record of the files hashed so far by a process, with the hash,
+    stat information and chunks of each file. Each record is a JSON line, and
+    the records are flushed as results come in, so that the results of an
+    interrupted indexing are kept on disk; a line with the hashing options
+    the records were written with precedes them. Each process writes its own
+    journal, named after its host and process id, and a `tag` if the process
+    writes several journals.
+    '''
+    def __init__(self, indexdir, options, tag=''):
+        self.journal_file = os.path.join(indexdir, '{}{}.{}{}'.format(JOURNAL_PREFIX, socket.gethostname(),
+                                                                      os.getpid(), tag))
+        self._f = open(self.journal_file, 'a')
+        self._f.write('{}\n'.format(json.dumps(options)))
+        self.flush()
+
+    def add(self, indexes):
+        '''
+        Records the (filename, hash, stats[, cdc_chunks]) results of `calculate_hash`.
+        '''
+        for index in indexes:
+            self._f.write('{}\n'.format(json.dumps(['f'] + list(index))))
+
+    def add_chunks(self, filepath, chunk_hashes):
+        self._f.write('{}\n'.format(json.dumps(['c', filepath, chunk_hashes])))
+
+    def flush(self):
+        self._f.flush()
+
+    def sync(self):
+        '''
+        Makes the records durable, which a flush alone does not if the node fails.
+        '''
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+
+def read_journals(indexdir, options):
+    '''
+    Reads the journals of a data path, returning the entries of the files
+    recorded with the same hashing options, as `read_prev_indexes` does,
+    and the chunk hashes of the files that have a tree hash.
+    '''
+    indexes = {}
+    chunk_indexes = {}
+    for journal_file in sorted(glob.glob(os.path.join(indexdir, JOURNAL_PREFIX + '*'))):
+        matches = False
+        with open(journal_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last record of an interrupted process may be partial
+                    break
+                if isinstance(record, dict):
+                    matches = record == options
+                elif not matches:
+                    continue
+                elif record[0] == 'f':
+                    prev_index = (record[2], tuple(record[3]) if record[3] is not None else None)
+                    if len(record) > 4:
+                        prev_index += ([tuple(chunk) for chunk in record[4]],)
+                    indexes[record[1]] = prev_index
+                else:
+                    chunk_indexes[record[1]] = record[2]
+    indexes = {filepath: prev_index for filepath, prev_index in indexes.items() if prev_index[1] is not None}
+    if indexes:
+        logger.info('Resuming from the journaled hashes of %d files', len(indexes))
+    return indexes, chunk_indexes
+
+
+def sync_path(path):
+    '''
+    Makes a file, or the renames and removals in a directory, durable.
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def remove_journals(indexdir):
+    for journal_file in glob.glob(os.path.join(indexdir, JOURNAL_PREFIX + '*')):
+        os.remove(journal_file)
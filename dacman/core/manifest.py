@@ -0,0 +1,226 @@
+"""
+`dacman.core.manifest`
+====================================
+
+.. currentmodule:: dacman.core.manifest
+
+:platform: Unix, Mac
+:synopsis: Module for importing checksum manifests into the index of a data path, and exporting indexes as manifests
+
+"""
+
+import os
+import re
+import sys
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import dacman.core.scanner as scanner
+import dacman.core.hashing as hashing
+import dacman.core.indexer as indexer
+import dacman.core.indexstore as indexstore
+from dacman.core.utils import get_hash_id
+
+import logging
+
+__modulename__ = 'manifest'
+
+logger = logging.getLogger(__name__)
+
+# BagIt payload manifests are named after their algorithm
+BAGIT_MANIFEST = re.compile(r'^(?:tag)?manifest-(\w+)\.txt$')
+# algorithm of the manifests without one in their name, by the length of their digests
+DIGEST_ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+def is_bagit(manifest_file):
+    return BAGIT_MANIFEST.match(os.path.basename(manifest_file)) is not None
+
+
+def _bagit_decode(path):
+    return path.replace('%0A', '\n').replace('%0D', '\r').replace('%25', '%')
+
+
+def _bagit_encode(path):
+    return path.replace('%', '%25').replace('\n', '%0A').replace('\r', '%0D')
+
+
+def _md5sum_decode(path):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), path)
+
+
+def _md5sum_encode(path):
+    return path.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def read_manifest(manifest_file):
+    '''
+    Returns the (digest, path) entries of a BagIt manifest, or of a checksum
+    list in the format of `md5sum` and `sha256sum` (`<digest>  <path>`,
+    with a `*` before the path of files hashed in binary mode). Paths are
+    relative to the directory of the manifest.
+    '''
+    bagit = is_bagit(manifest_file)
+    entries = []
+    with open(manifest_file, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            # md5sum escapes the lines of paths with backslashes or newlines
+            escaped = not bagit and line.startswith('\\')
+            fields = line[1 if escaped else 0:].split(None, 1)
+            if len(fields) != 2:
+                logger.warning('Skipping malformed line in %s: %s', manifest_file, line)
+                continue
+            digest, path = fields[0].lower(), fields[1]
+            if bagit:
+                path = _bagit_decode(path)
+            else:
+                path = path[1:] if path.startswith('*') else path
+                path = _md5sum_decode(path) if escaped else path
+            entries.append((digest, path))
+    return entries
+
+
+def get_algorithm(manifest_file, entries):
+    '''
+    Returns the algorithm of a manifest, from its name for BagIt manifests,
+    or from the length of its digests.
+    '''
+    match = BAGIT_MANIFEST.match(os.path.basename(manifest_file))
+    if match:
+        return match.group(1).lower()
+    lengths = set(len(digest) for digest, _ in entries)
+    if len(lengths) == 1:
+        return DIGEST_ALGORITHMS.get(lengths.pop())
+    return None
+
+
+def verify_sample(datapath, entries, algorithm, sample_size):
+    '''
+    Hashes a random sample of `sample_size` of the (path, digest, stats)
+    entries imported from a manifest, and returns the paths of the files
+    whose digest does not match, or that could not be read.
+    '''
+    sample = random.sample(entries, min(sample_size, len(entries)))
+    logger.info('Verifying the digests of %d files', len(sample))
+    hash_options = hashing.HashOptions(algorithm=algorithm)
+    mismatches = []
+    for filepath, digest, _ in sample:
+        index = indexer.try_calculate_hash(datapath, filepath, hash_options=hash_options)
+        if isinstance(index, indexer.FileError):
+            logger.error('Could not verify the digest of %s', index)
+            mismatches.append(filepath)
+        elif index[1] != digest:
+            logger.error('Digest of %s does not match the manifest', filepath)
+            mismatches.append(filepath)
+    return mismatches
+
+
+'''
+seeds the index of a data path with the digests of a manifest: the files of the
+manifest are indexed with their digest and current stat information, so that
+the indexing that follows only hashes the files missing from the manifest.
+The imported digests are listed as unverified in the index, and are kept out
+of the hash cache until their files are hashed. With a `sample_size`, that many
+files of the manifest are hashed first, and the manifest is rejected if any of
+them does not match. The digests of the files that cannot be stated, e.g.
+removed since the data path was scanned, are not imported, and these files
+fail the indexing that follows unless `continue_on_error` is set.
+'''
+def import_manifest(datapath, manifest_file, custom_stagingdir=None, algorithm=None, sample_size=0,
+                    continue_on_error=False):
+    stagingdir = indexer.check_stagingdir(custom_stagingdir, datapath)
+    indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
+    entries = read_manifest(manifest_file)
+    if algorithm is None:
+        algorithm = get_algorithm(manifest_file, entries)
+    if algorithm not in hashing.ALGORITHMS:
+        logger.error('Unknown or unsupported algorithm of manifest %s, set it with -a', manifest_file)
+        sys.exit(1)
+    logger.info('Importing %d %s digests from %s', len(entries), algorithm, manifest_file)
+
+    deduce_file = os.path.join(indexdir, 'FILEPATHS')
+    if not os.path.exists(deduce_file):
+        scanner.scan(datapath, stagingdir)
+    filelist = set(indexer.read_filelist(deduce_file))
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    digests = {}
+    for digest, path in entries:
+        filepath = os.path.relpath(os.path.join(manifest_dir, path), datapath)
+        if filepath in filelist:
+            digests[filepath] = digest
+    if len(digests) < len(entries):
+        logger.warning('%d files of the manifest are not in %s', len(entries) - len(digests), datapath)
+
+    with ThreadPoolExecutor(max_workers=indexer.STAT_THREADS) as executor:
+        file_stats = executor.map(lambda filepath: indexer._retry(indexer.stat_file, filepath,
+                                                                  os.path.join(datapath, filepath)), digests)
+        imported = []
+        for (filepath, digest), stats in zip(digests.items(), file_stats):
+            if isinstance(stats, indexer.FileError):
+                logger.warning('Could not stat %s, not importing its digest', stats)
+                continue
+            imported.append((filepath, digest, stats))
+
+    if sample_size and verify_sample(datapath, imported, algorithm, sample_size):
+        logger.error('Manifest %s does not match the data, not importing it', manifest_file)
+        sys.exit(1)
+
+    # files indexed with the same algorithm that the manifest does not list keep their hashes
+    hash_options = hashing.HashOptions(algorithm=algorithm)
+    prev_indexes = indexer.read_prev_indexes(indexdir, False, hash_options)
+    writer = indexer.IndexWriter(indexdir, algorithm, prev_indexes=prev_indexes)
+    writer.add(imported, verified=False)
+    writer.add((filepath,) + prev_index[:2] for filepath, prev_index in prev_indexes.items()
+               if filepath in filelist and filepath not in digests)
+    writer.close()
+    logger.info('Imported the digests of %d files, indexing the other files', len(imported))
+
+    return indexer.index(datapath, stagingdir, hash_options=hash_options, continue_on_error=continue_on_error)
+
+
+def export_manifest(datapath, manifest_file, custom_stagingdir=None, prefix=''):
+    '''
+    Writes the index of a data path as a manifest. Manifests named as BagIt
+    manifests are written in the BagIt format, and the others in the format of
+    `md5sum`. Paths are relative to the data path, with a `prefix`, e.g. `data/`
+    for a BagIt bag.
+    '''
+    stagingdir = indexer.check_stagingdir(custom_stagingdir, datapath)
+    indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
+    index_file = os.path.join(indexdir, indexstore.INDEX_DB)
+    if not os.path.exists(index_file):
+        logger.error('Data is not indexed... please index before exporting a manifest!')
+        sys.exit(1)
+    # tree hashes are not digests of the contents of files
+    if indexer.read_chunk_index(os.path.join(indexdir, 'CHUNKS.idx')):
+        logger.error('Index of %s has tree hashes of chunked files, index it without --chunk-size', datapath)
+        sys.exit(1)
+
+    bagit = is_bagit(manifest_file)
+    with indexstore.IndexStore(index_file) as store:
+        entries = sorted((filepath, file_hash) for filepath, file_hash, _ in store.items())
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        for filepath, file_hash in entries:
+            path = prefix + filepath
+            if bagit:
+                f.write('{}  {}\n'.format(file_hash, _bagit_encode(path)))
+            elif '\\' in path or '\n' in path:
+                f.write('\\{}  {}\n'.format(file_hash, _md5sum_encode(path)))
+            else:
+                f.write('{}  {}\n'.format(file_hash, path))
+    logger.info('Exported the %s digests of %d files', indexer.read_index_algorithm(index_file), len(entries))
+
+
+def main(args):
+    datapath = os.path.abspath(args.datapath)
+    if not args.file:
+        logger.error('No manifest provided, set it with -f')
+        sys.exit(1)
+    if args.option == 'import':
+        import_manifest(datapath, args.file, args.stagingdir, args.algorithm, args.sample, args.continue_on_error)
+    else:
+        export_manifest(datapath, args.file, args.stagingdir, args.prefix)
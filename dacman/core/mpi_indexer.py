@@ -14,7 +14,10 @@
 import yaml
 import sys
 import os
-import hashlib
+import time
+import sqlite3
+import threading
+from queue import Queue, Empty
 
 try:
     from mpi4py import MPI
@@ -22,8 +25,15 @@ try:
 except ImportError:
     __AVAIL_MPI__ = False
 
-import dacman.core.scanner as scanner
-from dacman.core.utils import dict_to_file, get_hash_id
+import dacman.core.mpi_scanner as mpi_scanner
+import dacman.core.hashing as hashing
+import dacman.core.indexstore as indexstore
+import dacman.core.journal as journal
+import dacman.core.hashcache as hashcache
+import dacman.core.xattrs as xattrs
+from dacman.core.indexer import try_calculate_hash, install_index, add_journal_indexes, stat_file, FileError, \
+     MAX_BATCH_FILES, ERRORS_FILE, UNVERIFIED_FILE, get_scan_options
+from dacman.core.utils import get_hash_id
 import dacman.core.utils as dacman_utils
 
 import logging
@@ -32,6 +42,11 @@ __modulename__ = 'indexer'
 
 logger = logging.getLogger(__name__)
 
+# each batch is at most this fraction of the remaining files divided among the ranks
+BATCH_SHARE = 4
+# seconds rank 0 waits between polls for requests, leaving the core to its hashing thread
+POLL_INTERVAL = 0.001
+
 ## DIRTY_CODING: redundant functions in indexer and mpi_indexer
 ## TODO: cleanup and merge, but MPI and non-MPI code work differently.
 
@@ -47,17 +62,6 @@ def dump(data, filepath):
         yaml.dump(data, f, default_flow_style=False)
     
 
-def calculate_hash(datapath, filename):
-    file_path = os.path.join(datapath, filename)
-    checksum = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        for block in iter(lambda: f.read(4096), b""):
-            checksum.update(block)
-
-    file_hash = checksum.hexdigest()
-    return (filename, file_hash)
-
-
 def read_filelist(metafile):
     logger.info('Getting file list')
     with open(metafile) as f:
@@ -88,57 +92,89 @@ def check_stagingdir(custom_stagingdir, datapath):
     return stagingdir
 
 
-def index(datapath, custom_stagingdir):
+def index(datapath, custom_stagingdir, hash_options=None, resume=False, continue_on_error=False, hash_cache=False):
     logger.info('Indexing %s', datapath)
     indexdir = None
     if __AVAIL_MPI__:
         logger.info('Using MPI for parallel indexing')
-        indexdir = mpi_index(custom_stagingdir, datapath)
+        indexdir = mpi_index(custom_stagingdir, datapath, hash_options, resume, continue_on_error, hash_cache)
     else:
         logger.error('mpi4py is not installed or not in path')
         sys.exit()
 
-    index_metafile = os.path.join(custom_stagingdir, 'indexes/INDEXED_PATHS')
-    indexing_info = {datapath: os.path.basename(indexdir)}
-    dacman_utils.update_yaml(indexing_info, index_metafile)
+    # only rank 0 returns the index directory
+    if indexdir is not None:
+        index_metafile = os.path.join(os.path.dirname(indexdir), 'INDEXED_PATHS')
+        index_metadata = {}
+        if os.path.exists(index_metafile):
+            index_metadata = dacman_utils.load_yaml(index_metafile)
+        index_metadata[datapath] = os.path.basename(indexdir)
+        dacman_utils.dump_yaml(index_metadata, index_metafile)
 
     return indexdir
 
-def save_indexes(indexdir, indexes):
+class BatchQueue(object):
     '''
-    There are two types of indexes created for each data path.
-    First, a hash of the data in a file to the file path.
-    Second, a file path to its hash.
-    A map of filename to all the paths is also created.
+    Hands out the files to index in batches that shrink as the files run out
+    (guided self-scheduling): each batch is a share of the remaining files
+    divided among the ranks, so that the first batches save messages and
+    the last ones keep all the ranks busy until the end.
     '''
-    logger.info('Building two-way hash indexes')
-    if not os.path.exists(indexdir):
-        os.makedirs(indexdir)
-    path_index_file = os.path.join(indexdir, 'PATH.idx')
-    data_index_file = os.path.join(indexdir, 'DATA.idx')
-    name_path_map_file = os.path.join(indexdir, 'PATHNAME.map')
-    path_indexes = dict(indexes)
-    data_indexes = {}
-    name_path_map = {}
-    for k, v in path_indexes.items():
-        data_indexes[v] = k
-        filename = os.path.basename(k)
-        if filename in name_path_map:
-            name_path_map[filename] = name_path_map[filename] + ' ' + k
-        else:
-            name_path_map[filename] = k
-    logger.info('Saving indexes')
-    dict_to_file(path_indexes, path_index_file)
-    dict_to_file(data_indexes, data_index_file)
-    dict_to_file(name_path_map, name_path_map_file)
-    logger.info('Directory indexing complete')
+    def __init__(self, filelist, nranks):
+        self.filelist = filelist
+        self.nranks = nranks
+        self.next_file = 0
+
+    def next_batch(self):
+        remaining = len(self.filelist) - self.next_file
+        if remaining <= 0:
+            return None
+        batch_files = min(max(remaining // (BATCH_SHARE * self.nranks), 1), MAX_BATCH_FILES)
+        batch = self.filelist[self.next_file:self.next_file + batch_files]
+        self.next_file += batch_files
+        return batch
 
 
+def get_part_file(indexdir, rank):
+    return os.path.join(indexdir, '{}.part{}'.format(indexstore.INDEX_DB, rank))
+
+
+def lookup_cached_hashes(cache, lookups, algorithm):
+    '''
+    Returns the (hash, stats) found in the hash cache for the (filename, stats) `lookups`, by file name.
+    '''
+    cached = {}
+    try:
+        for filename, stats in lookups:
+            file_hash = cache.get(stats, algorithm)
+            if file_hash is not None:
+                cached[filename] = (file_hash, stats)
+    except sqlite3.Error as e:
+        logger.warning('Could not read the hash cache %s: %s', cache.cache_file, e)
+    return cached
+
 '''
 function to index file paths in parallel using MPI for scaling
-across multiple nodes in a cluster
+across multiple nodes in a cluster.
+Rank 0 hands out batches of files to the other ranks, and hashes batches
+itself in a separate thread, so that hashing a large file does not hold up
+the requests of the other ranks. Each rank writes the hashes of its files
+to its own partial index, and the partial indexes are merged pairwise in a tree of
+log2(ranks) rounds into the partial index of rank 0, which becomes the index.
+Each rank also journals the hashes of its files, so that an interrupted
+indexing can be resumed: with `resume`, rank 0 sends the journaled entry of
+each file along, which is reused if the file is unchanged.
+A file that cannot be read aborts the indexing on all ranks, unless
+`continue_on_error` is set: the files that could not be read are then
+gathered on rank 0 and listed in `ERRORS`.
+With `hash_cache`, only rank 0 opens the hash cache of the staging directory,
+as the cache may be on a filesystem that many nodes cannot lock at once:
+the other ranks send the stat information of the files of each batch to
+rank 0, which replies with their cached hashes, and rank 0 adds the hashes
+of the index to the cache once it is complete.
 '''
-def mpi_index(custom_stagingdir, datapath):    
+def mpi_index(custom_stagingdir, datapath, hash_options=None, resume=False, continue_on_error=False,
+              hash_cache=False):
     comm = MPI.COMM_WORLD
     size = comm.Get_size()
     rank = comm.Get_rank()
@@ -147,9 +183,16 @@ def mpi_index(custom_stagingdir, datapath):
     class States():
         READY = 0
         START = 1
-        DONE = 2
         EXIT = 3
+        MERGE = 4
+        LOOKUP = 5
 
+    if hash_options is None:
+        hash_options = hashing.HashOptions()
+    indexdir = None
+    needs_scan = False
+    cache = None
+    hash_options.hash_cache = None
     if rank == 0:
         stagingdir = check_stagingdir(custom_stagingdir, datapath)
         '''
@@ -158,55 +201,196 @@ def mpi_index(custom_stagingdir, datapath):
         scanner.scan(datapath, stagingdir)
         '''
         indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
+        if not os.path.exists(indexdir):
+            os.makedirs(indexdir)
         deduce_file = os.path.join(indexdir, 'FILEPATHS')
-        if not os.path.exists(deduce_file):
-            scanner.scan(datapath, stagingdir)
+        needs_scan = not os.path.exists(deduce_file)
+        if hash_cache:
+            cache_file = os.path.join(stagingdir, hashcache.HASH_CACHE_DB)
+            try:
+                cache = hashcache.HashCache(cache_file)
+                # for the files hashed by rank 0 itself
+                hash_options.hash_cache = cache_file
+            except sqlite3.Error as e:
+                logger.warning('Could not open the hash cache %s: %s', cache_file, e)
+        prev_indexes = {}
+        if resume:
+            add_journal_indexes(indexdir, hash_options, prev_indexes)
+        else:
+            journal.remove_journals(indexdir)
+    indexdir, needs_scan, use_cache = comm.bcast((indexdir, needs_scan, cache is not None), root=0)
+    # the data path is scanned by all the ranks
+    if needs_scan:
+        mpi_scanner.mpi_scan(comm, datapath, indexdir)
+
+    store = indexstore.IndexStore.create(get_part_file(indexdir, rank),
+                                         {'algorithm': hash_options.algorithm, 'chunk_size': 0})
+    rank_journal = journal.Journal(indexdir, journal.journal_options(hash_options.algorithm))
+    errors = []
+
+    def journal_results(results):
+        '''
+        Journals the results of a rank, and returns them without the files that could not be read.
+        '''
+        for result in results:
+            if isinstance(result, FileError):
+                logger.error('Could not read %s', result)
+                if not continue_on_error:
+                    comm.Abort(1)
+                errors.append(str(result))
+        results = [result for result in results if not isinstance(result, FileError)]
+        rank_journal.add(results)
+        rank_journal.flush()
+        return results
 
-        filelist = []
-        file_num = 0
-        closed_workers = 0
+    if rank == 0:
         num_workers = size - 1
-        indexes = []
-
-        filelist = read_filelist(deduce_file)
-
-        logger.info('Indexing %d files', len(filelist))
+        closed_workers = 0
+        queue = BatchQueue(read_filelist(deduce_file), size)
+
+        logger.info('Indexing %d files', len(queue.filelist))
+        queue_lock = threading.Lock()
+        def next_batch():
+            with queue_lock:
+                batch = queue.next_batch()
+            if batch is None:
+                return None
+            return [(filename, prev_indexes.get(filename)) for filename in batch]
+
+        # only the main thread makes MPI calls and writes the journal and the partial index
+        own_results = Queue()
+        def hash_own_batches():
+            try:
+                for batch in iter(next_batch, None):
+                    own_results.put([try_calculate_hash(datapath, filename, prev_index, hash_options)
+                                     for filename, prev_index in batch])
+            finally:
+                own_results.put(None)
+
+        def add_own_results(block):
+            '''
+            Adds the batches hashed by rank 0 so far, or all of them with `block`,
+            and returns whether rank 0 has hashed all its batches.
+            '''
+            while True:
+                try:
+                    results = own_results.get(block=block)
+                except Empty:
+                    return False
+                if results is None:
+                    return True
+                store.add(journal_results(results))
+
+        hasher = threading.Thread(target=hash_own_batches, daemon=True)
+        hasher.start()
+        hashed = False
         while closed_workers < num_workers:
-            result = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            if use_cache and comm.Iprobe(source=MPI.ANY_SOURCE, tag=States.LOOKUP, status=status):
+                lookups = comm.recv(source=status.Get_source(), tag=States.LOOKUP)
+                comm.send(lookup_cached_hashes(cache, lookups, hash_options.algorithm), dest=status.Get_source(),
+                          tag=States.LOOKUP)
+                continue
+            # a blocking receive would keep polling on the core of the hashing thread
+            if not comm.Iprobe(source=MPI.ANY_SOURCE, tag=States.READY, status=status):
+                hashed = hashed or add_own_results(block=False)
+                time.sleep(POLL_INTERVAL)
+                continue
             source = status.Get_source()
-            tag = status.Get_tag()
-            
-            if tag == States.READY:
-                if file_num < len(filelist):
-                    comm.send(filelist[file_num], dest=source, tag=States.START)
-                    file_num += 1
-                else:
-                    comm.send(None, dest=source, tag=States.EXIT)
-            elif tag == States.DONE:
-                indexes.append(result)
-            elif tag == States.EXIT:
+            comm.recv(source=source, tag=States.READY)
+            batch = next_batch()
+            if batch is None:
+                comm.send(None, dest=source, tag=States.EXIT)
                 closed_workers += 1
-
-        save_indexes(indexdir, indexes)
-
-        return indexdir
+            else:
+                comm.send(batch, dest=source, tag=States.START)
+        if not hashed:
+            add_own_results(block=True)
+        hasher.join()
     else:
+        def add_cached_hashes(batch):
+            '''
+            Looks up the changed files of a batch in the hash cache through rank 0,
+            and returns the batch with their cached hashes as previous entries.
+            '''
+            lookups = []
+            for filename, prev_index in batch:
+                try:
+                    stats = stat_file(os.path.join(datapath, filename))
+                except OSError:
+                    # the error is reported when the file is hashed
+                    continue
+                if prev_index is None or prev_index[1] != stats:
+                    lookups.append((filename, stats))
+            comm.send(lookups, dest=0, tag=States.LOOKUP)
+            cached = comm.recv(source=0, tag=States.LOOKUP)
+            return [(filename, cached.get(filename, prev_index)) for filename, prev_index in batch]
+
         while True:
             comm.send(None, dest=0, tag=States.READY)
-            filename = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
-            tag = status.Get_tag()
-
-            if tag == States.START:
-                index = calculate_hash(datapath, filename)
-                comm.send(index, dest=0, tag=States.DONE)
-            elif tag == States.EXIT:
-                comm.send(None, dest=0, tag=States.EXIT)
+            batch = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == States.EXIT:
                 break
+            if use_cache:
+                batch = add_cached_hashes(batch)
+            store.add(journal_results([try_calculate_hash(datapath, filename, prev_index, hash_options)
+                                       for filename, prev_index in batch]))
+    hashing.log_throughput()
+    rank_journal.close()
+    errors = comm.gather(errors, root=0)
+
+    step = 1
+    while step < size:
+        if rank % (2 * step):
+            store.close()
+            comm.send(None, dest=rank - step, tag=States.MERGE)
+            return None
+        if rank + step < size:
+            comm.recv(source=rank + step, tag=States.MERGE)
+            part_file = get_part_file(indexdir, rank + step)
+            store.merge(part_file)
+            os.remove(part_file)
+        step *= 2
+
+    logger.info('Saving indexes')
+    store.finish()
+    if cache is not None:
+        try:
+            cache.add(((file_hash, stats) for _, file_hash, stats in store.items()), hash_options.algorithm)
+            cache.evict()
+        except sqlite3.Error as e:
+            logger.warning('Could not update the hash cache %s: %s', cache.cache_file, e)
+        cache.close()
+    store.close()
+    install_index(indexdir, get_part_file(indexdir, 0))
+    journal.remove_journals(indexdir)
+    # chunk indexes of earlier runs do not match this index, and all its files were hashed
+    for chunk_index_file in ['CHUNKS.idx', 'CDC.idx', ERRORS_FILE, UNVERIFIED_FILE]:
+        if os.path.exists(os.path.join(indexdir, chunk_index_file)):
+            os.remove(os.path.join(indexdir, chunk_index_file))
+    errors = [error for rank_errors in errors for error in rank_errors]
+    if errors:
+        with open(os.path.join(indexdir, ERRORS_FILE), 'w') as f:
+            f.writelines('{}\n'.format(error) for error in errors)
+        logger.warning('Could not read %d files, listed in %s', len(errors), os.path.join(indexdir, ERRORS_FILE))
+    logger.info('Directory indexing complete')
+
+    return indexdir
 
 def main(args):
     datapath = os.path.abspath(args.datapath)
     stagingdir = args.stagingdir
-    index(datapath, stagingdir)
+    hash_options = hashing.HashOptions(block_size=args.block_size << 20, readahead=not args.no_readahead,
+                                       use_mmap=args.mmap, algorithm=args.algorithm,
+                                       use_xattrs=args.xattrs and xattrs.AVAILABLE)
+    if args.xattrs and not xattrs.AVAILABLE:
+        logger.warning('Extended attributes are not available on this platform, not storing hashes in files')
+    if args.chunk_size:
+        logger.warning('Chunked hashing is not available with MPI, using flat hashes')
+    if args.cdc_size:
+        logger.warning('Content-defined chunks are not recorded with MPI')
+    if args.pipeline or get_scan_options(args):
+        logger.warning('Pipelined indexing is not available with MPI, scan the data path with its options first')
+    index(datapath, stagingdir, hash_options, args.resume, args.continue_on_error, args.hash_cache)
 
 def s_main(args):
     datapath = args['datapath']
@@ -217,6 +401,9 @@ def s_main(args):
     index(datapath, stagingdir)
 
 if __name__ == '__main__':
-   args = {'datapath': sys.argv[1]}
+   # e.g. mpirun -n 4 python -m dacman.core.mpi_indexer <datapath> [<stagingdir>]
+   args = {'datapath': os.path.abspath(sys.argv[1])}
+   if len(sys.argv) > 2:
+      args['stagingdir'] = sys.argv[2]
 
    s_main(args)
@@ -0,0 +1,221 @@
+"""
+`dacman.core.mpi_scanner`
+====================================
+
+.. currentmodule:: dacman.core.mpi_scanner
+
+:platform: Unix, Mac
+:synopsis: MPI module for scanning a data directory in parallel
+
+"""
+
+import os
+import sys
+import shutil
+import time
+
+try:
+    from mpi4py import MPI
+    __AVAIL_MPI__ = True
+except ImportError:
+    __AVAIL_MPI__ = False
+
+from dacman.core.scanner import scandir, ScanFilter, get_ancestors, is_loop
+from dacman.core.utils import get_hash_id
+import dacman.core.utils as dacman_utils
+
+import logging
+
+__modulename__ = 'scanner'
+
+logger = logging.getLogger(__name__)
+
+
+class States():
+    READY = 0
+    START = 1
+    EXIT = 3
+    STEAL = 5
+    WORK = 6
+
+
+def list_dir(item, prefix_len, excludes, follow_symlinks, scan_filter):
+    '''
+    Lists a (path, ancestors) directory, returning its (path, ancestors) subdirectories
+    to scan and the relative paths of its files.
+    '''
+    dirpath, ancestors = item
+    subdirs = []
+    files = []
+    for entry in scandir(dirpath):
+        if entry.name in excludes:
+            continue
+        if entry.is_dir(follow_symlinks=follow_symlinks):
+            if scan_filter.prune(entry.path[prefix_len:]):
+                continue
+            if is_loop(entry, ancestors, follow_symlinks):
+                continue
+            dir_stats = entry.stat(follow_symlinks=follow_symlinks)
+            subdirs.append((entry.path, get_ancestors(dir_stats, ancestors, follow_symlinks)))
+        elif scan_filter.accept(entry.path[prefix_len:], entry):
+            files.append(entry.path[prefix_len:])
+    return subdirs, files
+
+
+def get_part_file(indexdir, rank):
+    return os.path.join(indexdir, 'FILEPATHS.part{}'.format(rank))
+
+'''
+scans a data directory with all the ranks of `comm`, and merges the files
+listed by each rank into the FILEPATHS of the data path on rank 0.
+Rank 0 lists the top-level directories and hands out the second-level
+directories to the other ranks, which scan them depth-first. When the handed
+out directories run out, rank 0 steals half of the directories yet to be listed
+by a busy rank and hands them out to the idle ranks, so that a few large
+subtrees do not leave the other ranks idle.
+Directories are handed out with their ancestors, to detect symbolic link loops.
+'''
+def mpi_scan(comm, datapath, indexdir, symlinks=False, scan_filter=None):
+    size = comm.Get_size()
+    rank = comm.Get_rank()
+    status = MPI.Status()
+    if scan_filter is None:
+        scan_filter = ScanFilter()
+    excludes = {'.dacman': True}
+    prefix_len = len(os.path.join(datapath, ''))
+    nfiles = 0
+    start = time.time()
+
+    with open(get_part_file(indexdir, rank), 'w') as f:
+
+        def scan_dirs(stack, steal=False):
+            count = 0
+            steal_requested = False
+            while stack:
+                if steal and not steal_requested and comm.Iprobe(source=0, tag=States.STEAL):
+                    comm.recv(source=0, tag=States.STEAL)
+                    steal_requested = True
+                # the directories closest to the top of the tree, likely the largest subtrees, are given away
+                if steal_requested and len(stack) > 1:
+                    half = len(stack) // 2
+                    comm.send(stack[:half], dest=0, tag=States.WORK)
+                    del stack[:half]
+                    steal_requested = False
+                subdirs, files = list_dir(stack.pop(), prefix_len, excludes, symlinks, scan_filter)
+                stack.extend(subdirs)
+                for relative_path in files:
+                    f.write('{}\n'.format(relative_path))
+                count += len(files)
+            if steal_requested:
+                comm.send([], dest=0, tag=States.WORK)
+            return count
+
+        if rank == 0:
+            logger.info('Scanning datapath %s using %d MPI ranks', datapath, size)
+            root = (datapath, get_ancestors(os.stat(datapath), frozenset(), symlinks))
+            queue, files = list_dir(root, prefix_len, excludes, symlinks, scan_filter)
+            second_level = []
+            for item in queue:
+                subdirs, dir_files = list_dir(item, prefix_len, excludes, symlinks, scan_filter)
+                second_level.extend(subdirs)
+                files.extend(dir_files)
+            queue = second_level
+            for relative_path in files:
+                f.write('{}\n'.format(relative_path))
+            nfiles += len(files)
+
+            num_workers = size - 1
+            if num_workers == 0:
+                nfiles += scan_dirs(queue)
+            idle = []
+            busy = set()
+            stealing = set()
+            closed_workers = 0
+            while closed_workers < num_workers:
+                dirs = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+                source = status.Get_source()
+                if status.Get_tag() == States.READY:
+                    busy.discard(source)
+                    idle.append(source)
+                else:
+                    stealing.discard(source)
+                    queue.extend(dirs)
+                while idle and queue:
+                    ndirs = max(len(queue) // (2 * num_workers), 1)
+                    dest = idle.pop()
+                    comm.send(queue[-ndirs:], dest=dest, tag=States.START)
+                    del queue[-ndirs:]
+                    busy.add(dest)
+                if idle and not busy and not stealing:
+                    for dest in idle:
+                        comm.send(None, dest=dest, tag=States.EXIT)
+                    closed_workers += len(idle)
+                    idle = []
+                elif idle:
+                    for victim in list(busy - stealing)[:len(idle)]:
+                        comm.send(None, dest=victim, tag=States.STEAL)
+                        stealing.add(victim)
+        else:
+            while True:
+                comm.send(None, dest=0, tag=States.READY)
+                dirs = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+                # a steal request may arrive once this rank is already idle
+                while status.Get_tag() == States.STEAL:
+                    comm.send([], dest=0, tag=States.WORK)
+                    dirs = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+                if status.Get_tag() == States.EXIT:
+                    break
+                nfiles += scan_dirs(dirs, steal=True)
+
+    logger.info('Rank %d listed %d files', rank, nfiles)
+    nfiles = comm.reduce(nfiles, root=0)
+    if rank != 0:
+        return None
+
+    elapsed = time.time() - start
+    logger.info('Scanned %d files in %.2f seconds (%.1f files/s)',
+                nfiles, elapsed, nfiles / elapsed if elapsed > 0 else 0.0)
+    # the part files are complete on all ranks once the counts are reduced
+    paths_file = os.path.join(indexdir, 'FILEPATHS')
+    with open(paths_file + '.tmp', 'w') as f:
+        for part_rank in range(size):
+            with open(get_part_file(indexdir, part_rank)) as part:
+                shutil.copyfileobj(part, f)
+            os.remove(get_part_file(indexdir, part_rank))
+    os.replace(paths_file + '.tmp', paths_file)
+
+    with open(os.path.join(indexdir, 'DATAPATH'), 'w') as f:
+        f.write('{}\n'.format(datapath))
+    meta_file = os.path.join(indexdir, 'METADATA')
+    if not os.path.exists(meta_file):
+        open(meta_file, 'w').close()
+    # detailed metadata and directory snapshots are only recorded by the serial scan
+    for stale_file in ['FILESTATS.npz', 'DIRSTATE']:
+        if os.path.exists(os.path.join(indexdir, stale_file)):
+            os.remove(os.path.join(indexdir, stale_file))
+    logger.info('Directory scan complete')
+
+    return indexdir
+
+
+def scan(datapath, custom_stagingdir=None, symlinks=False, ignorelist=[]):
+    if not __AVAIL_MPI__:
+        logger.error('mpi4py is not installed or not in path')
+        sys.exit()
+    comm = MPI.COMM_WORLD
+    indexdir = None
+    if comm.Get_rank() == 0:
+        if not os.path.isdir(datapath):
+            logger.error('Datapath %s is not a directory!', datapath)
+            comm.Abort(1)
+        stagingdir = custom_stagingdir if custom_stagingdir else dacman_utils.DACMAN_STAGING_LOC
+        indexdir = os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
+        if not os.path.exists(indexdir):
+            os.makedirs(indexdir)
+    indexdir = comm.bcast(indexdir, root=0)
+    return mpi_scan(comm, datapath, indexdir, symlinks, ScanFilter(ignorelist))
+
+
+if __name__ == '__main__':
+    # e.g. mpirun -n 4 python -m dacman.core.mpi_scanner <datapath> [<stagingdir>]
+    scan(os.path.abspath(sys.argv[1]), sys.argv[2] if len(sys.argv) > 2 else None)
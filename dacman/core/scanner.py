@@ -22,34 +22,391 @@ import sys
 import pwd
 import grp
 import fnmatch
+import re
+import time
+import queue
+import functools
+import threading
+import array
+import numpy
 from dacman.core.utils import get_hash_id
 import dacman.core.utils as dacman_utils
 import logging
 
 __modulename__ = 'scanner'
 
+DEFAULT_SCAN_THREADS = 8
+
+'''
+file and directory filters applied by the walkers while scanning,
+so that ignored subtrees are never listed
+'''
+class ScanFilter(object):
+   def __init__(self, ignorelist=[], min_size=None, max_size=None, extensions=None,
+                newer_than=None, older_than=None):
+      self.ignorelist = sorted(ignorelist)
+      self.min_size = min_size
+      self.max_size = max_size
+      self.extensions = sorted(ext.lstrip('.') for ext in extensions) if extensions else None
+      self.newer_than = newer_than
+      self.older_than = older_than
+
+      # all the ignore patterns are compiled into a single regular expression
+      if ignorelist:
+         pattern = '|'.join('(?:{})'.format(fnmatch.translate(p)) for p in ignorelist)
+         self._ignore = re.compile(pattern).match
+      else:
+         self._ignore = None
+      self._extensions = set(self.extensions) if extensions else None
+      now = time.time()
+      self._min_mtime = now - newer_than * 86400 if newer_than is not None else None
+      self._max_mtime = now - older_than * 86400 if older_than is not None else None
+      self.needs_stat = any(opt is not None for opt in [min_size, max_size, newer_than, older_than])
+
+   def __str__(self):
+      options = 'ignore={}'.format(' '.join(self.ignorelist))
+      if self.extensions:
+         options += ' extensions={}'.format(' '.join(self.extensions))
+      for name in ['min_size', 'max_size', 'newer_than', 'older_than']:
+         if getattr(self, name) is not None:
+            options += ' {}={}'.format(name, getattr(self, name))
+      return options
+
+   '''
+   files and directories are ignored by the same rule: an ignore pattern matches
+   their path relative to the data path. A directory is pruned with its contents
+   '''
+   def prune(self, relative_path):
+      return self._ignore is not None and bool(self._ignore(relative_path))
+
+   def accept(self, relative_path, entry):
+      if self._ignore is not None and self._ignore(relative_path):
+         return False
+      if self._extensions is not None and \
+         os.path.splitext(entry.name)[1][1:] not in self._extensions:
+         return False
+      if self.needs_stat:
+         file_stats = entry.stat()
+         if self.min_size is not None and file_stats.st_size < self.min_size:
+            return False
+         if self.max_size is not None and file_stats.st_size > self.max_size:
+            return False
+         if self._min_mtime is not None and file_stats.st_mtime < self._min_mtime:
+            return False
+         if self._max_mtime is not None and file_stats.st_mtime > self._max_mtime:
+            return False
+      return True
+
+"""
+(device, inode) of a directory and of the directories above it, when symbolic links
+are followed: a directory that is one of its own ancestors closes a symbolic link loop
+and is skipped, while a directory reachable through several paths is listed under each
+of them. Without symbolic links, there are no loops and nothing is recorded
+"""
+def get_ancestors(dir_stats, parent_ancestors, follow_symlinks):
+   if not follow_symlinks:
+      return parent_ancestors
+   return parent_ancestors | {(dir_stats.st_dev, dir_stats.st_ino)}
+
+
+def is_loop(entry, ancestors, follow_symlinks):
+   if not follow_symlinks:
+      return False
+   dir_stats = entry.stat(follow_symlinks=True)
+   if (dir_stats.st_dev, dir_stats.st_ino) in ancestors:
+      logging.getLogger(__name__).warning('Skipping %s: symbolic link loop', entry.path)
+      return True
+   return False
+
+"""
+scans a directory tree iteratively, using an explicit stack of directories to list,
+so the cost per entry does not grow with the depth of the tree.
+a directory is yielded before its contents; with `recursive=False` only the entries
+of the top directory are returned.
+symbolic link loops are detected against the ancestors of each directory
+"""
+def scantree(path, excludes, follow_symlinks, scan_filter=None, recursive=True):
+   prefix_len = len(os.path.join(path, ''))
+   stack = [(path, get_ancestors(os.stat(path), frozenset(), follow_symlinks))]
+   while stack:
+      dirpath, ancestors = stack.pop()
+      for entry in scandir(dirpath):
+         if entry.name in excludes:
+            continue
+         if entry.is_dir(follow_symlinks=follow_symlinks):
+            if scan_filter is not None and scan_filter.prune(entry.path[prefix_len:]):
+               continue
+            if recursive:
+               if is_loop(entry, ancestors, follow_symlinks):
+                  continue
+               stack.append((entry.path, get_ancestors(entry.stat(), ancestors, follow_symlinks)))
+            yield entry
+         elif scan_filter is None or scan_filter.accept(entry.path[prefix_len:], entry):
+            yield entry
+
+"""
+scans a directory tree using a bounded pool of threads
+sibling sub-directories are listed concurrently through a shared work queue,
+which hides the metadata-server latency of each `scandir` on parallel filesystems.
+entries are yielded as directory listings complete, so the order is not depth-first
 """
-recursively scans a directory                                                                     
-sub-directories are not returned, only the files inside the subdirectories are returned           
+def parallel_scantree(path, excludes, follow_symlinks, scan_filter=None, nthreads=DEFAULT_SCAN_THREADS):
+   prefix_len = len(os.path.join(path, ''))
+   dirs = queue.Queue()
+   listings = queue.Queue()
+   lock = threading.Lock()
+   # number of directories queued or being listed
+   pending = [1]
+   stop = threading.Event()
+
+   def list_dirs():
+      while True:
+         item = dirs.get()
+         if item is None or stop.is_set():
+            break
+         dirpath, ancestors = item
+         subdirs = []
+         try:
+            listing = []
+            for entry in scandir(dirpath):
+               if entry.name in excludes:
+                  continue
+               if entry.is_dir(follow_symlinks=follow_symlinks):
+                  if scan_filter is not None and scan_filter.prune(entry.path[prefix_len:]):
+                     continue
+                  # the directory stat is cached in the entry for the consumer
+                  dir_stats = entry.stat(follow_symlinks=follow_symlinks)
+                  if is_loop(entry, ancestors, follow_symlinks):
+                     continue
+                  subdirs.append((entry.path, get_ancestors(dir_stats, ancestors, follow_symlinks)))
+               elif scan_filter is not None and not scan_filter.accept(entry.path[prefix_len:], entry):
+                  continue
+               listing.append(entry)
+         except OSError as e:
+            # hand the error over to the consumer, as the serial scan would raise it
+            listing = e
+         with lock:
+            pending[0] += len(subdirs)
+         # a directory is always yielded before its contents
+         listings.put(listing)
+         for subdir in subdirs:
+            dirs.put(subdir)
+         with lock:
+            pending[0] -= 1
+            finished = pending[0] == 0
+         if finished:
+            listings.put(None)
+
+   workers = [threading.Thread(target=list_dirs, daemon=True) for i in range(nthreads)]
+   for worker in workers:
+      worker.start()
+   dirs.put((path, get_ancestors(os.stat(path), frozenset(), follow_symlinks)))
+
+   try:
+      while True:
+         listing = listings.get()
+         if listing is None:
+            break
+         if isinstance(listing, OSError):
+            raise listing
+         for entry in listing:
+            yield entry
+   finally:
+      stop.set()
+      for worker in workers:
+         dirs.put(None)
+      for worker in workers:
+         worker.join()
+
+"""
+rescans a directory tree, listing again only the directories whose mtime or ctime
+changed since the previous scan; the entries of unchanged directories are spliced in
+from the previous file listing and directory snapshot instead of calling `scandir`
 """
-def scantree(path, excludes, follow_symlinks):
-   for entry in scandir(path):
-      if entry.is_dir(follow_symlinks=follow_symlinks) and entry.name not in excludes:
-         yield entry
-         for subentry in scantree(entry.path, excludes, follow_symlinks):
-            yield subentry
-      elif entry.name not in excludes:
-         yield entry
+def incremental_scantree(path, excludes, follow_symlinks, dirstate, filelist, scan_filter=None):
+   logger = logging.getLogger(__name__)
+
+   subdirs = {}
+   for reldir in dirstate:
+      if reldir != '.':
+         subdirs.setdefault(os.path.dirname(reldir) or '.', []).append(reldir)
+   files = {}
+   for relpath in filelist:
+      files.setdefault(os.path.dirname(relpath) or '.', []).append(relpath)
+
+   nlisted = 0
+   nreused = 0
+   root_stats = os.stat(path)
+   stack = [('.', root_stats, get_ancestors(root_stats, frozenset(), follow_symlinks))]
+   while stack:
+      reldir, dir_stats, ancestors = stack.pop()
+      prev_state = dirstate.get(reldir)
+      if prev_state is not None and \
+         prev_state[0] == dir_stats.st_mtime_ns and prev_state[1] == dir_stats.st_ctime_ns:
+         nreused += 1
+         for relpath in files.get(reldir, []):
+            entry = _CachedEntry(os.path.join(path, relpath))
+            if scan_filter is None or scan_filter.accept(relpath, entry):
+               yield entry
+         for subdir in subdirs.get(reldir, []):
+            entry = _CachedEntry(os.path.join(path, subdir), is_dir=True)
+            dir_stats = entry.stat(follow_symlinks=follow_symlinks)
+            stack.append((subdir, dir_stats, get_ancestors(dir_stats, ancestors, follow_symlinks)))
+            yield entry
+      else:
+         nlisted += 1
+         dirpath = path if reldir == '.' else os.path.join(path, reldir)
+         for entry in scandir(dirpath):
+            if entry.name in excludes:
+               continue
+            relpath = entry.name if reldir == '.' else os.path.join(reldir, entry.name)
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+               if scan_filter is not None and scan_filter.prune(relpath):
+                  continue
+               dir_stats = entry.stat(follow_symlinks=follow_symlinks)
+               if is_loop(entry, ancestors, follow_symlinks):
+                  continue
+               stack.append((relpath, dir_stats, get_ancestors(dir_stats, ancestors, follow_symlinks)))
+            elif scan_filter is not None and not scan_filter.accept(relpath, entry):
+               continue
+            yield entry
+
+   logger.info('Listed %d changed directories, reused %d unchanged directories', nlisted, nreused)
+
+
+class _CachedEntry(object):
+   '''
+   stand-in for an `os.DirEntry` that is reused from a previous scan
+   '''
+   def __init__(self, path, is_dir=False):
+      self.path = path
+      self.name = os.path.basename(path)
+      self._is_dir = is_dir
+      self._stat = None
+
+   def is_dir(self, follow_symlinks=True):
+      return self._is_dir
+
+   def stat(self, follow_symlinks=True):
+      if self._stat is None:
+         self._stat = os.stat(self.path, follow_symlinks=follow_symlinks)
+      return self._stat
+
+
+'''
+loads the directory snapshot saved by the previous scan,
+as a map of relative directory path to [mtime_ns, ctime_ns, number of entries]
+'''
+def load_dirstate(state_file):
+   dirstate = {}
+   with open(state_file) as f:
+      scan_options = f.readline().rstrip('\n')
+      for line in f:
+         reldir, mtime, ctime, nentries = line.rstrip('\n').rsplit('\t', 3)
+         dirstate[reldir] = [int(mtime), int(ctime), int(nentries)]
+   return scan_options, dirstate
+
+
+def save_dirstate(dirstate, scan_options, state_file):
+   with open(state_file, 'w') as f:
+      f.write('{}\n'.format(scan_options))
+      for reldir, state in dirstate.items():
+         f.write('{}\t{}\t{}\t{}\n'.format(reldir, state[0], state[1], state[2]))
+
+
+@functools.lru_cache(maxsize=None)
+def get_owner(uid):
+   try:
+      return pwd.getpwuid(uid).pw_name
+   except KeyError:
+      # the user does not exist on this system
+      return str(uid)
 
-def scan_only_dir(path, excludes, follow_symlinks):
-   for entry in scandir(path):
-         yield entry
+
+@functools.lru_cache(maxsize=None)
+def get_group(gid):
+   try:
+      return grp.getgrgid(gid).gr_name
+   except KeyError:
+      return str(gid)
+
+
+'''
+compact columnar record of the detailed filesystem metadata of a scan:
+row `i` of each column belongs to the `i`-th path in FILEPATHS,
+and owner/group names are stored once per distinct uid/gid
+'''
+class FileStats(object):
+   COLUMNS = [('uid', 'I'), ('gid', 'I'), ('mode', 'I'), ('size', 'Q'),
+              ('mtime', 'q'), ('inode', 'Q'), ('device', 'Q')]
+
+   def __init__(self):
+      self.columns = {name: array.array(typecode) for name, typecode in self.COLUMNS}
+      self.owners = {}
+      self.groups = {}
+      self._rows = {}
+
+   def append(self, file_stats):
+      columns = self.columns
+      columns['uid'].append(file_stats.st_uid)
+      columns['gid'].append(file_stats.st_gid)
+      columns['mode'].append(file_stats.st_mode)
+      columns['size'].append(file_stats.st_size)
+      columns['mtime'].append(file_stats.st_mtime_ns)
+      columns['inode'].append(file_stats.st_ino)
+      columns['device'].append(file_stats.st_dev)
+
+   def save(self, stats_file):
+      data = {name: numpy.frombuffer(self.columns[name], dtype=typecode)
+              for name, typecode in self.COLUMNS}
+      # user and group names are only resolved for the distinct ids
+      uids = numpy.unique(data['uid'])
+      gids = numpy.unique(data['gid'])
+      data['owner_ids'] = uids
+      data['owner_names'] = numpy.array([get_owner(int(uid)) for uid in uids], dtype=str)
+      data['group_ids'] = gids
+      data['group_names'] = numpy.array([get_group(int(gid)) for gid in gids], dtype=str)
+      with open(stats_file, 'wb') as f:
+         numpy.savez(f, **data)
+
+   @classmethod
+   def load(cls, stats_file, paths_file):
+      filestats = cls()
+      if not (os.path.exists(stats_file) and os.path.exists(paths_file)):
+         return filestats
+      with numpy.load(stats_file) as data:
+         for name, typecode in cls.COLUMNS:
+            filestats.columns[name] = data[name]
+         filestats.owners = dict(zip(data['owner_ids'].tolist(), data['owner_names'].tolist()))
+         filestats.groups = dict(zip(data['group_ids'].tolist(), data['group_names'].tolist()))
+      with open(paths_file) as f:
+         filestats._rows = {line.rstrip('\n'): row for row, line in enumerate(f)}
+      return filestats
+
+   def __len__(self):
+      return len(self._rows)
+
+   def __contains__(self, filepath):
+      return filepath in self._rows
+
+   '''
+   metadata that is compared between two versions of a file, as recorded in METADATA;
+   modification time, inode and device differ between copies, so they are left out
+   '''
+   def __getitem__(self, filepath):
+      row = self._rows[filepath]
+      columns = self.columns
+      return (self.owners[int(columns['uid'][row])], self.groups[int(columns['gid'][row])],
+              int(columns['size'][row]))
+
+   def mode(self, filepath):
+      return int(self.columns['mode'][self._rows[filepath]])
 
 
 def get_metadata(entry):
    file_stats = entry.stat()
-   owner = pwd.getpwuid(file_stats.st_uid).pw_name
-   group = grp.getgrgid(file_stats.st_gid).gr_name
+   owner = get_owner(file_stats.st_uid)
+   group = get_group(file_stats.st_gid)
    size = file_stats.st_size
    metadata = {'owner': owner, 'group': group, 'size': size}
    '''
@@ -64,7 +421,26 @@ def get_metadata(entry):
 '''
 scans a data directory
 '''
-def scan(datapath, custom_stagingdir=None, nonrecursive=False, symlinks=False, details=False, ignorelist=[]):
+def scan(datapath, custom_stagingdir=None, nonrecursive=False, symlinks=False, details=False, ignorelist=[],
+         nthreads=1, incremental=False, min_size=None, max_size=None, extensions=None,
+         newer_than=None, older_than=None):
+   for filepath in iter_scan(datapath, custom_stagingdir, nonrecursive, symlinks, details, ignorelist,
+                             nthreads, incremental, min_size, max_size, extensions, newer_than, older_than):
+      pass
+
+   if not custom_stagingdir:
+      stagingdir = dacman_utils.DACMAN_STAGING_LOC
+   else:
+      stagingdir = custom_stagingdir
+   return os.path.join(stagingdir, 'indexes', get_hash_id(datapath))
+
+'''
+scans a data directory, yielding the relative path of each file as soon as it is listed,
+so that the files can be processed while the scan is still in progress
+'''
+def iter_scan(datapath, custom_stagingdir=None, nonrecursive=False, symlinks=False, details=False, ignorelist=[],
+              nthreads=1, incremental=False, min_size=None, max_size=None, extensions=None,
+              newer_than=None, older_than=None):
    logger = logging.getLogger(__name__)
 
    if not os.path.exists(datapath):
@@ -121,85 +497,107 @@ def scan(datapath, custom_stagingdir=None, nonrecursive=False, symlinks=False, d
    dump(metainfo, meta_path)
    '''
    """
-   scan_funcs = {False: scantree, True: scan_only_dir}
-   scan_fn = scan_funcs[nonrecursive]
-
    paths_file = os.path.join(indexdir, 'FILEPATHS')    
    meta_file = os.path.join(indexdir, 'METADATA')
-   # open the metadata file
-   mf = open(meta_file, 'w')
+   stats_file = os.path.join(indexdir, 'FILESTATS.npz')
+   state_file = os.path.join(indexdir, 'DIRSTATE')
+   scan_filter = ScanFilter(ignorelist, min_size, max_size, extensions, newer_than, older_than)
+   scan_options = '# symlinks={} {}'.format(symlinks, scan_filter)
+
+   if incremental and scan_filter.needs_stat:
+      # files skipped by size or age in an unchanged directory may qualify now
+      logger.warning('Size and age filters require a full rescan, rescanning all directories')
+      incremental = False
+
+   if nonrecursive:
+      scan_fn = functools.partial(scantree, recursive=False)
+   elif incremental and os.path.exists(state_file) and os.path.exists(paths_file):
+      prev_options, prev_dirstate = load_dirstate(state_file)
+      if prev_options == scan_options:
+         logger.info('Rescanning only the directories changed since the last scan')
+         with open(paths_file) as f:
+            prev_filelist = [line.rstrip('\n') for line in f]
+         scan_fn = functools.partial(incremental_scantree, dirstate=prev_dirstate, filelist=prev_filelist)
+      else:
+         logger.warning('Scan options differ from the last scan, rescanning all directories')
+         incremental = False
+   elif incremental:
+      logger.info('No previous directory snapshot found, rescanning all directories')
+      incremental = False
+
+   if not (nonrecursive or incremental):
+      if nthreads > 1:
+         logger.info('Scanning subdirectories in parallel using %d threads', nthreads)
+         scan_fn = functools.partial(parallel_scantree, nthreads=nthreads)
+      else:
+         scan_fn = scantree
+
+   # the metadata file also holds user-defined metadata, so it is only rewritten with the details
+   if details or not os.path.exists(meta_file):
+      open(meta_file, 'w').close()
+   filestats = FileStats()
 
    if nonrecursive:
       logger.info('Ignoring subdirectory scans: scanning files only in the present directory')
 
-   '''
-   if there is no file to ignore
-   '''
-   if len(ignorelist) == 0:
-      with open(paths_file, 'w') as f:
-         for entry in scan_fn(datapath, excluded_dirs, follow_symlinks):
-            filepath = entry.path
-            relative_path = os.path.relpath(filepath, datapath)
+   nentries = 0
+   start = time.time()
+   # snapshot of the scanned directories, used by incremental rescans
+   root_stats = os.stat(datapath)
+   dirstate = {'.': [root_stats.st_mtime_ns, root_stats.st_ctime_ns, 0]}
+
+   prefix_len = len(os.path.join(datapath, ''))
+
+   with open(paths_file, 'w') as f, open(meta_file, 'a') as mf:
+      for entry in scan_fn(datapath, excluded_dirs, follow_symlinks, scan_filter=scan_filter):
+         nentries += 1
+         relative_path = entry.path[prefix_len:]
+         if entry.is_dir(follow_symlinks=symlinks):
+            if nonrecursive:
+               continue
+            dir_stats = entry.stat(follow_symlinks=symlinks)
+            dirstate[relative_path] = [dir_stats.st_mtime_ns, dir_stats.st_ctime_ns, 0]
+            dirstate[os.path.dirname(relative_path) or '.'][2] += 1
+         else:
             '''
             only save the file paths and not dir paths
             '''
-            if not entry.is_dir(follow_symlinks=symlinks):
-               line = '{}\n'.format(relative_path)
-               f.write(line)
-               if details:
-                  file_stats = entry.stat()
-                  owner = pwd.getpwuid(file_stats.st_uid).pw_name
-                  group = grp.getgrgid(file_stats.st_gid).gr_name
-                  size = file_stats.st_size
-                  #mtime = datetime.fromtimestamp(file_stats.st_mtime).strftime("%d %B %Y %I:%M:%S")
-                  # File modification time doesn't make sense here, because we compare two versions
-                  #mtime = file_stats.st_mtime
-                  metadata = relative_path+':owner='+owner+',group='+group+ ',size='+str(size)+'\n'
-                  #metadata = relative_path+':owner='+owner+',group='+group+\
-                  #    ',size='+str(size)+',mtime='+str(mtime)+'\n'
-                  mf.write(metadata)
-   else:
-      with open(paths_file, 'w') as f:
-         for entry in scan_fn(datapath, excluded_dirs, follow_symlinks):
-            filepath = entry.path
-            relative_path = os.path.relpath(filepath, datapath)
-            ignore_file = False
-            for ignore_pattern in ignorelist:
-               if fnmatch.fnmatch(relative_path, ignore_pattern):
-                  ignore_file = True
-                  break
-            '''
-            only save the file paths and not dir paths
-            '''
-            if not (ignore_file or entry.is_dir(follow_symlinks=symlinks)):
-               line = '{}\n'.format(relative_path)
-               f.write(line)
-               if details:
-                  file_stats = entry.stat()
-                  owner = pwd.getpwuid(file_stats.st_uid).pw_name
-                  group = grp.getgrgid(file_stats.st_gid).gr_name
-                  size = file_stats.st_size
-                  #mtime = datetime.fromtimestamp(file_stats.st_mtime).strftime("%d %B %Y %I:%M:%S")
-                  #mtime = file_stats.st_mtime
-                  metadata = relative_path+':owner='+owner+',group='+group+ ',size='+str(size)+'\n'
-                  #metadata = relative_path+':owner='+owner+',group='+group+\
-                  #    ',size='+str(size)+',mtime='+str(mtime)+'\n'
-                  mf.write(metadata)
+            dirstate[os.path.dirname(relative_path) or '.'][2] += 1
+            line = '{}\n'.format(relative_path)
+            f.write(line)
+            if details:
+               file_stats = entry.stat()
+               filestats.append(file_stats)
+               mf.write('{}:owner={},group={},size={}\n'.format(relative_path, get_owner(file_stats.st_uid),
+                                                                get_group(file_stats.st_gid), file_stats.st_size))
+            yield relative_path
+
+   elapsed = time.time() - start
+   logger.info('Scanned %d entries in %.2f seconds (%.1f entries/s)',
+               nentries, elapsed, nentries / elapsed if elapsed > 0 else 0.0)
 
    logger.info('Saving path metadata and directory scan information')
 
+   if nonrecursive:
+      # a partial listing cannot be the base of an incremental rescan
+      if os.path.exists(state_file):
+         os.remove(state_file)
+   else:
+      save_dirstate(dirstate, scan_options, state_file)
+
    basepath_file = os.path.join(indexdir, 'DATAPATH')
    with open(basepath_file, 'w') as f:
       f.write('{}\n'.format(datapath))
 
-   # close the metadata file
-   mf.close()
+   if details:
+      filestats.save(stats_file)
+   elif os.path.exists(stats_file):
+      # the rows would no longer match the new file listing
+      os.remove(stats_file)
 
    #cprint(__modulename__, 'Scan complete')
    logger.info('Directory scan complete')
 
-   return indexdir
-
 def dump(metainfo, meta_path):
    with open(meta_path, 'w') as f:
       yaml.dump(metainfo, f, default_flow_style=False)
@@ -211,11 +609,14 @@ def main(args):
    nonrecursive = args.nonrecursive
    symlinks = args.symlinks
    details = args.metadetails
+   nthreads = args.threads
+   incremental = args.incremental
    if args.ignore is None:
       ignorelist = []
    else:
       ignorelist = args.ignore   
-   scan(datapath, stagingdir, nonrecursive, symlinks, details, ignorelist)
+   scan(datapath, stagingdir, nonrecursive, symlinks, details, ignorelist, nthreads, incremental,
+        args.min_size, args.max_size, args.extensions, args.newer_than, args.older_than)
 
 def s_main(args):
    datapath = args['datapath']
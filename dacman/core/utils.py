@@ -21,8 +21,10 @@ import logging
 DACMAN_STAGING_LOC = os.path.join(os.getenv('HOME'), '.dacman/data')
 
 def dump_yaml(data, filepath):
-    with open(filepath, 'w') as f:
+    # written aside and renamed, so that an interrupted write does not leave the file truncated
+    with open(filepath + '.tmp', 'w') as f:
         yaml.dump(data, f, default_flow_style=False)
+    os.replace(filepath + '.tmp', filepath)
     
 
 def update_yaml(data, filepath):
@@ -0,0 +1,62 @@
+"""
+`dacman.core.xattrs`
+====================================
+
+.. currentmodule:: dacman.core.xattrs
+
+:platform: Unix, Mac
+:synopsis: Module for storing the hashes of files in their extended attributes
+
+"""
+
+import os
+
+import logging
+
+__modulename__ = 'xattrs'
+
+logger = logging.getLogger(__name__)
+
+# the hash of a file with an algorithm is stored in the attribute named after the algorithm
+XATTR_PREFIX = 'user.dacman.'
+
+# extended attributes are only available through the os module on Linux
+AVAILABLE = hasattr(os, 'getxattr') and hasattr(os, 'setxattr')
+
+
+def xattr_name(algorithm):
+    return XATTR_PREFIX + algorithm
+
+
+def read_hash(file_path, algorithm, stats):
+    '''
+    Returns the hash stored in the extended attributes of a file, if it
+    was calculated when the file had the same size and modification time
+    as in its (size, mtime_ns, inode, device) `stats`, or `None`.
+    Filesystems without extended attributes have no stored hashes.
+    '''
+    try:
+        value = os.getxattr(file_path, xattr_name(algorithm)).decode('ascii')
+    except (OSError, UnicodeDecodeError):
+        return None
+    fields = value.split()
+    if len(fields) != 3 or fields[1:] != [str(stats[0]), str(stats[1])]:
+        return None
+    return fields[0]
+
+
+def write_hash(fd, algorithm, file_hash, stats):
+    '''
+    Stores the hash of an open file in its extended attributes, as
+    `<hash> <size> <mtime_ns>`, along with the size and modification time
+    of the file it was calculated for. Files that cannot take extended
+    attributes, e.g. on read-only filesystems or files of other users,
+    are left as they are.
+    '''
+    value = '{} {} {}'.format(file_hash, stats[0], stats[1]).encode('ascii')
+    try:
+        os.setxattr(fd, xattr_name(algorithm), value)
+        return True
+    except OSError as e:
+        logger.debug('Could not store the hash of a file in its extended attributes: %s', e)
+        return False
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Compares the indexing time of the process-pool (`python`), thread-pool
+(`threads`) and `asyncio` managers on synthetic datasets of many small files
+and of a few large files. Every run rehashes all files, and the page cache is
+warmed by a first run, so that the timings compare the managers rather than
+the storage.
+
+    python benchmark_index.py [--small-files N] [--large-files N] [--large-size MiB] [--threads N ...]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from dacman.core import indexer, scanner
+
+
+def make_dataset(datapath, nfiles, size):
+    block = os.urandom(min(size, 1 << 20))
+    for i in range(nfiles):
+        subdir = os.path.join(datapath, 'dir{:03d}'.format(i % 100))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, 'file{:06d}'.format(i)), 'wb') as f:
+            for offset in range(0, size, len(block)):
+                f.write(block[:size - offset])
+
+
+def time_index(datapath, stagingdir, manager, nthreads):
+    start = time.time()
+    indexer.index(datapath, stagingdir, manager=manager, verify=True, nthreads=nthreads)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the local indexing managers')
+    parser.add_argument('--small-files', type=int, default=20000, help='number of 4 KiB files')
+    parser.add_argument('--large-files', type=int, default=8, help='number of large files')
+    parser.add_argument('--large-size', type=int, default=128, help='size of the large files (in MiB)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[4, 8, 16, 32],
+                        help='numbers of threads to benchmark')
+    parser.add_argument('--dir', help='directory where the datasets are created (a temporary directory by default)')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        datasets = [('small', args.small_files, 4 << 10), ('large', args.large_files, args.large_size << 20)]
+        print('{:8} {:14} {:>10} {:>10}'.format('dataset', 'manager', 'seconds', 'MB/s'))
+        for name, nfiles, size in datasets:
+            datapath = os.path.join(workdir, name)
+            stagingdir = os.path.join(workdir, 'stage-' + name)
+            make_dataset(datapath, nfiles, size)
+            scanner.scan(datapath, stagingdir)
+            mbytes = nfiles * size / float(1 << 20)
+            time_index(datapath, stagingdir, 'python', None)
+            runs = [('processes', 'python', None)] + \
+                   [('threads={}'.format(n), 'threads', n) for n in args.threads] + \
+                   [('asyncio', 'asyncio', None)]
+            for label, manager, nthreads in runs:
+                seconds = time_index(datapath, stagingdir, manager, nthreads)
+                print('{:8} {:14} {:10.2f} {:10.1f}'.format(name, label, seconds, mbytes / seconds))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -49,6 +49,7 @@ def get_extras_require():
     d['csv'] = ['pandas']
 
     d['hpc'] = ['mpi4py']
+    d['xxhash'] = ['xxhash']
 
     return d
 
@@ -0,0 +1,70 @@
+"""
+Checks the content-defined chunks recorded for the files of a data directory.
+"""
+
+import os
+import random
+
+import pytest
+
+from dacman.core import chunking
+from dacman.core import comparator
+from dacman.core import hashing
+from dacman.core import indexer
+
+AVG_SIZE = 16 << 10
+
+
+def get_chunks(data, block_size):
+    chunker = chunking.ContentChunker(AVG_SIZE)
+    for offset in range(0, len(data), block_size):
+        chunker.update(memoryview(data)[offset:offset + block_size])
+    return chunker.finish()
+
+
+@pytest.fixture
+def data():
+    return random.Random(0).getrandbits(8 << 20).to_bytes(1 << 20, 'little')
+
+
+def test_chunks_do_not_depend_on_block_size(data):
+    chunks = get_chunks(data, 1 << 20)
+
+    assert get_chunks(data, 1000) == get_chunks(data, 65536) == chunks
+    assert sum(length for length, chunk_hash in chunks) == len(data)
+    assert all(AVG_SIZE // 4 <= length <= AVG_SIZE * 4 for length, chunk_hash in chunks[:-1])
+
+
+def test_insertion_only_changes_nearby_chunks(data):
+    middle = len(data) // 2
+    new_data = data[:middle] + b'inserted' * 100 + data[middle:]
+
+    nbytes = chunking.changed_bytes(get_chunks(data, 65536), get_chunks(new_data, 65536))
+
+    assert 800 <= nbytes <= 3 * 4 * AVG_SIZE
+
+
+def test_compare_reports_changed_fraction_and_shared_chunks(tmp_path, data):
+    old_datapath = tmp_path / 'old'
+    new_datapath = tmp_path / 'new'
+    old_datapath.mkdir()
+    new_datapath.mkdir()
+    (old_datapath / 'data.bin').write_bytes(data)
+    (new_datapath / 'data.bin').write_bytes(data[:1000] + b'edited' + data[1000:])
+    (new_datapath / 'copy.bin').write_bytes(data[len(data) // 2:])
+    stagingdir = str(tmp_path / 'stage')
+    hash_options = hashing.HashOptions(cdc_size=AVG_SIZE)
+    indexer.index(str(old_datapath), stagingdir, hash_options=hash_options)
+    indexer.index(str(new_datapath), stagingdir, hash_options=hash_options)
+
+    change_id = comparator.compare(str(old_datapath), str(new_datapath), stagingdir)
+
+    change_dir = os.path.join(stagingdir, 'cache', change_id)
+    with open(os.path.join(change_dir, 'MODIFIED_FRACTION')) as f:
+        filepath, fraction = f.read().split(': ')
+    assert filepath == 'data.bin' and 0 < float(fraction) < 0.1
+    with open(os.path.join(change_dir, 'SHARED_CHUNKS')) as f:
+        filepath, shared = f.read().split(': ')
+    shared_bytes, old_filepath = shared.split()
+    assert filepath == 'copy.bin' and old_filepath == 'data.bin'
+    assert len(data) // 2 - 4 * AVG_SIZE <= int(shared_bytes) <= len(data) // 2
@@ -0,0 +1,101 @@
+"""
+Checks the changes found between two versions of a data directory.
+"""
+
+import os
+
+import pytest
+
+from dacman.core import comparator
+from dacman.core import indexer
+from dacman.core import indexstore
+from dacman.core.compactindex import CompactIndex
+
+
+@pytest.fixture
+def datapaths(tmp_path):
+    old_datapath = tmp_path / 'old'
+    new_datapath = tmp_path / 'new'
+    for root in [old_datapath, new_datapath]:
+        (root / 'a').mkdir(parents=True)
+        (root / 'same.txt').write_text('same')
+        (root / 'a/empty').write_text('')
+    middle = b'0' * 5000
+    (old_datapath / 'middle.bin').write_bytes(b'head' + middle + b'tail')
+    (new_datapath / 'middle.bin').write_bytes(b'head' + middle.replace(b'0', b'1', 1) + b'tail')
+    (old_datapath / 'resized.txt').write_text('short')
+    (new_datapath / 'resized.txt').write_text('much longer')
+    (old_datapath / 'moved.txt').write_text('moved contents')
+    (new_datapath / 'a/renamed.txt').write_text('moved contents')
+    (old_datapath / 'name.txt').write_text('old name contents')
+    (new_datapath / 'a/name.txt').write_text('new name contents')
+    (old_datapath / 'deleted.txt').write_text('deleted')
+    (new_datapath / 'added.txt').write_text('added')
+    return old_datapath, new_datapath
+
+
+def read_changes(stagingdir, change_id):
+    changes = {}
+    for name in ['UNCHANGED', 'ADDED', 'DELETED', 'MODIFIED', 'METACHANGE']:
+        with open(os.path.join(stagingdir, 'cache', change_id, name)) as f:
+            changes[name] = sorted(line.strip() for line in f)
+    return changes
+
+
+def test_staged_comparison_matches_indexed_comparison(datapaths, tmp_path, monkeypatch):
+    old_datapath, new_datapath = str(datapaths[0]), str(datapaths[1])
+    indexed = read_changes(str(tmp_path / 'indexed'),
+                           comparator.compare(old_datapath, new_datapath, str(tmp_path / 'indexed')))
+    # the partial hashes of middle.bin are the same
+    monkeypatch.setattr(comparator, 'PARTIAL_HASH_SIZE', 4)
+
+    staged = read_changes(str(tmp_path / 'staged'),
+                          comparator.compare(old_datapath, new_datapath, str(tmp_path / 'staged'), staged=True))
+
+    assert staged == indexed
+    assert staged['UNCHANGED'] == ['a/empty', 'same.txt']
+    assert staged['MODIFIED'] == ['a/name.txt: name.txt', 'middle.bin: middle.bin', 'resized.txt: resized.txt']
+    assert staged['METACHANGE'] == ['a/renamed.txt: moved.txt']
+    assert staged['ADDED'] == ['added.txt'] and staged['DELETED'] == ['deleted.txt']
+
+
+def test_staged_comparison_only_reads_files_of_the_same_size(datapaths, monkeypatch):
+    monkeypatch.setattr(comparator, 'PARTIAL_HASH_SIZE', 4)
+    comparison = comparator.StagedComparison(str(datapaths[0]), str(datapaths[1]))
+    comparison.stat('old', ['resized.txt', 'middle.bin'])
+    comparison.stat('new', ['resized.txt', 'middle.bin'])
+
+    same = comparison.same_contents([('resized.txt', 'resized.txt'), ('middle.bin', 'middle.bin')])
+
+    assert same == set()
+    assert comparison.bytes_read == 2 * (8 + os.path.getsize(str(datapaths[0] / 'middle.bin')))
+
+
+def test_compact_index_holds_paths_and_hashes(datapaths, tmp_path):
+    indexdir = indexer.index(str(datapaths[1]), str(tmp_path / 'stage'))
+    index_file = os.path.join(indexdir, 'INDEX.db')
+    path_index = indexer.read_path_index(index_file)
+
+    index = CompactIndex.load(index_file)
+
+    assert [index.path(i) for i in range(len(index))] == sorted(path_index)
+    assert [index.digests[i] for i in range(len(index))] == \
+        [index.digest(path_index[filepath]) for filepath in sorted(path_index)]
+    assert sorted(index.directories.paths) == ['', 'a']
+    # MD5 digests, name keys, offsets and directory ids take 32 bytes per file
+    assert index.nbytes == 32 * len(index) + 4 + sum(len(os.path.basename(filepath)) for filepath in path_index)
+
+
+def test_modified_files_without_stats_have_no_ranges(tmp_path):
+    for version, chunk_hashes in [('old', 'h0 h1 h2'), ('new', 'h0 x1 h2')]:
+        (tmp_path / version).mkdir()
+        (tmp_path / version / 'CHUNKS.idx').write_text('sized.bin: {}\nimported.bin: {}\n'.format(
+            chunk_hashes, chunk_hashes))
+    index_file = str(tmp_path / 'new' / 'INDEX.db')
+    with indexstore.IndexStore.create(index_file, {}) as store:
+        store.add([('sized.bin', 'tree', (25, 0, 0, 0)), ('imported.bin', 'tree', None)])
+
+    ranges = comparator.get_modified_ranges({'sized.bin': 'sized.bin', 'imported.bin': 'imported.bin'},
+                                            str(tmp_path / 'old'), str(tmp_path / 'new'), index_file, 10)
+
+    assert ranges == {'sized.bin': '10-20'}
@@ -0,0 +1,400 @@
+"""
+Checks the indexes created for a data directory.
+"""
+
+import os
+import time
+import errno
+import hashlib
+
+import pytest
+
+from dacman.core import indexer
+from dacman.core import hashing
+from dacman.core import indexstore
+from dacman.core import hashcache
+from dacman.core import journal
+
+
+@pytest.fixture
+def datapath(tmp_path):
+    root = tmp_path / 'data'
+    for subdir in ['a/b', 'c']:
+        (root / subdir).mkdir(parents=True)
+    for name in ['top.txt', 'a/x.txt', 'a/b/y.h5', 'c/x.txt', 'c/empty']:
+        (root / name).write_text(name if name != 'c/empty' else '')
+    return root
+
+
+@pytest.fixture
+def stagingdir(tmp_path):
+    return tmp_path / 'stage'
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    '''
+    Paths of the files hashed, in the calling process: indexing with the
+    default multiprocessing manager hashes them in forked workers.
+    '''
+    hash_file = hashing.hash_file
+    paths = []
+
+    def counted_hash_file(f, *args, **kwargs):
+        paths.append(f.name)
+        return hash_file(f, *args, **kwargs)
+
+    monkeypatch.setattr(hashing, 'hash_file', counted_hash_file)
+    return paths
+
+
+def read_path_index(indexdir):
+    return indexer.read_path_index('{}/INDEX.db'.format(indexdir))
+
+
+def test_index_hashes_all_files(datapath, stagingdir):
+    indexdir = indexer.index(str(datapath), str(stagingdir))
+
+    path_index = read_path_index(indexdir)
+    assert sorted(path_index) == ['a/b/y.h5', 'a/x.txt', 'c/empty', 'c/x.txt', 'top.txt']
+    assert path_index['c/empty'] == 'd41d8cd98f00b204e9800998ecf8427e'
+
+
+def test_pipelined_index_matches_default_index(datapath, stagingdir, tmp_path):
+    expected = read_path_index(indexer.index(str(datapath), str(tmp_path / 'default')))
+
+    indexdir = indexer.index(str(datapath), str(stagingdir), pipeline=True)
+
+    assert read_path_index(indexdir) == expected
+    with open('{}/FILEPATHS'.format(indexdir)) as f:
+        assert sorted(line.strip() for line in f) == sorted(expected)
+
+
+def test_pipelined_index_scans_with_the_scan_options(datapath, stagingdir):
+    indexdir = indexer.index(str(datapath), str(stagingdir), pipeline=True,
+                             scan_options={'ignorelist': ['c'], 'details': True})
+
+    assert sorted(read_path_index(indexdir)) == ['a/b/y.h5', 'a/x.txt', 'top.txt']
+    assert os.path.exists('{}/FILESTATS.npz'.format(indexdir))
+
+
+@pytest.mark.parametrize('manager,pipeline', [('python', True), ('python', False), ('threads', False),
+                                              ('asyncio', False)])
+def test_failed_index_leaves_only_its_journal(datapath, stagingdir, monkeypatch, manager, pipeline):
+    calculate_hash = indexer.calculate_hash
+
+    def failing_hash(datapath, filename, prev_index=None, hash_options=None):
+        if filename == 'c/x.txt':
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), filename)
+        return calculate_hash(datapath, filename, prev_index, hash_options)
+
+    monkeypatch.setattr(indexer, 'calculate_hash', failing_hash)
+    with pytest.raises(PermissionError):
+        indexer.index(str(datapath), str(stagingdir), manager=manager, pipeline=pipeline)
+
+    indexdir = os.path.join(str(stagingdir), 'indexes', os.listdir(str(stagingdir / 'indexes'))[0])
+    assert not [name for name in os.listdir(indexdir) if name.endswith('.tmp')]
+    assert any(name.startswith('INDEX.journal.') for name in os.listdir(indexdir))
+
+
+@pytest.mark.parametrize('hash_options', [None, hashing.HashOptions(block_size=1024, chunk_size=4096)])
+def test_threaded_index_matches_default_index(datapath, stagingdir, tmp_path, hash_options):
+    (datapath / 'large').write_bytes(os.urandom(10000))
+    expected = read_path_index(indexer.index(str(datapath), str(tmp_path / 'default'), hash_options=hash_options))
+
+    indexdir = indexer.index(str(datapath), str(stagingdir), manager='threads', hash_options=hash_options,
+                             nthreads=4)
+
+    assert read_path_index(indexdir) == expected
+
+
+def test_asyncio_index_matches_default_index(datapath, stagingdir, tmp_path):
+    expected = read_path_index(indexer.index(str(datapath), str(tmp_path / 'default')))
+
+    indexdir = indexer.index(str(datapath), str(stagingdir), manager='asyncio', concurrency=2)
+
+    assert read_path_index(indexdir) == expected
+
+
+def test_asyncio_index_reads_files_without_read_ahead(datapath, stagingdir, monkeypatch):
+    (datapath / 'large.bin').write_bytes(os.urandom(5000))
+    monkeypatch.setattr(hashing, '_update_readahead', None)
+
+    indexdir = indexer.index(str(datapath), str(stagingdir), manager='asyncio',
+                             hash_options=hashing.HashOptions(block_size=1024))
+
+    assert read_path_index(indexdir)['large.bin'] == hashlib.md5((datapath / 'large.bin').read_bytes()).hexdigest()
+
+
+def test_reindex_reuses_hashes_of_unchanged_files(datapath, stagingdir):
+    before = read_path_index(indexer.index(str(datapath), str(stagingdir)))
+    # same size and modification time, but different content
+    top = datapath / 'top.txt'
+    top_stats = top.stat()
+    top.write_text('TOP.TXT')
+    os.utime(str(top), ns=(top_stats.st_atime_ns, top_stats.st_mtime_ns))
+    (datapath / 'a/x.txt').write_text('modified')
+
+    reused = read_path_index(indexer.index(str(datapath), str(stagingdir)))
+    verified = read_path_index(indexer.index(str(datapath), str(stagingdir), verify=True))
+
+    assert reused['top.txt'] == before['top.txt']
+    assert verified['top.txt'] != before['top.txt']
+    assert reused['a/x.txt'] == verified['a/x.txt'] != before['a/x.txt']
+
+
+def test_index_store_looks_up_files_by_path_hash_and_name(datapath, stagingdir):
+    indexdir = indexer.index(str(datapath), str(stagingdir))
+
+    with indexstore.IndexStore('{}/INDEX.db'.format(indexdir)) as store:
+        x_hash = store.get_hash('c/x.txt')
+        assert len(store) == 5
+        assert store.get('a/x.txt')[1][0] == len('a/x.txt')
+        assert store.get('missing') is None
+        assert store.paths_with_name('x.txt') == ['a/x.txt', 'c/x.txt']
+        assert store.paths_with_hash(x_hash) == ['c/x.txt']
+        assert store.has_hash(x_hash) and not store.has_hash('0' * 32)
+
+
+def test_index_store_keeps_large_inode_numbers(tmp_path):
+    stats = (10, -1000, (1 << 64) - 1, 1 << 63)
+    with indexstore.IndexStore.create(str(tmp_path / 'INDEX.db'), {'algorithm': 'md5'}) as store:
+        store.add([('file', 'hash', stats), ('nostats', 'hash', None)])
+        store.finish()
+
+    with indexstore.IndexStore(str(tmp_path / 'INDEX.db')) as store:
+        assert store.get('file') == ('hash', stats)
+        assert store.get('nostats') == ('hash', None)
+        assert store.options() == {'algorithm': 'md5'}
+
+
+@pytest.mark.parametrize('hash_options', [
+    hashing.HashOptions(block_size=1024, readahead=False),
+    hashing.HashOptions(block_size=1024, readahead=True),
+    hashing.HashOptions(block_size=1024, use_mmap=True),
+])
+@pytest.mark.parametrize('size', [0, 1000, 1024, 5000, 20480])
+def test_hashing_modes_match_md5(tmp_path, hash_options, size):
+    data = os.urandom(size)
+    (tmp_path / 'file').write_bytes(data)
+
+    filename, file_hash, file_stats = indexer.calculate_hash(str(tmp_path), 'file', hash_options=hash_options)
+
+    assert file_hash == hashlib.md5(data).hexdigest()
+    assert file_stats[0] == size
+
+
+def test_hash_algorithm_is_recorded_in_index(datapath, stagingdir):
+    hash_options = hashing.HashOptions(algorithm='blake2b-128')
+
+    indexdir = indexer.index(str(datapath), str(stagingdir), hash_options=hash_options)
+
+    index_file = '{}/INDEX.db'.format(indexdir)
+    assert indexer.read_index_algorithm(index_file) == 'blake2b-128'
+    assert read_path_index(indexdir)['c/empty'] == hashlib.blake2b(digest_size=16).hexdigest()
+
+
+def test_batches_are_size_balanced_and_largest_first():
+    files = [('large{}'.format(i), 512 << 20) for i in range(2)] + \
+            [('small{}'.format(i), 1 << 10) for i in range(5000)]
+
+    batches = indexer.make_batches(files, 4)
+
+    assert batches[0] in (['large0'], ['large1']) and batches[1] in (['large0'], ['large1'])
+    assert sorted(sum(batches, [])) == sorted(filename for filename, size in files)
+    assert all(1 < len(batch) <= indexer.MAX_BATCH_FILES for batch in batches[2:])
+
+
+def test_chunked_files_get_tree_hashes_and_changed_ranges(tmp_path, stagingdir):
+    chunk_size = 4096
+    datapath = tmp_path / 'chunked'
+    datapath.mkdir()
+    data = bytearray(os.urandom(3 * chunk_size + 100))
+    (datapath / 'large').write_bytes(bytes(data))
+    (datapath / 'small').write_bytes(b'small')
+    hash_options = hashing.HashOptions(chunk_size=chunk_size)
+
+    indexdir = indexer.index(str(datapath), str(stagingdir), hash_options=hash_options)
+
+    chunks = [bytes(data[offset:offset + chunk_size]) for offset in range(0, len(data), chunk_size)]
+    chunk_hashes = [hashlib.md5(chunk).hexdigest() for chunk in chunks]
+    path_index = read_path_index(indexdir)
+    assert indexer.read_index_header('{}/INDEX.db'.format(indexdir)) == {'algorithm': 'md5', 'chunk_size': chunk_size}
+    assert indexer.read_chunk_index('{}/CHUNKS.idx'.format(indexdir)) == {'large': chunk_hashes}
+    assert path_index['large'] == hashing.tree_hash(chunk_hashes)
+    assert path_index['small'] == hashlib.md5(b'small').hexdigest()
+
+    data[chunk_size + 10] ^= 0xff
+    data[2 * chunk_size] ^= 0xff
+    new_chunk_hashes = [hashlib.md5(bytes(data[offset:offset + chunk_size])).hexdigest()
+                        for offset in range(0, len(data), chunk_size)]
+    assert hashing.changed_ranges(chunk_hashes, new_chunk_hashes, chunk_size, len(data)) == \
+        [(chunk_size, 3 * chunk_size)]
+    assert hashing.changed_ranges(chunk_hashes, chunk_hashes[:2], chunk_size, 2 * chunk_size) == \
+        [(2 * chunk_size, 2 * chunk_size)]
+
+
+def test_index_writer_inserts_entries_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(indexer, 'WRITE_BATCH_FILES', 2)
+    indexdir = str(tmp_path / 'index')
+    writer = indexer.IndexWriter(indexdir, chunk_size=4096)
+
+    writer.add(('file{}'.format(i), 'hash{}'.format(i), (i, 0, 0, 0)) for i in range(5))
+    writer.add_chunks('file4', ['chunk0', 'chunk1'])
+
+    assert writer.nfiles == 4 and not os.path.exists(os.path.join(indexdir, 'INDEX.db'))
+    writer.close()
+    with indexstore.IndexStore(os.path.join(indexdir, 'INDEX.db')) as store:
+        assert len(store) == 5 and store.get('file4') == ('hash4', (4, 0, 0, 0))
+    assert indexer.read_chunk_index(os.path.join(indexdir, 'CHUNKS.idx')) == {'file4': ['chunk0', 'chunk1']}
+    assert sorted(os.listdir(indexdir)) == ['CHUNKS.idx', 'INDEX.db']
+
+
+def test_index_is_synced_before_its_journals_are_removed(tmp_path, monkeypatch):
+    indexdir = str(tmp_path / 'index')
+    writer = indexer.IndexWriter(indexdir)
+    writer.add([('file', 'hash', (1, 0, 0, 0))])
+    events = []
+    sync_path, replace, remove_journals = journal.sync_path, os.replace, journal.remove_journals
+    monkeypatch.setattr(journal, 'sync_path', lambda path: events.append(('sync', path)) or sync_path(path))
+    monkeypatch.setattr(os, 'replace', lambda src, dst: events.append(('replace', src)) or replace(src, dst))
+    monkeypatch.setattr(journal, 'remove_journals',
+                        lambda indexdir: events.append(('remove_journals', indexdir)) or remove_journals(indexdir))
+
+    writer.close()
+
+    index_file = os.path.join(indexdir, 'INDEX.db.tmp')
+    assert [event for event in events if event[0] != 'replace' or event[1] == index_file] == \
+        [('sync', index_file), ('replace', index_file), ('sync', indexdir), ('remove_journals', indexdir)]
+
+
+def test_interrupted_index_is_resumed_from_journal(datapath, stagingdir, monkeypatch, hashed):
+    indexdir = indexer.index(str(datapath), str(stagingdir))
+    expected = read_path_index(indexdir)
+    calculate_hash = indexer.calculate_hash
+    hashed.clear()
+
+    def interrupted_hash(datapath, filename, prev_index=None, hash_options=None):
+        if len(hashed) == 3:
+            raise IOError('interrupted')
+        return calculate_hash(datapath, filename, prev_index, hash_options)
+
+    monkeypatch.setattr(indexer, 'calculate_hash', interrupted_hash)
+    with pytest.raises(IOError):
+        indexer.index(str(datapath), str(stagingdir), manager='asyncio', verify=True, concurrency=1)
+    assert any(name.startswith('INDEX.journal.') for name in os.listdir(indexdir))
+
+    monkeypatch.setattr(indexer, 'calculate_hash', calculate_hash)
+    hashed.clear()
+    indexer.index(str(datapath), str(stagingdir), manager='asyncio', verify=True, resume=True)
+
+    assert len(hashed) == 2
+    assert read_path_index(indexdir) == expected
+    assert not any(name.startswith('INDEX.journal.') for name in os.listdir(indexdir))
+
+
+def test_unreadable_files_are_retried_and_listed_in_errors(datapath, stagingdir, monkeypatch):
+    calculate_hash = indexer.calculate_hash
+    failures = {'a/x.txt': [errno.EIO], 'c/x.txt': [errno.EACCES]}
+
+    def failing_hash(datapath, filename, prev_index=None, hash_options=None):
+        if failures.get(filename):
+            error = failures[filename].pop()
+            raise OSError(error, os.strerror(error), filename)
+        return calculate_hash(datapath, filename, prev_index, hash_options)
+
+    monkeypatch.setattr(indexer, 'calculate_hash', failing_hash)
+    monkeypatch.setattr(indexer, 'RETRY_DELAY', 0)
+    with pytest.raises(PermissionError):
+        indexer.index(str(datapath), str(stagingdir), manager='threads')
+
+    failures = {'a/x.txt': [errno.EIO], 'c/x.txt': [errno.EACCES]}
+    indexdir = indexer.index(str(datapath), str(stagingdir), manager='threads', continue_on_error=True)
+
+    assert sorted(read_path_index(indexdir)) == ['a/b/y.h5', 'a/x.txt', 'c/empty', 'top.txt']
+    with open(os.path.join(indexdir, 'ERRORS')) as f:
+        assert f.read() == 'c/x.txt: {} (EACCES)\n'.format(os.strerror(errno.EACCES))
+
+    indexer.index(str(datapath), str(stagingdir), manager='threads', continue_on_error=True)
+    assert len(read_path_index(indexdir)) == 5 and not os.path.exists(os.path.join(indexdir, 'ERRORS'))
+
+
+@pytest.mark.parametrize('manager', ['python', 'threads'])
+def test_unreadable_file_stops_the_indexing_promptly(tmp_path, stagingdir, monkeypatch, manager):
+    datapath = tmp_path / 'many'
+    datapath.mkdir()
+    for i in range(200):
+        (datapath / 'file{:03}'.format(i)).write_text('file')
+    # the largest file is in the first batch
+    (datapath / 'unreadable').write_text('unreadable')
+    calculate_hash = indexer.calculate_hash
+    # the files hashed by the worker processes are counted in a file
+    hashed_file = tmp_path / 'hashed'
+    hashed_file.write_text('')
+
+    def slow_hash(datapath, filename, prev_index=None, hash_options=None):
+        if filename == 'unreadable':
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), filename)
+        time.sleep(0.05)
+        with open(str(hashed_file), 'a') as f:
+            f.write('{}\n'.format(filename))
+        return calculate_hash(datapath, filename, prev_index, hash_options)
+
+    monkeypatch.setattr(indexer, 'calculate_hash', slow_hash)
+    with pytest.raises(PermissionError):
+        indexer.index(str(datapath), str(stagingdir), manager=manager, nthreads=2)
+
+    # the workers are stopped, or done with their batch, once the indexing stops
+    nhashed = len(hashed_file.read_text().splitlines())
+    time.sleep(0.2)
+    assert len(hashed_file.read_text().splitlines()) == nhashed < 200
+
+
+def test_hard_linked_snapshot_is_indexed_from_hash_cache(datapath, stagingdir, tmp_path, hashed):
+    indexer.index(str(datapath), str(stagingdir), hash_cache=True)
+    snapshot = tmp_path / 'snapshot'
+    for filepath in datapath.rglob('*'):
+        if filepath.is_file():
+            (snapshot / filepath.relative_to(datapath)).parent.mkdir(parents=True, exist_ok=True)
+            os.link(str(filepath), str(snapshot / filepath.relative_to(datapath)))
+    (snapshot / 'new.txt').write_text('new')
+    indexdir = indexer.index(str(snapshot), str(stagingdir), manager='threads', hash_cache=True)
+
+    assert hashed == [str(snapshot / 'new.txt')]
+    assert read_path_index(indexdir)['a/x.txt'] == hashlib.md5(b'a/x.txt').hexdigest()
+
+
+def test_hash_cache_evicts_least_recently_indexed_files(tmp_path, monkeypatch):
+    with hashcache.HashCache(str(tmp_path / 'HASHCACHE.db')) as cache:
+        for i in range(4):
+            monkeypatch.setattr(hashcache.time, 'time', lambda: 1000 + i)
+            cache.add([('hash{}'.format(i), (i, 0, 1 << 63, 1))], 'md5')
+
+        assert cache.evict(max_entries=2) == 2
+        assert len(cache) == 2 and cache.get((3, 0, 1 << 63, 1), 'md5') == 'hash3'
+        assert cache.get((0, 0, 1 << 63, 1), 'md5') is None and cache.get((3, 0, 1 << 63, 1), 'sha1') is None
+
+
+def test_hashes_stored_in_xattrs_survive_a_new_staging_dir(datapath, tmp_path, hashed):
+    hash_options = hashing.HashOptions(use_xattrs=True)
+    indexer.index(str(datapath), str(tmp_path / 'stage1'), hash_options=hash_options)
+    stats = os.stat(str(datapath / 'top.txt'))
+    assert os.getxattr(str(datapath / 'top.txt'), 'user.dacman.md5') == \
+        '{} {} {}'.format(hashlib.md5(b'top.txt').hexdigest(), stats.st_size, stats.st_mtime_ns).encode()
+    os.utime(str(datapath / 'c/x.txt'), ns=(stats.st_atime_ns, stats.st_mtime_ns + 1))
+    hashed.clear()
+    indexdir = indexer.index(str(datapath), str(tmp_path / 'stage2'), manager='threads', hash_options=hash_options)
+
+    assert hashed == [str(datapath / 'c/x.txt')]
+    assert read_path_index(indexdir)['top.txt'] == hashlib.md5(b'top.txt').hexdigest()
+
+
+def test_files_without_xattr_support_are_hashed(datapath, stagingdir, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.ENOTSUP, os.strerror(errno.ENOTSUP))
+
+    monkeypatch.setattr(os, 'getxattr', unsupported)
+    monkeypatch.setattr(os, 'setxattr', unsupported)
+    indexdir = indexer.index(str(datapath), str(stagingdir), hash_options=hashing.HashOptions(use_xattrs=True))
+
+    assert len(read_path_index(indexdir)) == 5
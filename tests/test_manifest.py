@@ -0,0 +1,121 @@
+"""
+Checks the import of checksum manifests into indexes, and the export of indexes as manifests.
+"""
+
+import os
+import errno
+import hashlib
+
+import pytest
+
+from dacman.core import indexer
+from dacman.core import hashing
+from dacman.core import hashcache
+from dacman.core import manifest
+from dacman.core import scanner
+from dacman.core.utils import get_hash_id
+
+
+@pytest.fixture
+def bag(tmp_path):
+    root = tmp_path / 'bag'
+    (root / 'data/a').mkdir(parents=True)
+    for name in ['top.txt', 'a/x.txt', 'a/unlisted.txt']:
+        (root / 'data' / name).write_text(name)
+    return root
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_bagit_manifest_digests_are_imported_without_hashing(bag, tmp_path):
+    # the digest of top.txt is only in the index if it is taken from the manifest
+    (bag / 'manifest-sha256.txt').write_text('{}  data/top.txt\n{}  data/a/x.txt\n{}  data/missing.txt\n'.format(
+        'f' * 64, sha256(b'a/x.txt'), '0' * 64))
+
+    indexdir = manifest.import_manifest(str(bag / 'data'), str(bag / 'manifest-sha256.txt'), str(tmp_path / 'stage'))
+
+    index_file = os.path.join(indexdir, 'INDEX.db')
+    assert indexer.read_index_algorithm(index_file) == 'sha256'
+    assert indexer.read_path_index(index_file) == {'top.txt': 'f' * 64, 'a/x.txt': sha256(b'a/x.txt'),
+                                                   'a/unlisted.txt': sha256(b'a/unlisted.txt')}
+
+
+def test_manifest_not_matching_the_sample_is_rejected(bag, tmp_path):
+    (bag / 'data/SHA256SUMS').write_text('{} *top.txt\n{} *a/x.txt\n'.format('f' * 64, sha256(b'a/x.txt')))
+
+    with pytest.raises(SystemExit):
+        manifest.import_manifest(str(bag / 'data'), str(bag / 'data/SHA256SUMS'), str(tmp_path / 'stage'),
+                                 sample_size=2)
+
+    assert not os.path.exists(str(tmp_path / 'stage/indexes/{}/INDEX.db'.format(
+        get_hash_id(str(bag / 'data')))))
+
+
+def test_exported_manifests_read_back_as_the_index(bag, tmp_path):
+    (bag / 'data/back\\slash').write_text('escaped')
+    indexer.index(str(bag / 'data'), str(tmp_path / 'stage'))
+    md5sums = str(tmp_path / 'MD5SUMS')
+    bagit = str(tmp_path / 'manifest-md5.txt')
+
+    manifest.export_manifest(str(bag / 'data'), md5sums, str(tmp_path / 'stage'))
+    manifest.export_manifest(str(bag / 'data'), bagit, str(tmp_path / 'stage'), prefix='data/')
+
+    expected = sorted((hashlib.md5(name.encode() if name != 'back\\slash' else b'escaped').hexdigest(), name)
+                      for name in ['top.txt', 'a/x.txt', 'a/unlisted.txt', 'back\\slash'])
+    assert sorted(manifest.read_manifest(md5sums)) == expected
+    assert sorted(manifest.read_manifest(bagit)) == [(digest, 'data/' + name) for digest, name in expected]
+    assert manifest.get_algorithm(bagit, []) == 'md5'
+
+
+def test_imported_digests_stay_out_of_the_hash_cache_until_hashed(bag, tmp_path):
+    (bag / 'manifest-sha256.txt').write_text('{}  data/top.txt\n{}  data/a/x.txt\n'.format(
+        'f' * 64, sha256(b'a/x.txt')))
+    indexdir = manifest.import_manifest(str(bag / 'data'), str(bag / 'manifest-sha256.txt'), str(tmp_path / 'stage'))
+    hash_options = hashing.HashOptions(algorithm='sha256')
+
+    indexer.index(str(bag / 'data'), str(tmp_path / 'stage'), hash_options=hash_options, hash_cache=True)
+
+    with open(os.path.join(indexdir, 'UNVERIFIED')) as f:
+        assert sorted(f.read().split()) == ['a/x.txt', 'top.txt']
+    # only the file missing from the manifest was hashed
+    with hashcache.HashCache(str(tmp_path / 'stage/HASHCACHE.db')) as cache:
+        assert len(cache) == 1
+        assert cache.get(indexer.stat_file(str(bag / 'data/a/unlisted.txt')), 'sha256') == sha256(b'a/unlisted.txt')
+    indexer.index(str(bag / 'data'), str(tmp_path / 'stage'), hash_options=hash_options, verify=True)
+    indexer.index(str(bag / 'data'), str(tmp_path / 'stage'), hash_options=hash_options, hash_cache=True)
+    assert not os.path.exists(os.path.join(indexdir, 'UNVERIFIED'))
+    with hashcache.HashCache(str(tmp_path / 'stage/HASHCACHE.db')) as cache:
+        assert len(cache) == 3
+
+
+def test_manifest_with_unreadable_sampled_files_is_rejected(bag, tmp_path, monkeypatch):
+    (bag / 'data/SHA256SUMS').write_text('{} *top.txt\n{} *a/x.txt\n'.format(sha256(b'top.txt'),
+                                                                             sha256(b'a/x.txt')))
+    calculate_hash = indexer.calculate_hash
+
+    def unreadable_top(datapath, filename, prev_index=None, hash_options=None):
+        if filename == 'top.txt':
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), filename)
+        return calculate_hash(datapath, filename, prev_index, hash_options)
+
+    monkeypatch.setattr(indexer, 'calculate_hash', unreadable_top)
+    with pytest.raises(SystemExit):
+        manifest.import_manifest(str(bag / 'data'), str(bag / 'data/SHA256SUMS'), str(tmp_path / 'stage'),
+                                 sample_size=2)
+
+
+def test_files_removed_since_the_scan_are_not_imported(bag, tmp_path):
+    (bag / 'manifest-sha256.txt').write_text('{}  data/top.txt\n{}  data/a/x.txt\n'.format(
+        sha256(b'top.txt'), sha256(b'a/x.txt')))
+    scanner.scan(str(bag / 'data'), str(tmp_path / 'stage'))
+    (bag / 'data/top.txt').unlink()
+
+    indexdir = manifest.import_manifest(str(bag / 'data'), str(bag / 'manifest-sha256.txt'), str(tmp_path / 'stage'),
+                                        continue_on_error=True)
+
+    assert indexer.read_path_index(os.path.join(indexdir, 'INDEX.db')) == \
+        {'a/x.txt': sha256(b'a/x.txt'), 'a/unlisted.txt': sha256(b'a/unlisted.txt')}
+    with open(os.path.join(indexdir, 'ERRORS')) as f:
+        assert f.read().startswith('top.txt: ')
@@ -0,0 +1,132 @@
+"""
+Checks the MPI indexer and scanner; the parts that need MPI run with a local `mpirun`.
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+
+import pytest
+
+from dacman.core import indexer
+from dacman.core import indexstore
+from dacman.core import mpi_indexer
+from dacman.core import mpi_scanner
+from dacman.core import scanner
+from dacman.core.utils import get_hash_id
+
+
+def test_batches_shrink_as_files_run_out():
+    filelist = ['file{}'.format(i) for i in range(10000)]
+    queue = mpi_indexer.BatchQueue(filelist, 8)
+
+    batches = []
+    batch = queue.next_batch()
+    while batch is not None:
+        batches.append(batch)
+        batch = queue.next_batch()
+
+    assert sum(batches, []) == filelist
+    assert len(batches[0]) == 10000 // (mpi_indexer.BATCH_SHARE * 8)
+    assert all(len(a) >= len(b) for a, b in zip(batches, batches[1:]))
+    assert len(batches[-1]) == 1
+
+
+def test_partial_indexes_are_merged(tmp_path):
+    options = {'algorithm': 'md5', 'chunk_size': 0}
+    for rank in range(3):
+        with indexstore.IndexStore.create(mpi_indexer.get_part_file(str(tmp_path), rank), options) as store:
+            store.add([('file{}'.format(rank), 'hash{}'.format(rank), (rank, 0, 0, 0))])
+
+    with indexstore.IndexStore(mpi_indexer.get_part_file(str(tmp_path), 0)) as store:
+        for rank in [1, 2]:
+            store.merge(mpi_indexer.get_part_file(str(tmp_path), rank))
+        store.finish()
+        assert sorted(path for path, file_hash, stats in store.items()) == ['file0', 'file1', 'file2']
+        assert store.get('file2') == ('hash2', (2, 0, 0, 0))
+
+
+# Open MPI otherwise refuses more ranks than cores, or running as root (e.g. in containers)
+MPI_ENV = dict(os.environ, OMPI_MCA_rmaps_base_oversubscribe='1', OMPI_ALLOW_RUN_AS_ROOT='1',
+               OMPI_ALLOW_RUN_AS_ROOT_CONFIRM='1')
+
+needs_mpirun = pytest.mark.skipif(not mpi_scanner.__AVAIL_MPI__ or shutil.which('mpirun') is None,
+                                  reason='mpi4py and mpirun are needed')
+
+
+@needs_mpirun
+def test_mpi_scan_lists_the_same_files_as_the_scanner(tmp_path):
+    datapath = tmp_path / 'data'
+    for i in range(3):
+        (datapath / 'top{}'.format(i)).mkdir(parents=True)
+        for j in range(i * 3):
+            subdir = datapath / 'top{}'.format(i) / 'sub{}'.format(j) / 'deep'
+            subdir.mkdir(parents=True)
+            (subdir / 'file').write_text('file')
+            (subdir.parent / 'file').write_text('file')
+        (datapath / 'top{}'.format(i) / 'file').write_text('file')
+    (datapath / 'file').write_text('file')
+
+    subprocess.run(['mpirun', '-n', '4', sys.executable, '-m', 'dacman.core.mpi_scanner', str(datapath),
+                    str(tmp_path / 'mpi')], check=True, env=MPI_ENV)
+
+    indexdir = scanner.scan(str(datapath), str(tmp_path / 'serial'))
+    filelists = []
+    for paths_file in [os.path.join(str(tmp_path / 'mpi'), 'indexes', os.path.basename(indexdir), 'FILEPATHS'),
+                       os.path.join(indexdir, 'FILEPATHS')]:
+        with open(paths_file) as f:
+            filelists.append(sorted(f))
+    assert filelists[0] == filelists[1]
+    assert len(filelists[0]) == 1 + 3 + 2 * (0 + 3 + 6)
+
+
+@needs_mpirun
+@pytest.mark.parametrize('nranks', [1, 3])
+def test_mpi_index_matches_the_indexer(tmp_path, nranks):
+    datapath = tmp_path / 'data'
+    for i in range(4):
+        (datapath / 'dir{}'.format(i)).mkdir(parents=True)
+        for j in range(10):
+            (datapath / 'dir{}'.format(i) / 'file{}'.format(j)).write_text('file {} {}'.format(i, j))
+
+    subprocess.run(['mpirun', '-n', str(nranks), sys.executable, '-m', 'dacman.core.mpi_indexer', str(datapath),
+                    str(tmp_path / 'mpi')], check=True, env=MPI_ENV)
+
+    indexdir = indexer.index(str(datapath), str(tmp_path / 'serial'))
+    path_indexes = [indexer.read_path_index(os.path.join(str(stagingdir), 'indexes', os.path.basename(indexdir),
+                                                         indexstore.INDEX_DB))
+                    for stagingdir in [tmp_path / 'mpi', tmp_path / 'serial']]
+    assert len(path_indexes[0]) == 40
+    assert path_indexes[0] == path_indexes[1]
+
+
+@needs_mpirun
+@pytest.mark.parametrize('nranks', [1, 3])
+def test_mpi_index_reuses_the_hash_cache_of_rank_0(tmp_path, nranks):
+    datapath = tmp_path / 'data'
+    snapshot = tmp_path / 'snapshot'
+    for i in range(400):
+        (datapath / 'dir{}'.format(i % 4)).mkdir(parents=True, exist_ok=True)
+        (datapath / 'dir{}'.format(i % 4) / 'file{}'.format(i)).write_text('file {:03}'.format(i))
+    code = ('import sys; from dacman.core import mpi_indexer; '
+            'mpi_indexer.index(sys.argv[1], sys.argv[2], hash_cache=True)')
+    subprocess.run(['mpirun', '-n', str(nranks), sys.executable, '-c', code, str(datapath), str(tmp_path / 'stage')],
+                   check=True, env=MPI_ENV)
+    for filepath in datapath.rglob('file*'):
+        (snapshot / filepath.relative_to(datapath)).parent.mkdir(parents=True, exist_ok=True)
+        os.link(str(filepath), str(snapshot / filepath.relative_to(datapath)))
+    # contents changed in place with the same size and mtime are only seen by hashing the files
+    for filepath in datapath.rglob('file*'):
+        stats = filepath.stat()
+        filepath.write_text(filepath.read_text().replace('file', 'FILE'))
+        os.utime(str(filepath), ns=(stats.st_atime_ns, stats.st_mtime_ns))
+
+    subprocess.run(['mpirun', '-n', str(nranks), sys.executable, '-c', code, str(snapshot), str(tmp_path / 'stage')],
+                   check=True, env=MPI_ENV)
+
+    indexes = [indexer.read_path_index(os.path.join(str(tmp_path / 'stage'), 'indexes', get_hash_id(str(path)),
+                                                    indexstore.INDEX_DB))
+               for path in [datapath, snapshot]]
+    assert len(indexes[1]) == 400
+    assert indexes[1] == indexes[0]
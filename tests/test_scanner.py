@@ -0,0 +1,128 @@
+"""
+Checks the directory scan and the files it saves in the staging directory.
+"""
+
+import pytest
+
+from dacman.core import scanner
+
+
+@pytest.fixture
+def datapath(tmp_path):
+    root = tmp_path / 'data'
+    for subdir in ['a', 'a/b', 'a/b/c', 'd', 'e/f']:
+        (root / subdir).mkdir(parents=True)
+    for name in ['top.txt', 'a/x.txt', 'a/b/y.h5', 'a/b/c/z.txt', 'd/w.csv', 'e/f/v.txt']:
+        (root / name).write_text(name)
+    return root
+
+
+@pytest.fixture
+def stagingdir(tmp_path):
+    return tmp_path / 'stage'
+
+
+def read_filepaths(indexdir):
+    with open('{}/FILEPATHS'.format(indexdir)) as f:
+        return sorted(line.strip() for line in f)
+
+
+def test_scan_lists_all_files(datapath, stagingdir):
+    indexdir = scanner.scan(str(datapath), str(stagingdir))
+
+    assert read_filepaths(indexdir) == ['a/b/c/z.txt', 'a/b/y.h5', 'a/x.txt', 'd/w.csv', 'e/f/v.txt', 'top.txt']
+
+
+def test_parallel_scan_matches_serial_scan(datapath, stagingdir):
+    serial = read_filepaths(scanner.scan(str(datapath), str(stagingdir)))
+    parallel = read_filepaths(scanner.scan(str(datapath), str(stagingdir), nthreads=4))
+
+    assert parallel == serial
+
+
+def test_incremental_scan_relists_changed_directories(datapath, stagingdir):
+    scanner.scan(str(datapath), str(stagingdir))
+    (datapath / 'a/b/new.txt').write_text('new')
+    (datapath / 'd/w.csv').unlink()
+
+    indexdir = scanner.scan(str(datapath), str(stagingdir), incremental=True)
+
+    assert read_filepaths(indexdir) == ['a/b/c/z.txt', 'a/b/new.txt', 'a/b/y.h5', 'a/x.txt', 'e/f/v.txt', 'top.txt']
+
+
+def test_ignored_directories_are_pruned(datapath, stagingdir):
+    indexdir = scanner.scan(str(datapath), str(stagingdir), ignorelist=['a/b', 'e/*', '*.csv'])
+
+    assert read_filepaths(indexdir) == ['a/x.txt', 'top.txt']
+
+
+@pytest.mark.parametrize('nthreads', [1, 4])
+def test_ignore_patterns_match_relative_paths_of_files_and_directories(datapath, stagingdir, nthreads):
+    assert read_filepaths(scanner.scan(str(datapath), str(stagingdir), nthreads=nthreads, ignorelist=['b'])) == \
+        ['a/b/c/z.txt', 'a/b/y.h5', 'a/x.txt', 'd/w.csv', 'e/f/v.txt', 'top.txt']
+    assert read_filepaths(scanner.scan(str(datapath), str(stagingdir), nthreads=nthreads, ignorelist=['*/b'])) == \
+        ['a/x.txt', 'd/w.csv', 'e/f/v.txt', 'top.txt']
+    # the directory txt does not match, and neither does the file in it
+    (datapath / 'txt').mkdir()
+    (datapath / 'txt/notes.txt').write_text('notes')
+    assert read_filepaths(scanner.scan(str(datapath), str(stagingdir), nthreads=nthreads, ignorelist=['*[!t]'])) == \
+        ['top.txt', 'txt/notes.txt']
+
+
+def test_extension_and_size_filters(datapath, stagingdir):
+    (datapath / 'a/big.txt').write_text('x' * 100)
+
+    indexdir = scanner.scan(str(datapath), str(stagingdir), nthreads=4, extensions=['txt'], min_size=50)
+
+    assert read_filepaths(indexdir) == ['a/big.txt']
+
+
+def test_metadata_details_are_saved_per_file(datapath, stagingdir):
+    (datapath / 'a/x.txt').chmod(0o600)
+
+    indexdir = scanner.scan(str(datapath), str(stagingdir), details=True)
+    filestats = scanner.FileStats.load('{}/FILESTATS.npz'.format(indexdir), '{}/FILEPATHS'.format(indexdir))
+
+    owner, group, size = filestats['a/x.txt']
+    assert owner == scanner.get_owner((datapath / 'a/x.txt').stat().st_uid)
+    assert size == len('a/x.txt')
+    assert filestats.mode('a/x.txt') & 0o777 == 0o600
+    # permissions are recorded, but only owner, group and size are compared
+    assert filestats['a/b/y.h5'] != filestats['a/x.txt']
+    assert filestats['a/x.txt'] == filestats['d/w.csv']
+    with open('{}/METADATA'.format(indexdir)) as f:
+        assert 'a/x.txt:owner={},group={},size=7\n'.format(owner, group) in f.read()
+
+
+@pytest.mark.parametrize('nthreads', [1, 4])
+def test_symlink_loops_are_skipped_and_aliases_are_listed(datapath, stagingdir, nthreads):
+    (datapath / 'a/b/loop').symlink_to('../..')
+    (datapath / 'd/alias').symlink_to('../e')
+    (datapath / 'e/f/twin').symlink_to('../../e')
+
+    indexdir = scanner.scan(str(datapath), str(stagingdir), symlinks=True, nthreads=nthreads)
+
+    # every path to e is listed, whichever is scanned first
+    assert read_filepaths(indexdir) == ['a/b/c/z.txt', 'a/b/y.h5', 'a/x.txt', 'd/alias/f/v.txt', 'd/w.csv',
+                                        'e/f/v.txt', 'top.txt']
+
+
+def test_deep_directory_tree(tmp_path, stagingdir):
+    # deeper than the interpreter's recursion limit
+    deepest = tmp_path / 'data'
+    deepest.mkdir()
+    for depth in range(1200):
+        deepest = deepest / 'd'
+        deepest.mkdir()
+    (deepest / 'leaf.txt').write_text('leaf')
+
+    try:
+        indexdir = scanner.scan(str(tmp_path / 'data'), str(stagingdir))
+
+        assert read_filepaths(indexdir) == ['/'.join(['d'] * 1200 + ['leaf.txt'])]
+    finally:
+        # the tree is too deep for the recursive cleanup of pytest's temporary directories
+        (deepest / 'leaf.txt').unlink()
+        while deepest != tmp_path:
+            deepest.rmdir()
+            deepest = deepest.parent